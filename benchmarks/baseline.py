@@ -0,0 +1,72 @@
+"""
+Сохраненные результаты бенчмарков и проверка на регрессию.
+
+Файл базовой линии — JSON {сценарий: {метрика: значение}}. Метрики задержки
+(имя оканчивается на _ms) не должны вырасти, метрики пропускной способности
+(оканчиваются на _per_sec) — упасть больше чем на допустимую долю. Остальные
+значения сохраняются для справки и не сравниваются.
+
+Чтобы проверка не срабатывала на шуме, базовую линию лучше записать как огибающую
+нескольких прогонов (merge): для каждой метрики остается худшее значение.
+"""
+import json
+import os
+from typing import Dict, List
+
+
+def load(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def worst(metric: str, a: float, b: float) -> float:
+    """Худшее из двух значений метрики (для остальных метрик — последнее)"""
+    if metric.endswith("_ms"):
+        return max(a, b)
+    if metric.endswith("_per_sec"):
+        return min(a, b)
+    return b
+
+
+def save(path: str, scenario: str, results: Dict[str, float], merge: bool = False):
+    """
+    Записывает результаты сценария, не трогая остальные сценарии файла.
+
+    merge оставляет для каждой метрики худшее из сохраненного и нового значения.
+    """
+    baselines = load(path)
+    if merge and scenario in baselines:
+        previous = baselines[scenario]
+        results = {metric: worst(metric, previous[metric], value) if metric in previous else value
+                   for metric, value in results.items()}
+    baselines[scenario] = results
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(baseline: Dict[str, float], results: Dict[str, float], max_regression: float) -> List[str]:
+    """Список регрессий больше max_regression (доля, 0.2 = 20%)"""
+    regressions = []
+    for metric, expected in sorted(baseline.items()):
+        actual = results.get(metric)
+        if actual is None or not expected:
+            continue
+        if metric.endswith("_ms") and actual > expected * (1 + max_regression):
+            regressions.append(f"{metric}: {actual:.2f} мс против {expected:.2f} мс "
+                               f"(+{(actual / expected - 1) * 100:.0f}%)")
+        elif metric.endswith("_per_sec") and actual < expected * (1 - max_regression):
+            regressions.append(f"{metric}: {actual:.1f}/с против {expected:.1f}/с "
+                               f"(-{(1 - actual / expected) * 100:.0f}%)")
+    return regressions
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
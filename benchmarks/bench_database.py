@@ -0,0 +1,238 @@
+"""
+Задержка и пропускная способность методов Database на базах разного размера.
+
+Для каждого размера (--sizes, число сообщений) заполняет базу синтетическими
+пользователями: сообщения, токены устройств, связи с Telegram и режимы поддержки.
+Заполненные файлы остаются в --data-dir и используются повторно. Каждый метод
+вызывается --ops раз в одном потоке (p50/p95/p99 и вызовов в секунду) и столько
+же раз из --threads потоков одновременно (вызовов в секунду и p95). Кэши Database
+выключены, чтобы замерялась работа с SQLite.
+
+Результаты сравниваются с базовой линией каждого размера из --baseline: если
+метод медленнее больше чем на --max-regression, код возврата 1. С --ci отсутствие
+базовой линии для размера — тоже ошибка (код 1), иначе проверка молча не выполнялась
+бы. Базовая линия для CI (--sizes 10000) лежит в baselines/database.json: огибающая
+трех прогонов на машине разработчика. Хвосты задержек (p99, p95 в потоках) на общей
+машине колеблются до двух раз, поэтому CI проверяет с --max-regression 1.5 и ловит
+грубые регрессии (пропавший индекс, лишний запрос); после смены железа CI базовую
+линию перезаписывают там же.
+--save-baseline записывает текущий прогон, --merge-baseline добавляет его к сохраненному
+(худшее значение каждой метрики; запустите несколько раз, чтобы учесть шум). Запуск:
+
+    python benchmarks/bench_database.py --sizes 10000 1000000 10000000
+    python benchmarks/bench_database.py --sizes 10000 --ci --max-regression 1.5
+    python benchmarks/bench_database.py --sizes 10000 --save-baseline
+    python benchmarks/bench_database.py --sizes 10000 --merge-baseline
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import logging
+logging.disable(logging.INFO)
+
+import baseline
+from database import Database
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "database.json")
+WORDS = ["здравствуйте", "бронирование", "возврат", "оплата", "номер", "отель", "спасибо", "вопрос",
+         "hello", "booking", "refund", "payment", "please", "заказ", "доставка", "скидка"]
+# Первый telegram_message_id новых связей, выше всех заполненных
+NEW_MAPPING_IDS_FROM = 10 ** 12
+
+
+def seed(db: Database, messages: int, messages_per_user: int, seed_value: int = 42) -> int:
+    """Заполняет пустую базу; возвращает число пользователей"""
+    rng = random.Random(seed_value)
+    users = max(1, messages // messages_per_user)
+    conn = db.get_connection()
+    batch = []
+    for i in range(messages):
+        text = " ".join(rng.choices(WORDS, k=rng.randint(3, 12)))
+        batch.append((f"user-{rng.randrange(users)}", text, rng.choice(["user", "support"])))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO messages (user_id, message_text, direction) VALUES (?, ?, ?)", batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages (user_id, message_text, direction) VALUES (?, ?, ?)", batch)
+    conn.executemany("INSERT INTO device_tokens (user_id, fcm_token, platform) VALUES (?, ?, 'android')",
+                     ((f"user-{u}", f"token-{u}") for u in range(users)))
+    # Одна связь с Telegram на десять сообщений
+    conn.executemany("INSERT INTO message_mapping (user_id, telegram_message_id) VALUES (?, ?)",
+                     ((f"user-{rng.randrange(users)}", i) for i in range(messages // 10)))
+    conn.executemany("INSERT INTO user_support_mode (user_id, mode) VALUES (?, ?)",
+                     ((f"user-{u}", "human" if u % 10 == 0 else "ai") for u in range(users)))
+    conn.commit()
+    conn.close()
+    return users
+
+
+def open_database(data_dir: str, messages: int, messages_per_user: int, write_behind: bool):
+    path = os.path.join(data_dir, f"bench_{messages}")
+    os.makedirs(path, exist_ok=True)
+    previous_cwd = os.getcwd()
+    os.chdir(path)  # Database кладет файл в текущую директорию
+    try:
+        db = Database("bench.db", write_behind=write_behind)
+    finally:
+        os.chdir(previous_cwd)
+    conn = db.get_connection()
+    existing = conn.execute("SELECT COUNT(*) FROM user_support_mode").fetchone()[0]
+    conn.close()
+    if existing:
+        return db, existing
+    started = time.perf_counter()
+    users = seed(db, messages, messages_per_user)
+    print(f"  заполнено {messages:,} сообщений, {users:,} пользователей за {time.perf_counter() - started:.1f} с")
+    return db, users
+
+
+def operations(db: Database, users: int, mappings: int):
+    """Имя метода -> функция одного вызова со случайными аргументами"""
+    mapping_ids = iter(range(NEW_MAPPING_IDS_FROM, NEW_MAPPING_IDS_FROM + 10 ** 9))
+    mapping_lock = threading.Lock()
+
+    def user(rng):
+        return f"user-{rng.randrange(users)}"
+
+    def new_mapping(rng):
+        with mapping_lock:
+            telegram_message_id = next(mapping_ids)
+        db.save_message_mapping(user(rng), telegram_message_id)
+
+    return {
+        "get_message_history": lambda rng: db.get_message_history(user(rng), limit=50),
+        "get_last_message_id": lambda rng: db.get_last_message_id(user(rng)),
+        "get_device_tokens": lambda rng: db.get_device_tokens(user(rng)),
+        "get_user_by_telegram_message": lambda rng: db.get_user_by_telegram_message(rng.randrange(max(1, mappings))),
+        "get_user_support_mode": lambda rng: db.get_user_support_mode(user(rng)),
+        "save_message": lambda rng: db.save_message(user(rng), "как изменить бронирование", None, "user"),
+        "save_device_token": lambda rng: db.save_device_token(user(rng), f"token-{rng.randrange(10 ** 9)}", "ios"),
+        "save_message_mapping": new_mapping,
+        "set_user_support_mode": lambda rng: db.set_user_support_mode(user(rng), rng.choice(["ai", "human"])),
+        "update_last_user_message_time": lambda rng: db.update_last_user_message_time(user(rng)),
+        "reset_expired_human_sessions": lambda rng: db.reset_expired_human_sessions(5),
+    }
+
+
+def run_single(op, ops: int) -> dict:
+    rng = random.Random(1)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(ops):
+        call_started = time.perf_counter()
+        op(rng)
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "st_p50_ms": round(baseline.percentile(latencies, 0.5), 4),
+        "st_p95_ms": round(baseline.percentile(latencies, 0.95), 4),
+        "st_p99_ms": round(baseline.percentile(latencies, 0.99), 4),
+        "st_per_sec": round(ops / elapsed, 1),
+    }
+
+
+def run_threads(op, ops: int, threads: int) -> dict:
+    barrier = threading.Barrier(threads + 1)
+    latencies = [[] for _ in range(threads)]
+    errors = []
+
+    def worker(idx: int):
+        rng = random.Random(idx + 2)
+        barrier.wait()
+        try:
+            for _ in range(max(1, ops // threads)):
+                call_started = time.perf_counter()
+                op(rng)
+                latencies[idx].append((time.perf_counter() - call_started) * 1000)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    merged = sorted(value for values in latencies for value in values)
+    result = {
+        "mt_p95_ms": round(baseline.percentile(merged, 0.95), 4),
+        "mt_per_sec": round(len(merged) / elapsed, 1),
+    }
+    if errors:
+        result["mt_errors"] = len(errors)
+        print(f"    ошибок: {len(errors)}, первая: {errors[0]}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000],
+                        help="число сообщений в базе")
+    parser.add_argument("--messages-per-user", type=int, default=50)
+    parser.add_argument("--ops", type=int, default=2000, help="вызовов каждого метода")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--methods", nargs="+", help="только эти методы")
+    parser.add_argument("--write-behind", action="store_true", help="WRITE_BEHIND_ENABLED")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "smile_bench_database"),
+                        help="где хранить заполненные базы между запусками")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--merge-baseline", action="store_true", help="добавить прогон к базовой линии")
+    parser.add_argument("--max-regression", type=float, default=0.3, help="допустимое ухудшение (доля)")
+    parser.add_argument("--ci", action="store_true", help="ошибка, если базовой линии нет")
+    args = parser.parse_args()
+
+    regressions = []
+    missing = []
+    baselines = baseline.load(args.baseline)
+    for size in args.sizes:
+        print(f"\nбаза {size:,} сообщений ({args.data_dir})")
+        db, users = open_database(args.data_dir, size, args.messages_per_user, args.write_behind)
+        ops = operations(db, users, size // 10)
+        names = args.methods or list(ops)
+        print(f"  {'метод':32s} {'p50 мс':>9s} {'p95 мс':>9s} {'p99 мс':>9s} {'в сек':>9s}"
+              f" {args.threads:>3d} потоков: {'в сек':>9s} {'p95 мс':>9s}")
+        results = {}
+        for name in names:
+            single = run_single(ops[name], args.ops)
+            multi = run_threads(ops[name], args.ops, args.threads)
+            print(f"  {name:32s} {single['st_p50_ms']:9.3f} {single['st_p95_ms']:9.3f} {single['st_p99_ms']:9.3f}"
+                  f" {single['st_per_sec']:9.0f}             {multi['mt_per_sec']:9.0f} {multi['mt_p95_ms']:9.3f}")
+            results.update({f"{name}.{key}": value for key, value in {**single, **multi}.items()})
+        db.close()
+
+        scenario = f"{size}{'-write-behind' if args.write_behind else ''}"
+        if args.save_baseline or args.merge_baseline:
+            baseline.save(args.baseline, scenario, results, merge=args.merge_baseline)
+            print(f"  базовая линия '{scenario}' сохранена в {args.baseline}")
+        elif scenario in baselines:
+            found = baseline.compare(baselines[scenario], results, args.max_regression)
+            regressions.extend(f"{scenario}: {line}" for line in found)
+        else:
+            print(f"  базовой линии '{scenario}' нет, сохраните ее с --save-baseline")
+            missing.append(scenario)
+
+    if regressions:
+        print(f"\nРЕГРЕССИЯ относительно базовой линии (порог {args.max_regression:.0%}):")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    if missing and args.ci:
+        print(f"\nОШИБКА: нет базовой линии для {', '.join(missing)} в {args.baseline}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Задержка полнотекстового поиска (FTS5) по большой таблице сообщений.
+
+Заполняет временную базу синтетическими сообщениями на русском и английском
+с редкими номерами бронирований и замеряет Database.search_messages для
+редкого, среднего и частого запроса. Запуск:
+
+    python benchmarks/bench_search.py --messages 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.INFO)
+
+from database import Database
+
+COMMON = ["здравствуйте", "спасибо", "hello", "please", "вопрос", "помогите", "thanks", "заказ"]
+MEDIUM = ["бронирование", "возврат", "booking", "refund", "оплата", "доставка", "cancel", "номер",
+          "отель", "payment", "трансфер", "invoice", "скидка", "upgrade", "ребенок", "luggage"]
+FILLER = [f"слово{i}" for i in range(3000)] + [f"word{i}" for i in range(3000)]
+
+
+def fill(db: Database, messages: int, users: int, seed: int = 42):
+    rng = random.Random(seed)
+    conn = db.get_connection()
+    batch = []
+    for i in range(messages):
+        words = rng.sample(FILLER, 6) + [rng.choice(COMMON)]
+        if rng.random() < 0.2:
+            words.append(rng.choice(MEDIUM))
+        if rng.random() < 0.001:
+            words.append(f"BK{rng.randrange(10 ** 6):06d}")
+        rng.shuffle(words)
+        batch.append((f"user-{rng.randrange(users)}", " ".join(words), rng.choice(["user", "support"])))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO messages (user_id, message_text, direction) VALUES (?, ?, ?)", batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages (user_id, message_text, direction) VALUES (?, ?, ?)", batch)
+        conn.commit()
+    booking = conn.execute(
+        "SELECT message_text FROM messages WHERE message_text LIKE '%BK%' LIMIT 1").fetchone()
+    conn.close()
+    return next(word for word in booking[0].split() if word.startswith("BK")) if booking else "BK000000"
+
+
+def measure(db: Database, query: str, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        results = db.search_messages(query, limit=21)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    os.chdir(workdir)  # Database кладет файл в текущую директорию
+    db = Database("bench.db")
+
+    started = time.perf_counter()
+    booking = fill(db, args.messages, args.users)
+    print(f"заполнено {args.messages:,} сообщений за {time.perf_counter() - started:.1f} с")
+
+    queries = [
+        ("редкий (номер брони)", booking),
+        ("средний", "бронирование"),
+        ("средний, префикс", "брониров"),
+        ("два слова", "refund payment"),
+        ("частый", "здравствуйте"),
+    ]
+    for name, query in queries:
+        p50, p95, found = measure(db, query, args.repeats)
+        print(f"  {name:24s} {query!r:20s} p50={p50:7.2f} мс  p95={p95:7.2f} мс  результатов={found}")
+
+
+if __name__ == "__main__":
+    main()
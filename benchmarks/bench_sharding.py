@@ -0,0 +1,78 @@
+"""
+Скорость параллельной записи сообщений в один файл SQLite и в N шардов.
+
+Каждый поток пишет сообщения своих пользователей через Database.save_message.
+В одном файле все потоки ждут единственную блокировку записи; с шардами
+пользователи разных файлов пишут параллельно. Каждая конфигурация использует
+свою временную директорию. Запуск:
+
+    python benchmarks/bench_sharding.py --threads 16 --messages 200 --shards 4 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.INFO)
+
+from database import Database
+
+
+def run(threads: int, messages: int, users_per_thread: int, shards: int) -> float:
+    workdir = tempfile.mkdtemp(prefix="bench_sharding_")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)  # Database кладет файлы в текущую директорию
+    try:
+        db = Database("bench.db", shards=shards)
+        barrier = threading.Barrier(threads + 1)
+        errors = []
+
+        def writer(thread_idx: int):
+            barrier.wait()
+            try:
+                for i in range(messages):
+                    user_id = f"user-{thread_idx}-{i % users_per_thread}"
+                    db.save_message(user_id, f"сообщение {i}", None, "user")
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        db.close()
+        if errors:
+            print(f"  ошибок записи: {len(errors)}, первая: {errors[0]}")
+        return threads * messages / elapsed
+    finally:
+        os.chdir(previous_cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200, help="сообщений на поток")
+    parser.add_argument("--users-per-thread", type=int, default=10)
+    parser.add_argument("--shards", type=int, nargs="+", default=[4, 8], help="варианты DB_SHARDS")
+    args = parser.parse_args()
+
+    print(f"потоков={args.threads}, сообщений на поток={args.messages}")
+    baseline = run(args.threads, args.messages, args.users_per_thread, 0)
+    print(f"  {'один файл':20s} {baseline:10,.0f} вставок/с")
+    for shards in args.shards:
+        rate = run(args.threads, args.messages, args.users_per_thread, shards)
+        print(f"  {f'{shards} шардов':20s} {rate:10,.0f} вставок/с  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Сравнение скорости вставки сообщений с групповой фиксацией и без нее.
+
+Несколько потоков одновременно вызывают Database.save_message (как запросы
+/send_message при всплеске). Каждая конфигурация пишет в свою временную базу.
+Запуск:
+
+    python benchmarks/bench_write_queue.py --threads 8 --messages 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.INFO)
+
+from database import Database
+
+
+def run(threads: int, messages: int, **db_options) -> float:
+    workdir = tempfile.mkdtemp(prefix="bench_write_queue_")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)  # Database кладет файл в текущую директорию
+    try:
+        db = Database("bench.db", **db_options)
+        barrier = threading.Barrier(threads + 1)
+
+        def writer(thread_idx: int):
+            barrier.wait()
+            for i in range(messages):
+                db.save_message(f"user-{thread_idx}", f"сообщение {i}", None, "user")
+
+        workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        stats = db.writer_stats()
+        db.close()
+        total = threads * messages
+        rate = total / elapsed
+        suffix = f", средняя пачка {stats['avg_batch']}" if stats else ""
+        return rate, suffix
+    finally:
+        os.chdir(previous_cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=500, help="сообщений на поток")
+    parser.add_argument("--delay-ms", type=float, default=5, help="WRITE_BATCH_MAX_DELAY_MS")
+    args = parser.parse_args()
+
+    configs = [
+        ("без очереди", {}),
+        (f"group commit, задержка {args.delay_ms} мс",
+         {"write_behind": True, "write_max_delay_ms": args.delay_ms}),
+        ("group commit, без задержки", {"write_behind": True, "write_max_delay_ms": 0}),
+    ]
+    print(f"потоков={args.threads}, сообщений на поток={args.messages}")
+    for name, options in configs:
+        rate, suffix = run(args.threads, args.messages, **options)
+        print(f"  {name:35s} {rate:10,.0f} вставок/с{suffix}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Сквозной нагрузочный тест server.py с локальными заглушками Telegram, OpenRouter и FCM.
+
+Запускает заглушки (benchmarks/stubs.py) и server.py отдельным процессом во временной
+директории, направив в заглушки все внешние вызовы. Затем регистрирует устройства,
+подключает Socket.IO клиентов к чатам и --duration секунд гоняет смешанный трафик:
+/send_message в режиме AI и оператора (доля --human-share пользователей просит
+оператора) и /message_history. В конце печатает запросы в секунду и p50/p95/p99
+по каждому типу запроса.
+
+Результат сравнивается с базовой линией сценария --scenario из --baseline: если
+задержка или пропускная способность хуже больше чем на --max-regression, код
+возврата 1; с --ci также при отсутствии базовой линии сценария. Базовая линия
+сценария default (параметры по умолчанию, огибающая трех прогонов) лежит в
+baselines/loadtest.json; из-за шума p99 CI проверяет с --max-regression 1.5.
+--save-baseline записывает текущий прогон как базовую линию, --merge-baseline
+добавляет его к сохраненной (худшее значение каждой метрики). Запуск:
+
+    python benchmarks/loadtest.py --duration 30 --workers 16 --users 200
+    python benchmarks/loadtest.py --ci --max-regression 1.5
+    python benchmarks/loadtest.py --env WRITE_BEHIND_ENABLED=true --scenario write-behind
+"""
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import baseline
+from stubs import StubServer, AI_REPLY_WORD
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "loadtest.json")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(env: dict, workdir: str, port: int, timeout: float = 60) -> subprocess.Popen:
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py")], cwd=workdir,
+                               env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py завершился с кодом {process.returncode}, см. {log.name}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"server.py не ответил за {timeout:.0f} с, см. {log.name}")
+
+
+class Recorder:
+    """Задержки и ошибки по типам запросов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name: str, seconds: float, ok: bool):
+        with self._lock:
+            self.latencies[name].append(seconds * 1000)
+            if not ok:
+                self.errors[name] += 1
+
+
+def connect_sockets(base_url: str, user_ids, recorder: Recorder, received: list):
+    import socketio
+
+    clients = []
+    for user_id in user_ids:
+        client = socketio.Client(reconnection=False)
+        joined = threading.Event()
+        client.on("joined", lambda data, joined=joined: joined.set())
+        client.on("new_message", lambda data: received.append(1))
+        started = time.perf_counter()
+        try:
+            client.connect(base_url, transports=["polling"], wait_timeout=10)
+            client.emit("join_chat", {"user_id": user_id})
+            ok = joined.wait(10)
+        except Exception:
+            ok = False
+        recorder.add("socketio join_chat", time.perf_counter() - started, ok)
+        clients.append(client)
+    return clients
+
+
+def worker(base_url: str, users, human_users, history_share: float, deadline: float,
+           recorder: Recorder, seed: int):
+    rnd = random.Random(seed)
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        user_id = rnd.choice(users)
+        if rnd.random() < history_share:
+            name = "GET /message_history"
+            started = time.perf_counter()
+            try:
+                ok = session.get(f"{base_url}/message_history/{user_id}", params={"limit": 50},
+                                 timeout=60).status_code == 200
+            except requests.RequestException:
+                ok = False
+        else:
+            human = user_id in human_users
+            name = "POST /send_message (human)" if human else "POST /send_message (ai)"
+            text = "позовите оператора" if human else f"Как изменить бронь {rnd.randrange(10 ** 6)}?"
+            started = time.perf_counter()
+            try:
+                ok = session.post(f"{base_url}/send_message", json={"user_id": user_id, "message": text},
+                                  timeout=60).status_code == 200
+            except requests.RequestException:
+                ok = False
+        recorder.add(name, time.perf_counter() - started, ok)
+
+
+def check_ai_replies(base_url: str, users, expected: str, limit: int = 20) -> tuple:
+    """(ответов AI, искаженных) в истории пользователей: ответ должен совпасть с текстом заглушки"""
+    replies = broken = 0
+    for user_id in users[:limit]:
+        messages = requests.get(f"{base_url}/message_history/{user_id}", params={"limit": 200},
+                                timeout=30).json().get("messages", [])
+        for message in messages:
+            text = message.get("message") or ""
+            if message.get("direction") != "support" or not text.strip():
+                continue
+            if text.strip() == expected.strip():
+                replies += 1
+            elif AI_REPLY_WORD.strip()[:2].encode("utf-8").decode("latin-1") in text:
+                # UTF-8 поток прочитан как ISO-8859-1
+                broken += 1
+    return replies, broken
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    results = {}
+    print(f"\n{'запрос':32s} {'всего':>7s} {'ошибок':>7s} {'в сек':>8s} {'p50 мс':>9s} {'p95 мс':>9s} {'p99 мс':>9s}")
+    total = 0
+    for name in sorted(recorder.latencies):
+        latencies = sorted(recorder.latencies[name])
+        rate = len(latencies) / elapsed
+        p50, p95, p99 = (baseline.percentile(latencies, q) for q in (0.5, 0.95, 0.99))
+        print(f"{name:32s} {len(latencies):7d} {recorder.errors[name]:7d} {rate:8.1f} "
+              f"{p50:9.1f} {p95:9.1f} {p99:9.1f}")
+        key = name.lower().replace("post ", "").replace("get ", "").strip("/").replace(" ", "_") \
+            .replace("/", "_").replace("(", "").replace(")", "")
+        if not name.startswith("socketio"):
+            results[f"{key}_per_sec"] = round(rate, 2)
+            total += len(latencies)
+        results.update({f"{key}_p50_ms": round(p50, 2), f"{key}_p95_ms": round(p95, 2),
+                        f"{key}_p99_ms": round(p99, 2), f"{key}_errors": recorder.errors[name]})
+    results["total_per_sec"] = round(total / elapsed, 2)
+    print(f"\nвсего HTTP: {results['total_per_sec']:.1f} запросов/с")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30, help="секунд нагрузки")
+    parser.add_argument("--workers", type=int, default=16, help="одновременных HTTP клиентов")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--sockets", type=int, default=20, help="пользователей с Socket.IO подключением")
+    parser.add_argument("--human-share", type=float, default=0.1, help="доля пользователей в режиме оператора")
+    parser.add_argument("--history-share", type=float, default=0.4, help="доля запросов /message_history")
+    parser.add_argument("--telegram-latency-ms", type=float, default=50)
+    parser.add_argument("--ai-first-token-ms", type=float, default=300)
+    parser.add_argument("--ai-token-ms", type=float, default=10)
+    parser.add_argument("--ai-tokens", type=int, default=30)
+    parser.add_argument("--fcm-latency-ms", type=float, default=30)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные настройки server.py (можно несколько)")
+    parser.add_argument("--scenario", default="default", help="имя сценария в файле базовой линии")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--merge-baseline", action="store_true", help="добавить прогон к базовой линии")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="допустимое ухудшение (доля)")
+    parser.add_argument("--ci", action="store_true", help="ошибка, если базовой линии нет")
+    args = parser.parse_args()
+
+    stubs = StubServer(telegram_latency_ms=args.telegram_latency_ms, ai_first_token_ms=args.ai_first_token_ms,
+                       ai_token_ms=args.ai_token_ms, ai_tokens=args.ai_tokens,
+                       fcm_latency_ms=args.fcm_latency_ms).start()
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    port = free_port()
+    env = {
+        **stubs.server_env(workdir),
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        # Весь трафик идет с одного IP и от немногих пользователей
+        "RATE_LIMIT_ENABLED": "false",
+        "TRACE_LOG_MIN_MS": "1000000",
+    }
+    env.update(item.split("=", 1) for item in args.env)
+    base_url = f"http://127.0.0.1:{port}"
+
+    print(f"заглушки: {stubs.url}, сервер: {base_url}, директория: {workdir}")
+    server = start_server(env, workdir, port)
+    clients = []
+    try:
+        users = [f"load-{i}" for i in range(args.users)]
+        human_users = set(users[:int(len(users) * args.human_share)])
+        for user_id in users:
+            requests.post(f"{base_url}/register_device",
+                          json={"user_id": user_id, "fcm_token": f"token-{user_id}", "platform": "android"},
+                          timeout=30).raise_for_status()
+
+        recorder = Recorder()
+        received = []
+        clients = connect_sockets(base_url, users[-args.sockets:] if args.sockets else [], recorder, received)
+
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=worker, args=(base_url, users, human_users, args.history_share,
+                                                         deadline, recorder, i))
+                   for i in range(args.workers)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        results = summarize(recorder, elapsed)
+        print(f"событий new_message получено сокетами: {len(received)}")
+        print(f"вызовы заглушек: {dict(sorted(stubs.calls.items()))}")
+        ai_replies, broken_replies = check_ai_replies(base_url, [u for u in users if u not in human_users],
+                                                      AI_REPLY_WORD * args.ai_tokens)
+        print(f"ответов AI проверено: {ai_replies}, искаженных: {broken_replies}")
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        server.terminate()
+        server.wait(10)
+        stubs.stop()
+
+    if broken_replies:
+        print(f"\nОШИБКА: {broken_replies} ответов AI сохранены с неверной кодировкой")
+        sys.exit(1)
+
+    if args.save_baseline or args.merge_baseline:
+        baseline.save(args.baseline, args.scenario, results, merge=args.merge_baseline)
+        print(f"базовая линия '{args.scenario}' сохранена в {args.baseline}")
+        return
+
+    expected = baseline.load(args.baseline).get(args.scenario)
+    if expected is None:
+        print(f"базовой линии '{args.scenario}' нет, сохраните ее с --save-baseline")
+        if args.ci:
+            sys.exit(1)
+        return
+    regressions = baseline.compare(expected, results, args.max_regression)
+    if regressions:
+        print(f"\nРЕГРЕССИЯ относительно базовой линии '{args.scenario}' (порог {args.max_regression:.0%}):")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nрегрессий относительно базовой линии '{args.scenario}' нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Нагрузочная проверка PresenceRegistry из нескольких потоков.
+
+Каждый поток подключает свои сокеты к общим пользователям, случайно выходит из чатов
+и отключается. В конце реестр должен быть пуст, а во время работы прямой и обратный
+индексы — согласованы. Запуск:
+
+    python benchmarks/stress_presence.py --threads 16 --ops 20000
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from realtime_backend import PresenceRegistry
+
+
+def check_consistency(registry: PresenceRegistry):
+    with registry._lock:
+        for user_id, sids in registry._sids_by_user.items():
+            assert sids, f"пустое множество сокетов у {user_id}"
+            for sid in sids:
+                assert user_id in registry._users_by_sid.get(sid, ()), (user_id, sid)
+        for sid, users in registry._users_by_sid.items():
+            assert users, f"пустое множество пользователей у {sid}"
+            for user_id in users:
+                assert sid in registry._sids_by_user.get(user_id, ()), (user_id, sid)
+
+
+def worker(registry: PresenceRegistry, thread_idx: int, ops: int, users: int, barrier):
+    rnd = random.Random(thread_idx)
+    open_sids = []
+    barrier.wait()
+    for op in range(ops):
+        action = rnd.random()
+        if action < 0.5 or not open_sids:
+            sid = f"t{thread_idx}-s{op}"
+            for _ in range(rnd.randint(1, 3)):
+                registry.join(f"user-{rnd.randrange(users)}", sid)
+            open_sids.append(sid)
+        elif action < 0.7:
+            sid = rnd.choice(open_sids)
+            registry.leave(f"user-{rnd.randrange(users)}", sid)
+        else:
+            sid = open_sids.pop(rnd.randrange(len(open_sids)))
+            registry.disconnect(sid)
+    for sid in open_sids:
+        registry.disconnect(sid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=20000, help="операций на поток")
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+
+    registry = PresenceRegistry()
+    barrier = threading.Barrier(args.threads + 1)
+    stop = threading.Event()
+
+    def checker():
+        checks = 0
+        while not stop.is_set():
+            check_consistency(registry)
+            checks += 1
+            time.sleep(0.01)
+        print(f"проверок согласованности во время работы: {checks}")
+
+    threads = [threading.Thread(target=worker, args=(registry, i, args.ops, args.users, barrier))
+               for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    checker_thread = threading.Thread(target=checker)
+    checker_thread.start()
+
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    checker_thread.join()
+
+    check_consistency(registry)
+    assert registry.online_users == 0 and registry.sockets == 0, registry.stats()
+
+    total = args.threads * args.ops
+    print(f"потоков={args.threads} операций={total} время={elapsed:.2f}с "
+          f"({total / elapsed:,.0f} оп/с), реестр пуст: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Локальные заглушки Telegram Bot API, OpenRouter и FCM для нагрузочных тестов.
+
+Один HTTP-сервер в потоке отвечает на все три API по префиксам путей:
+
+    /telegram/bot<token>/<method>              Telegram (sendMessage, sendPhoto, getUpdates, ...)
+    /openrouter/chat/completions               OpenRouter (stream=true — SSE по токенам)
+    /fcm/token, /fcm/v1/projects/<p>/messages:send   OAuth-токен и отправка FCM
+
+Задержки задаются параметрами StubServer. Сервер запускается так:
+
+    stubs = StubServer(ai_first_token_ms=300).start()
+    env = stubs.server_env(workdir)   # переменные окружения для server.py
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Без ключевых слов перевода на оператора (см. HUMAN_SUPPORT_KEYWORDS)
+AI_REPLY_WORD = "ответ "
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StubServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        self._route(urlparse(self.path), b"")
+
+    def do_POST(self):
+        self._route(urlparse(self.path), self._read_body())
+
+    def _route(self, url, body: bytes):
+        stub = self.server.stub
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "telegram" and len(parts) == 3:
+            stub.count(f"telegram.{parts[2]}")
+            self._telegram(parts[2], parse_qs(url.query))
+        elif url.path == "/openrouter/chat/completions":
+            self._openrouter(json.loads(body or b"{}"))
+        elif url.path == "/fcm/token":
+            stub.count("fcm.token")
+            self._json({"access_token": "stub", "expires_in": 3600, "token_type": "Bearer"})
+        elif parts[0] == "fcm" and url.path.endswith("messages:send"):
+            stub.count("fcm.send")
+            time.sleep(stub.fcm_latency_ms / 1000.0)
+            self._json({"name": f"projects/loadtest/messages/{stub.next_id()}"})
+        else:
+            self._json({"error": f"unknown path {url.path}"}, 404)
+
+    def _telegram(self, method: str, query):
+        stub = self.server.stub
+        if method == "getUpdates":
+            timeout = float(query.get("timeout", ["0"])[0])
+            time.sleep(min(timeout, stub.poll_wait_seconds))
+            self._json({"ok": True, "result": []})
+            return
+        time.sleep(stub.telegram_latency_ms / 1000.0)
+        if method == "sendMediaGroup":
+            self._json({"ok": True, "result": [{"message_id": stub.next_id()}]})
+        elif method in ("sendMessage", "sendPhoto"):
+            self._json({"ok": True, "result": {"message_id": stub.next_id()}})
+        else:
+            self._json({"ok": True, "result": True})
+
+    def _openrouter(self, request):
+        stub = self.server.stub
+        if not request.get("stream"):
+            # Классификатор перевода на оператора
+            stub.count("openrouter.classify")
+            time.sleep(stub.classifier_latency_ms / 1000.0)
+            self._json({"choices": [{"message": {"content": "AI"}}]})
+            return
+
+        stub.count("openrouter.stream")
+        self.send_response(200)
+        # Как у OpenRouter: без charset, а текст — кириллица в UTF-8
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(stub.ai_first_token_ms / 1000.0)
+        try:
+            for i in range(stub.ai_tokens):
+                if i:
+                    time.sleep(stub.ai_token_ms / 1000.0)
+                chunk = {"choices": [{"delta": {"content": AI_REPLY_WORD}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Попытку отменил хеджирующий клиент
+            stub.count("openrouter.cancelled")
+
+
+class StubServer:
+    """Заглушки всех внешних API на одном порту"""
+
+    def __init__(self, telegram_latency_ms: float = 50, ai_first_token_ms: float = 300,
+                 ai_token_ms: float = 10, ai_tokens: int = 30, classifier_latency_ms: float = 100,
+                 fcm_latency_ms: float = 30, poll_wait_seconds: float = 1,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.telegram_latency_ms = telegram_latency_ms
+        self.ai_first_token_ms = ai_first_token_ms
+        self.ai_token_ms = ai_token_ms
+        self.ai_tokens = ai_tokens
+        self.classifier_latency_ms = classifier_latency_ms
+        self.fcm_latency_ms = fcm_latency_ms
+        self.poll_wait_seconds = poll_wait_seconds  # ответ getUpdates без обновлений
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._lock = threading.Lock()
+        self._ids = 0
+        self.calls = Counter()
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self._httpd.serve_forever, daemon=True, name="stubs").start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def next_id(self) -> int:
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def count(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+
+    def write_service_account(self, path: str):
+        """Фиктивный service account Firebase: токен выдает /fcm/token этой заглушки"""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "type": "service_account",
+                "project_id": "loadtest",
+                "private_key_id": "stub",
+                "private_key": pem,
+                "client_email": "loadtest@loadtest.iam.gserviceaccount.com",
+                "client_id": "1",
+                "token_uri": f"{self.url}/fcm/token",
+            }, f)
+
+    def server_env(self, workdir: str) -> dict:
+        """Переменные окружения server.py, направляющие все внешние вызовы в заглушки"""
+        service_account = os.path.join(workdir, "firebase-service-account.json")
+        self.write_service_account(service_account)
+        return {
+            "BOT_TOKEN": "loadtest",
+            "GROUP_CHAT_ID": "-1000000000000",
+            "TELEGRAM_API_BASE": f"{self.url}/telegram",
+            "TELEGRAM_POLL_TIMEOUT_SECONDS": "1",
+            "OPENROUTER_API_KEY": "stub",
+            "OPENROUTER_BASE_URL": f"{self.url}/openrouter",
+            "FCM_SERVICE_ACCOUNT_PATH": service_account,
+            "FCM_API_BASE": f"{self.url}/fcm",
+        }
@@ -1,9 +1,11 @@
 import requests
+import json
 import logging
 from typing import Optional, Dict, List
 from config import TELEGRAM_API_URL, GROUP_CHAT_ID
+from metrics import timed, failed_result
+from logging_setup import SAMPLED
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -12,8 +14,21 @@ class TelegramBot:
         self.api_url = TELEGRAM_API_URL
         self.group_chat_id = GROUP_CHAT_ID
         
+    @staticmethod
+    def _suggestion_keyboard(suggestions: List[Dict], label_length: int = 60) -> Dict:
+        """Inline-кнопки с подсказками ответа: по одной в строке, в callback_data только id"""
+        keyboard = []
+        for suggestion in suggestions:
+            text = " ".join(suggestion["text"].split())
+            if len(text) > label_length:
+                text = text[:label_length - 1] + "…"
+            keyboard.append([{"text": f"💡 {text}", "callback_data": f"suggest:{suggestion['message_id']}"}])
+        return {"inline_keyboard": keyboard}
+    
+    @timed("telegram", failed=failed_result)
     def send_message_to_group(self, user_id: str, user_name: str, message_text: str, 
-                              photo_path: Optional[str] = None) -> Optional[Dict]:
+                              photo_path: Optional[str] = None,
+                              suggestions: Optional[List[Dict]] = None) -> Optional[Dict]:
         if not self.group_chat_id:
             logger.error("GROUP_CHAT_ID не установлен в конфигурации")
             return None
@@ -25,6 +40,8 @@ class TelegramBot:
             formatted_message += f"📝 <b>Имя:</b> {user_name}\n"
         formatted_message += f"\n💬 <b>Сообщение:</b>\n{message_text}"
         
+        reply_markup = self._suggestion_keyboard(suggestions) if suggestions else None
+        
         try:
             if photo_path:
                 # Отправляем фото с подписью
@@ -35,6 +52,8 @@ class TelegramBot:
                         'caption': formatted_message,
                         'parse_mode': 'HTML'
                     }
+                    if reply_markup:
+                        data['reply_markup'] = json.dumps(reply_markup)
                     response = requests.post(
                         f"{self.api_url}/sendPhoto",
                         files=files,
@@ -43,13 +62,16 @@ class TelegramBot:
                     )
             else:
                 # Отправляем только текст
+                payload = {
+                    "chat_id": self.group_chat_id,
+                    "text": formatted_message,
+                    "parse_mode": "HTML"
+                }
+                if reply_markup:
+                    payload["reply_markup"] = reply_markup
                 response = requests.post(
                     f"{self.api_url}/sendMessage",
-                    json={
-                        "chat_id": self.group_chat_id,
-                        "text": formatted_message,
-                        "parse_mode": "HTML"
-                    },
+                    json=payload,
                     timeout=10
                 )
             
@@ -58,7 +80,7 @@ class TelegramBot:
             
             if result.get("ok"):
                 message_id = result["result"]["message_id"]
-                logger.info(f"Сообщение отправлено в группу. Message ID: {message_id}")
+                logger.info("Сообщение отправлено в группу. Message ID: %s", message_id, extra=SAMPLED)
                 return {
                     "message_id": message_id,
                     "user_id": user_id,
@@ -75,6 +97,7 @@ class TelegramBot:
             logger.error(f"Файл фотографии не найден: {photo_path}")
             return None
     
+    @timed("telegram", failed=failed_result)
     def send_media_group_to_group(self, user_id: str, user_name: str, message_text: str,
                                   photo_paths: List[str]) -> Optional[Dict]:
         """
@@ -128,8 +151,6 @@ class TelegramBot:
                 media.append(media_item)
             
             # Отправляем медиагруппу
-            import json
-            
             # Конвертируем media в JSON строку
             media_json = json.dumps(media)
             
@@ -157,7 +178,8 @@ class TelegramBot:
                 messages = result.get("result", [])
                 if messages:
                     message_id = messages[0].get("message_id")
-                    logger.info(f"Медиагруппа отправлена в группу. Message ID: {message_id}, фото: {len(photo_paths)}")
+                    logger.info("Медиагруппа отправлена в группу. Message ID: %s, фото: %d", message_id, len(photo_paths),
+                                extra=SAMPLED)
                     return {
                         "message_id": message_id,
                         "user_id": user_id,
@@ -182,6 +204,7 @@ class TelegramBot:
             logger.error(traceback.format_exc())
             return None
     
+    @timed("telegram", failed=failed_result)
     def send_reply_to_user(self, user_id: str, reply_text: str) -> bool:
         """
         Отправляет ответ пользователю.
@@ -206,7 +229,7 @@ class TelegramBot:
             result = response.json()
             
             if result.get("ok"):
-                logger.info(f"Ответ отправлен пользователю {user_id}")
+                logger.info("Ответ отправлен пользователю %s", user_id, extra=SAMPLED)
                 return True
             else:
                 logger.error(f"Ошибка отправки ответа: {result}")
@@ -216,25 +239,92 @@ class TelegramBot:
             logger.error(f"Ошибка при отправке ответа пользователю: {e}")
             return False
     
-    def get_updates(self, offset: Optional[int] = None) -> Optional[Dict]:
+    @timed("telegram", failed=failed_result)
+    def send_group_reply(self, reply_to_message_id: int, text: str) -> Optional[int]:
+        """
+        Отправляет в группу ответ на сообщение пользователя (выбранную подсказку).
+        
+        Returns:
+            message_id отправленного сообщения или None в случае ошибки
+        """
+        try:
+            response = requests.post(
+                f"{self.api_url}/sendMessage",
+                json={
+                    "chat_id": self.group_chat_id,
+                    "text": text,
+                    "reply_to_message_id": reply_to_message_id
+                },
+                timeout=10
+            )
+            response.raise_for_status()
+            result = response.json()
+            
+            if result.get("ok"):
+                return result["result"]["message_id"]
+            logger.error(f"Ошибка отправки ответа в группу: {result}")
+            return None
+            
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка при отправке ответа в группу: {e}")
+            return None
+    
+    @timed("telegram", failed=failed_result)
+    def clear_reply_markup(self, message_id: int) -> bool:
+        """Убирает inline-кнопки с сообщения в группе"""
+        try:
+            response = requests.post(
+                f"{self.api_url}/editMessageReplyMarkup",
+                json={
+                    "chat_id": self.group_chat_id,
+                    "message_id": message_id,
+                    "reply_markup": {"inline_keyboard": []}
+                },
+                timeout=10
+            )
+            return response.ok
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка при удалении кнопок сообщения {message_id}: {e}")
+            return False
+    
+    @timed("telegram", failed=failed_result)
+    def answer_callback_query(self, callback_query_id: str, text: Optional[str] = None) -> bool:
+        """Подтверждает нажатие inline-кнопки (иначе у оператора крутится индикатор загрузки)"""
+        try:
+            payload = {"callback_query_id": callback_query_id}
+            if text:
+                payload["text"] = text
+            response = requests.post(
+                f"{self.api_url}/answerCallbackQuery",
+                json=payload,
+                timeout=10
+            )
+            return response.ok
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Ошибка при ответе на нажатие кнопки: {e}")
+            return False
+    
+    @timed("telegram", failed=failed_result)
+    def get_updates(self, offset: Optional[int] = None, timeout: int = 30) -> Optional[Dict]:
         """
         Получает обновления от Telegram (для обработки reply в группе).
         
         Args:
             offset: ID последнего обработанного обновления
+            timeout: Время long polling в секундах
             
         Returns:
             Dict с обновлениями или None в случае ошибки
         """
         try:
-            params = {"timeout": 30}
+            params = {"timeout": timeout}
             if offset:
                 params["offset"] = offset + 1
                 
             response = requests.get(
                 f"{self.api_url}/getUpdates",
                 params=params,
-                timeout=35
+                timeout=timeout + 5
             )
             response.raise_for_status()
             result = response.json()
@@ -0,0 +1,199 @@
+"""
+Кэши в памяти процесса для горячих чтений из SQLite.
+
+RecentMessageCache — кольцевой буфер последних сообщений каждого пользователя
+с общим лимитом на число сообщений и LRU-вытеснением пользователей. Заполняется
+при чтении истории и дополняется при сохранении сообщений (write-through).
+
+TTLCache — LRU-кэш с временем жизни записей для редко меняющихся значений
+(режим поддержки, токены устройств). Сбрасывается явно при записи.
+"""
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _UserBuffer:
+    __slots__ = ("messages", "ids", "complete")
+
+    def __init__(self, messages: List[Dict], complete: bool):
+        self.messages = messages
+        self.ids = [message["id"] for message in messages]
+        # True, если в буфере вся история пользователя (сообщений меньше емкости)
+        self.complete = complete
+
+
+class RecentMessageCache:
+    """Последние per_user сообщений пользователей, всего не более max_messages"""
+
+    # Счетчики записей по полосам: защищают от заполнения буфера устаревшим чтением
+    _STRIPES = 1024
+
+    def __init__(self, per_user: int = 100, max_messages: int = 200000):
+        self.per_user = per_user
+        self.max_messages = max_messages
+
+        self._lock = threading.Lock()
+        self._buffers: "OrderedDict[str, _UserBuffer]" = OrderedDict()
+        self._total = 0
+        self._write_versions = [0] * self._STRIPES
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _stripe(self, user_id: str) -> int:
+        return hash(user_id) % self._STRIPES
+
+    def get_recent(self, user_id: str, limit: int) -> Optional[List[Dict]]:
+        """Последние limit сообщений (от старых к новым) или None, если кэш не может ответить"""
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if buffer is None or (len(buffer.messages) < limit and not buffer.complete):
+                self.misses += 1
+                return None
+            self._buffers.move_to_end(user_id)
+            self.hits += 1
+            return buffer.messages[-limit:] if limit > 0 else []
+
+    def load_token(self, user_id: str) -> int:
+        """Версия записей пользователя до чтения из БД (передается в fill)"""
+        return self._write_versions[self._stripe(user_id)]
+
+    def fill(self, user_id: str, messages: List[Dict], complete: bool, token: int):
+        """Заполняет буфер результатом чтения из БД, если с начала чтения не было записей"""
+        messages = messages[-self.per_user:]
+        with self._lock:
+            if self._write_versions[self._stripe(user_id)] != token:
+                return
+            old = self._buffers.pop(user_id, None)
+            if old is not None:
+                self._total -= len(old.messages)
+            self._buffers[user_id] = _UserBuffer(list(messages), complete)
+            self._total += len(messages)
+            self._evict()
+
+    def append(self, user_id: str, message: Dict):
+        """Добавляет сохраненное сообщение в буфер пользователя, если он загружен"""
+        with self._lock:
+            self._write_versions[self._stripe(user_id)] += 1
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                return
+
+            # Параллельные сохранения могут прийти не по порядку id
+            position = bisect.bisect_right(buffer.ids, message["id"])
+            buffer.ids.insert(position, message["id"])
+            buffer.messages.insert(position, message)
+            self._total += 1
+
+            if len(buffer.messages) > self.per_user:
+                del buffer.ids[0]
+                del buffer.messages[0]
+                buffer.complete = False
+                self._total -= 1
+
+            self._buffers.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._write_versions[self._stripe(user_id)] += 1
+            buffer = self._buffers.pop(user_id, None)
+            if buffer is not None:
+                self._total -= len(buffer.messages)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._write_versions = [version + 1 for version in self._write_versions]
+            self._buffers.clear()
+            self._total = 0
+
+    def _evict(self):
+        while self._total > self.max_messages and self._buffers:
+            _, buffer = self._buffers.popitem(last=False)
+            self._total -= len(buffer.messages)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._buffers),
+            "messages": self._total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class TTLCache:
+    """LRU-кэш не более maxsize записей, каждая живет ttl_seconds"""
+
+    def __init__(self, maxsize: int = 10000, ttl_seconds: float = 30):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        # Растет при каждой инвалидации: чтение, начатое до нее, не попадет в кэш
+        self._version = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Возвращает (найдено, значение)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def load_token(self) -> int:
+        """Версия кэша до чтения из БД (передается в set)"""
+        return self._version
+
+    def set(self, key: str, value: Any, token: Optional[int] = None):
+        with self._lock:
+            if token is not None and token != self._version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._version += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -8,8 +8,11 @@ GROUP_CHAT_ID = os.getenv('GROUP_CHAT_ID', '')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))
 SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', '')
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# Base URLs are overridable for load tests against local stubs (benchmarks/loadtest.py)
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}"
 FCM_SERVICE_ACCOUNT_PATH = os.getenv('FCM_SERVICE_ACCOUNT_PATH', 'firebase-service-account.json')
+FCM_API_BASE = os.getenv('FCM_API_BASE', '')  # empty = https://fcm.googleapis.com
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 MAX_FILE_SIZE = 10 * 1024 * 1024
@@ -17,8 +20,121 @@ MAX_FILE_SIZE = 10 * 1024 * 1024
 # OpenRouter AI Configuration
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', '')
 OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', 'openai/gpt-3.5-turbo')
-OPENROUTER_BASE_URL = 'https://openrouter.ai/api/v1'
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
+OPENROUTER_TIMEOUT_SECONDS = float(os.getenv('OPENROUTER_TIMEOUT_SECONDS', '30'))
+# Ordered model chain (comma-separated); defaults to OPENROUTER_MODEL alone
+OPENROUTER_MODELS = [model.strip() for model in os.getenv('OPENROUTER_MODELS', OPENROUTER_MODEL).split(',')
+                     if model.strip()] or [OPENROUTER_MODEL]
+# Ask the next model when no first token arrived within this budget
+AI_HEDGE_AFTER_MS = float(os.getenv('AI_HEDGE_AFTER_MS', '2500'))
+
+# Handoff classifier: a small model asked in parallel with the answer whether an operator is needed
+HANDOFF_CLASSIFIER_ENABLED = os.getenv('HANDOFF_CLASSIFIER_ENABLED', 'false').lower() == 'true'
+HANDOFF_CLASSIFIER_MODEL = os.getenv('HANDOFF_CLASSIFIER_MODEL', OPENROUTER_MODEL)
+HANDOFF_CLASSIFIER_TIMEOUT_SECONDS = float(os.getenv('HANDOFF_CLASSIFIER_TIMEOUT_SECONDS', '5'))
+
+# OpenRouter circuit breaker (opens on consecutive failures or slow p95) and concurrency cap
+AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('AI_BREAKER_FAILURE_THRESHOLD', '5'))
+AI_BREAKER_LATENCY_P95_SECONDS = float(os.getenv('AI_BREAKER_LATENCY_P95_SECONDS', '15'))
+AI_BREAKER_OPEN_SECONDS = float(os.getenv('AI_BREAKER_OPEN_SECONDS', '30'))
+AI_MAX_CONCURRENT_REQUESTS = int(os.getenv('AI_MAX_CONCURRENT_REQUESTS', '8'))
+AI_BULKHEAD_WAIT_SECONDS = float(os.getenv('AI_BULKHEAD_WAIT_SECONDS', '0'))  # 0 = reject at once when full
 
 # Support mode settings
 HUMAN_SUPPORT_TIMEOUT_MINUTES = 5  # Time of inactivity before switching back to AI
+SUPPORT_MODE_SWEEP_INTERVAL_SECONDS = float(os.getenv('SUPPORT_MODE_SWEEP_INTERVAL_SECONDS', '30'))
+
+
+# Realtime backend (presence and cross-process Socket.IO events)
+REALTIME_BACKEND = os.getenv('REALTIME_BACKEND', 'memory')  # 'memory' or 'redis'
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_CHANNEL_PREFIX = os.getenv('REDIS_CHANNEL_PREFIX', 'smile')
+# A worker's presence entries expire this long after its last heartbeat (crashed workers drop out)
+PRESENCE_TTL_SECONDS = float(os.getenv('PRESENCE_TTL_SECONDS', '30'))
+
+# Telegram poller leader election (only one replica polls getUpdates)
+LEADER_LEASE_TTL_SECONDS = float(os.getenv('LEADER_LEASE_TTL_SECONDS', '10'))
+LEADER_HEARTBEAT_SECONDS = float(os.getenv('LEADER_HEARTBEAT_SECONDS', '3'))
+TELEGRAM_POLL_TIMEOUT_SECONDS = int(os.getenv('TELEGRAM_POLL_TIMEOUT_SECONDS', '5'))
+
+# Max number of missed messages replayed on join_chat (older ones need /message_history)
+REPLAY_LIMIT = int(os.getenv('REPLAY_LIMIT', '100'))
+
+# In-memory cache of recent messages per user (history first page and AI context)
+MESSAGE_CACHE_ENABLED = os.getenv('MESSAGE_CACHE_ENABLED', 'true').lower() == 'true'
+MESSAGE_CACHE_PER_USER = int(os.getenv('MESSAGE_CACHE_PER_USER', '100'))
+MESSAGE_CACHE_MAX_MESSAGES = int(os.getenv('MESSAGE_CACHE_MAX_MESSAGES', '200000'))
+
+# Read-through cache for support mode and device tokens
+DB_CACHE_ENABLED = os.getenv('DB_CACHE_ENABLED', 'true').lower() == 'true'
+DB_CACHE_TTL_SECONDS = float(os.getenv('DB_CACHE_TTL_SECONDS', '30'))
+DB_CACHE_MAXSIZE = int(os.getenv('DB_CACHE_MAXSIZE', '10000'))
+
+# Days of greetings_sent rows to keep (only today's are needed to avoid repeats)
+GREETINGS_RETENTION_DAYS = int(os.getenv('GREETINGS_RETENTION_DAYS', '2'))
+
+# Number of SQLite files for per-user tables (0 = single file); change it with shard_tool.py migrate
+DB_SHARDS = int(os.getenv('DB_SHARDS', '0'))
+
+# Group-committed write-behind queue for message, mapping and greeting inserts
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '256'))
+WRITE_BATCH_MAX_DELAY_MS = float(os.getenv('WRITE_BATCH_MAX_DELAY_MS', '5'))
+# A request waiting for its queued write gives up after this many seconds
+WRITE_TIMEOUT_SECONDS = float(os.getenv('WRITE_TIMEOUT_SECONDS', '10'))
+
+# Retention: monthly message archives, mapping cleanup and compaction in quiet periods
+RETENTION_ENABLED = os.getenv('RETENTION_ENABLED', 'false').lower() == 'true'
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', 'archive')  # relative to the database file
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', '180'))
+MESSAGE_MAPPING_RETENTION_DAYS = int(os.getenv('MESSAGE_MAPPING_RETENTION_DAYS', '30'))
+RETENTION_INTERVAL_SECONDS = float(os.getenv('RETENTION_INTERVAL_SECONDS', '3600'))
+RETENTION_QUIET_SECONDS = float(os.getenv('RETENTION_QUIET_SECONDS', '300'))
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', '1000'))
+
+# Local FAQ tier: answers close matches from the FAQ file and repeated operator replies without OpenRouter
+FAQ_ENABLED = os.getenv('FAQ_ENABLED', 'false').lower() == 'true'
+FAQ_PATH = os.getenv('FAQ_PATH', 'faq.json')
+FAQ_CONFIDENCE_THRESHOLD = float(os.getenv('FAQ_CONFIDENCE_THRESHOLD', '0.75'))
+FAQ_MIN_OPERATOR_USERS = int(os.getenv('FAQ_MIN_OPERATOR_USERS', '3'))  # distinct users an operator reply was sent to
+FAQ_HISTORY_LIMIT = int(os.getenv('FAQ_HISTORY_LIMIT', '50000'))  # past operator replies indexed at startup
+FAQ_MAX_CANDIDATES = int(os.getenv('FAQ_MAX_CANDIDATES', '10000'))  # operator replies tracked until they become templates
+
+# Reply suggestions: top past operator replies to similar questions as buttons under forwarded messages
+SUGGESTIONS_ENABLED = os.getenv('SUGGESTIONS_ENABLED', 'false').lower() == 'true'
+SUGGESTIONS_COUNT = int(os.getenv('SUGGESTIONS_COUNT', '3'))
+SUGGESTIONS_MIN_CONFIDENCE = float(os.getenv('SUGGESTIONS_MIN_CONFIDENCE', '0.3'))
+
+# Idempotency-Key for /send_message and /register_device: stored responses and waiting for in-flight duplicates
+IDEMPOTENCY_TTL_HOURS = float(os.getenv('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '60'))  # a retry waits this long for the first request
+IDEMPOTENCY_IN_FLIGHT_TIMEOUT_SECONDS = float(os.getenv('IDEMPOTENCY_IN_FLIGHT_TIMEOUT_SECONDS', '120'))  # then the key is taken over
+
+# Admission control on /send_message: token buckets per user_id and per IP, global concurrency cap
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # 'memory' (per process) or 'redis' (shared, REDIS_URL)
+RATE_LIMIT_USER_PER_SECOND = float(os.getenv('RATE_LIMIT_USER_PER_SECOND', '1'))
+RATE_LIMIT_USER_BURST = float(os.getenv('RATE_LIMIT_USER_BURST', '10'))
+# Off by default: behind a proxy or carrier NAT many users share one address; set it together
+# with RATE_LIMIT_TRUST_X_FORWARDED_FOR when the proxy passes the client IP
+RATE_LIMIT_IP_PER_SECOND = float(os.getenv('RATE_LIMIT_IP_PER_SECOND', '0'))
+RATE_LIMIT_IP_BURST = float(os.getenv('RATE_LIMIT_IP_BURST', '30'))
+RATE_LIMIT_TRUST_X_FORWARDED_FOR = os.getenv('RATE_LIMIT_TRUST_X_FORWARDED_FOR', 'false').lower() == 'true'  # behind a proxy
+SEND_MESSAGE_MAX_CONCURRENT = int(os.getenv('SEND_MESSAGE_MAX_CONCURRENT', '64'))
+
+# Prometheus metrics on /metrics: dependency latency histograms, counters and gauges
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Per-request timing: Server-Timing header and one JSON log line per request slower than TRACE_LOG_MIN_MS
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() == 'true'
+TRACE_LOG_MIN_MS = float(os.getenv('TRACE_LOG_MIN_MS', '200'))
+# On-demand profiling of sampled requests (switched on via POST /admin/profiling)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5'))
 
+# Logging: records are formatted and written by a background thread (logging_setup.py)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json' (one JSON object per line)
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # per-logger levels, e.g. "database=WARNING,werkzeug=WARNING"
+LOG_SAMPLE_PER_SECOND = int(os.getenv('LOG_SAMPLE_PER_SECOND', '10'))  # per message template for frequent success logs; 0 = log all
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # records beyond this are dropped instead of blocking requests
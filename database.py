@@ -1,15 +1,47 @@
 import sqlite3
+import html
 import logging
 import os
+import re
+import zlib
 from typing import List, Dict, Optional
-from datetime import datetime
+from cache import RecentMessageCache, TTLCache
+from write_queue import GroupCommitWriter
+from retention import MessageArchive
+from metrics import timed, mark_failed
+from logging_setup import SAMPLED
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Message ids in sharded mode are multiples of the stride plus the shard index
+SHARD_ID_STRIDE = 1024
+
+# Search terms taken from an operator query (the rest of the query syntax is ignored)
+SEARCH_MAX_TERMS = 10
+# BM25 ranks only the newest matches: scoring every match of a common word is O(matches)
+SEARCH_RANK_WINDOW = 2000
+
+
+def shard_index(user_id: str, shards: int) -> int:
+    """Stable shard number of a user (the same in every process and replica)"""
+    return zlib.crc32(user_id.encode("utf-8")) % shards
+
 
 class Database:
-    def __init__(self, db_path: str = "support_bot.db"):
+    def __init__(self, db_path: str = "support_bot.db",
+                 message_cache: Optional[RecentMessageCache] = None,
+                 cache_enabled: bool = False, cache_ttl_seconds: float = 30,
+                 cache_maxsize: int = 10000, write_behind: bool = False,
+                 write_batch_size: int = 256, write_max_delay_ms: float = 5,
+                 write_timeout_seconds: float = 10, archive_dir: Optional[str] = None, shards: int = 0):
+        # Кэш последних сообщений (write-through), None - читать всегда из БД
+        self.message_cache = message_cache
+        # Read-through кэш режима поддержки и токенов устройств (выключается для тестов)
+        self.cache_enabled = cache_enabled
+        self.support_mode_cache = TTLCache(cache_maxsize, cache_ttl_seconds)
+        self.device_tokens_cache = TTLCache(cache_maxsize, cache_ttl_seconds)
+        self._invalidation_bus = None
+        
         # Проверяем, существует ли директория data
         if os.path.exists("data") and os.path.isdir("data"):
             # Используем директорию data для базы данных
@@ -36,13 +68,88 @@ class Database:
         except Exception as e:
             logger.warning(f"Не удалось установить права на директорию {db_dir}: {e}")
         
+        # Sharded mode: per-user tables live in `shards` files picked by shard_index(user_id);
+        # the main file keeps global tables (message_mapping, telegram_offset, leader_lease)
+        if shards > SHARD_ID_STRIDE:
+            raise ValueError(f"shards must be at most {SHARD_ID_STRIDE}")
+        self.shards = shards if shards > 1 else 0
+        stem, ext = os.path.splitext(self.db_path)
+        self.shard_paths = [f"{stem}.shard{i:02d}{ext}" for i in range(self.shards)]
+        
         logger.info(f"Используется база данных: {self.db_path}")
+        if self.shards:
+            logger.info(f"Данные пользователей разделены на {self.shards} файлов: {stem}.shardNN{ext}")
         self.init_database()
+        
+        # One idle connection per file: closing the last connection checkpoints and deletes
+        # the WAL, which would otherwise happen after almost every call
+        self._wal_keepers = [sqlite3.connect(path, check_same_thread=False) for path in self.all_paths()]
+        
+        # Месячные архивы старых сообщений (каталог относительно базы), None - без архива
+        self.archive = None
+        if archive_dir:
+            self.archive = MessageArchive(os.path.join(os.path.dirname(self.db_path), archive_dir))
+        
+        # Групповая фиксация вставок сообщений, связей и приветствий (опционально),
+        # по одному потоку-писателю на файл
+        self._writers = {}
+        if write_behind:
+            self._writers = {path: GroupCommitWriter(path, write_batch_size, write_max_delay_ms,
+                                                     write_timeout_seconds)
+                             for path in self.all_paths()}
+    
+    def shard_for(self, user_id: str) -> Optional[int]:
+        """Shard number of the user, None when sharding is off"""
+        return shard_index(user_id, self.shards) if self.shards else None
+    
+    def path_for_user(self, user_id: str) -> str:
+        if not self.shards:
+            return self.db_path
+        return self.shard_paths[shard_index(user_id, self.shards)]
+    
+    def user_paths(self) -> List[str]:
+        """Files holding per-user tables"""
+        return self.shard_paths or [self.db_path]
+    
+    def all_paths(self) -> List[str]:
+        return [self.db_path] + self.shard_paths
+    
+    def close(self):
+        """Commit queued writes, stop the writer threads and release the files"""
+        for writer in self._writers.values():
+            writer.stop()
+        self._writers = {}
+        for conn in self._wal_keepers:
+            conn.close()
+        self._wal_keepers = []
+    
+    def _writer_for(self, user_id: Optional[str] = None) -> Optional[GroupCommitWriter]:
+        if not self._writers:
+            return None
+        return self._writers[self.path_for_user(user_id) if user_id is not None else self.db_path]
+    
+    def _wait_for_writes(self, key: str, user_id: Optional[str] = None):
+        # Read-your-writes: reads for a key see its queued writes
+        writer = self._writer_for(user_id)
+        if writer is not None:
+            writer.wait_for(key)
+    
+    def _submit_write(self, writer: GroupCommitWriter, func, keys, description: str):
+        """Queue a write without waiting for the commit; failures are logged"""
+        def log_failure(future):
+            if future.exception() is not None:
+                logger.error(f"Ошибка при {description}: {future.exception()}")
+        
+        writer.submit(func, keys).add_done_callback(log_failure)
     
-    def get_connection(self):
+    def get_connection(self, user_id: Optional[str] = None):
+        """Connection to the user's shard, or to the main file when user_id is None"""
+        return self._connect(self.path_for_user(user_id) if user_id is not None else self.db_path)
+    
+    def _connect(self, db_path: str):
         try:
             # Проверяем, что директория существует и доступна для записи
-            db_dir = os.path.dirname(self.db_path)
+            db_dir = os.path.dirname(db_path)
             if db_dir and not os.path.exists(db_dir):
                 os.makedirs(db_dir, mode=0o777, exist_ok=True)
             
@@ -61,20 +168,84 @@ class Database:
                     except:
                         pass
             
-            conn = sqlite3.connect(self.db_path)
+            conn = sqlite3.connect(db_path)
             conn.row_factory = sqlite3.Row
             return conn
         except sqlite3.OperationalError as e:
-            logger.error(f"Ошибка подключения к базе данных {self.db_path}: {e}")
+            logger.error(f"Ошибка подключения к базе данных {db_path}: {e}")
             logger.error(f"Текущая рабочая директория: {os.getcwd()}")
             logger.error(f"Права на директорию: {oct(os.stat(db_dir).st_mode) if db_dir and os.path.exists(db_dir) else 'N/A'}")
             raise
     
+    def attach_invalidation_bus(self, bus):
+        """Share cache invalidations with other workers through a realtime backend"""
+        self._invalidation_bus = bus
+        bus.subscribe("cache_invalidation", self._on_remote_invalidation)
+    
+    def _publish_invalidation(self, cache_name: str, key: str):
+        if self._invalidation_bus is None:
+            return
+        try:
+            self._invalidation_bus.publish("cache_invalidation", {"cache": cache_name, "key": key})
+        except Exception as e:
+            logger.error(f"Ошибка при рассылке инвалидации кэша {cache_name}: {e}")
+    
+    def _on_remote_invalidation(self, payload: Dict):
+        cache_name = payload.get("cache")
+        if cache_name == "messages" and self.message_cache is not None:
+            self.message_cache.invalidate(payload["key"])
+        elif cache_name == "support_mode":
+            self.support_mode_cache.invalidate(payload["key"])
+        elif cache_name == "device_tokens":
+            self.device_tokens_cache.invalidate(payload["key"])
+    
+    def writer_stats(self) -> Dict:
+        if not self._writers:
+            return {}
+        stats = [writer.stats() for writer in self._writers.values()]
+        total = {key: sum(item[key] for item in stats)
+                 for key in ("queue_depth", "batches", "operations", "failed_operations")}
+        total["avg_batch"] = round(total["operations"] / total["batches"], 2) if total["batches"] else 0.0
+        return total
+    
+    def cache_stats(self) -> Dict:
+        stats = {}
+        if self.message_cache is not None:
+            stats["messages"] = self.message_cache.stats()
+        if self.cache_enabled:
+            stats["support_mode"] = self.support_mode_cache.stats()
+            stats["device_tokens"] = self.device_tokens_cache.stats()
+        return stats
+    
     def init_database(self):
+        # Cleared by _init_schema when SQLite is built without FTS5
+        self.search_enabled = True
+        
+        # In sharded mode every file gets the full schema; unused tables stay empty
+        for path in self.all_paths():
+            self._init_schema(path)
+        
+        if self.shards and self._count_rows(self.db_path, "messages"):
+            logger.warning("В основном файле остались сообщения: перенесите их по шардам "
+                           "командой python shard_tool.py migrate")
+    
+    def _count_rows(self, db_path: str, table: str) -> int:
+        conn = self._connect(db_path)
         try:
-            conn = self.get_connection()
+            return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+    
+    def _init_schema(self, db_path: str):
+        try:
+            conn = self._connect(db_path)
             cursor = conn.cursor()
             
+            # Takes effect only for a new file; existing ones are converted by retention
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # Readers do not block the writer; checkpoints run in quiet periods
+            cursor.execute("PRAGMA journal_mode = WAL")
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -120,6 +291,12 @@ class Database:
                 )
             ''')
             
+            # Per-user range reads by id (history, replay after reconnect)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_user_id_id
+                ON messages (user_id, id)
+            ''')
+            
             # Table for tracking user support mode (AI or human)
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_support_mode (
@@ -131,68 +308,483 @@ class Database:
                 )
             ''')
             
+            # Sweeper lookup of idle human sessions
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_user_support_mode_mode_last_message
+                ON user_support_mode (mode, last_user_message_at)
+            ''')
+            
+            # Offset of the last processed Telegram update, shared by all replicas
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_offset (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    last_update_id INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Telegram updates seen by the poller: at-most-once handling across replicas,
+            # failed updates stay as dead letters (status 'failed' with the payload)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'processing',
+                    error TEXT,
+                    payload TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Suggested replies offered under each forwarded group message: a pressed
+            # button is honoured only if its message id was offered there
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS suggestion_offers (
+                    group_message_id INTEGER NOT NULL,
+                    suggestion_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (group_message_id, suggestion_id)
+                )
+            ''')
+            
+            # Forwarded group messages already answered with a suggested reply: a second
+            # press of the inline button (or another operator's press) is ignored
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS suggestion_replies (
+                    group_message_id INTEGER PRIMARY KEY,
+                    suggestion_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Id ranges of monthly message archive files (see retention.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS message_archives (
+                    month TEXT PRIMARY KEY,
+                    min_id INTEGER NOT NULL,
+                    max_id INTEGER NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            if not self._init_search_index(cursor):
+                self.search_enabled = False
+            
             conn.commit()
             conn.close()
-            logger.info("База данных инициализирована успешно")
+            logger.info(f"База данных {os.path.basename(db_path)} инициализирована успешно")
             
         except Exception as e:
             logger.error(f"Ошибка при инициализации базы данных: {e}")
             raise
     
+    @staticmethod
+    def _init_search_index(cursor, schema: str = "main") -> bool:
+        """
+        Create the FTS5 index over messages and its sync triggers; False without FTS5.
+        
+        schema is "archive" for an attached monthly archive file (see retention.py).
+        """
+        cursor.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'messages_fts'")
+        existed = cursor.fetchone() is not None
+        
+        # External content table: stores only the index, text is read from messages.
+        # unicode61 folds case and diacritics for Cyrillic and Latin, porter stems English.
+        # user_id is indexed too, so per-user search intersects doclists instead of scanning
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.messages_fts USING fts5(
+                    message_text,
+                    user_id,
+                    content='messages',
+                    content_rowid='id',
+                    tokenize='porter unicode61 remove_diacritics 2'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Полнотекстовый поиск недоступен (SQLite без FTS5): {e}")
+            return False
+        
+        # Trigger bodies resolve unqualified names in the trigger's own schema
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, message_text, user_id)
+                VALUES (new.id, new.message_text, new.user_id);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message_text, user_id)
+                VALUES ('delete', old.id, old.message_text, old.user_id);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_update AFTER UPDATE OF message_text, user_id ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message_text, user_id)
+                VALUES ('delete', old.id, old.message_text, old.user_id);
+                INSERT INTO messages_fts (rowid, message_text, user_id)
+                VALUES (new.id, new.message_text, new.user_id);
+            END
+        ''')
+        
+        if not existed:
+            # Index messages saved before the search existed
+            cursor.execute(f"INSERT INTO {schema}.messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+    
+    @timed("sqlite")
     def save_message(self, user_id: str, message_text: Optional[str] = None, 
                     photo_url: Optional[str] = None, direction: str = "user",
-                    telegram_message_id: Optional[int] = None):
+                    telegram_message_id: Optional[int] = None) -> int:
+        """Save a message and return its row id (used as the event sequence number)"""
         try:
-            conn = self.get_connection()
+            writer = self._writer_for(user_id)
+            if writer is not None:
+                message = writer.execute(
+                    lambda cursor: self._insert_message(cursor, user_id, message_text, photo_url,
+                                                        direction, telegram_message_id),
+                    (f"user:{user_id}",)
+                )
+                self._on_message_saved(user_id, message)
+                return message["id"]
+            
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO messages (user_id, message_text, photo_url, direction, telegram_message_id)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, message_text, photo_url, direction, telegram_message_id))
+            message = self._insert_message(cursor, user_id, message_text, photo_url,
+                                           direction, telegram_message_id)
             
             conn.commit()
             conn.close()
-            logger.info(f"Сообщение сохранено для пользователя {user_id}")
+            logger.info("Сообщение сохранено для пользователя %s", user_id, extra=SAMPLED)
+            
+            self._on_message_saved(user_id, message)
+            return message["id"]
             
         except Exception as e:
             logger.error(f"Ошибка при сохранении сообщения: {e}")
             raise
     
-    def get_message_history(self, user_id: str, limit: int = 50) -> List[Dict]:
+    def _insert_message(self, cursor, user_id: str, message_text: Optional[str],
+                        photo_url: Optional[str], direction: str,
+                        telegram_message_id: Optional[int]) -> Dict:
+        if self.shards:
+            # Next multiple of the stride above the shard's high-water mark plus the shard
+            # number: ids stay increasing per user and unique across shards after rebalancing
+            cursor.execute('''
+                INSERT INTO messages (id, user_id, message_text, photo_url, direction, telegram_message_id)
+                VALUES (
+                    (SELECT (IFNULL(MAX(seq), 0) / ? + 1) * ? + ? FROM sqlite_sequence WHERE name = 'messages'),
+                    ?, ?, ?, ?, ?
+                )
+                RETURNING id, created_at
+            ''', (SHARD_ID_STRIDE, SHARD_ID_STRIDE, self.shard_for(user_id),
+                  user_id, message_text, photo_url, direction, telegram_message_id))
+        else:
+            cursor.execute('''
+                INSERT INTO messages (user_id, message_text, photo_url, direction, telegram_message_id)
+                VALUES (?, ?, ?, ?, ?)
+                RETURNING id, created_at
+            ''', (user_id, message_text, photo_url, direction, telegram_message_id))
+        row = cursor.fetchone()
+        
+        return {
+            "id": row["id"],
+            "message": message_text,
+            "photo_url": photo_url,
+            "direction": direction,
+            "created_at": row["created_at"]
+        }
+    
+    def _on_message_saved(self, user_id: str, message: Dict):
+        if self.message_cache is not None:
+            self.message_cache.append(user_id, message)
+            self._publish_invalidation("messages", user_id)
+    
+    @timed("sqlite")
+    def get_message_history(self, user_id: str, limit: int = 50,
+                            before_id: Optional[int] = None,
+                            after_id: Optional[int] = None,
+                            min_last_id: Optional[int] = None) -> List[Dict]:
+        """
+        Get user messages oldest first, paginated by the id primary key.
+        
+        Without cursors returns the latest `limit` messages, with before_id the page
+        right before that id, with after_id the messages right after it (delta sync).
+        min_last_id is the latest id known to be in the database: a ring buffer that
+        ends before it (a write on another worker whose invalidation has not arrived
+        yet) is refilled instead of served.
+        """
         try:
-            conn = self.get_connection()
+            self._wait_for_writes(f"user:{user_id}", user_id)
+            
+            if self.message_cache is None or before_id is not None or after_id is not None:
+                return self._select_history(user_id, limit, before_id, after_id)
+            
+            # First page: serve from the ring buffer, fill it on a miss
+            cached = self.message_cache.get_recent(user_id, limit)
+            if cached is not None:
+                if min_last_id is None or (cached and cached[-1]["id"] >= min_last_id):
+                    return cached
+                self.message_cache.invalidate(user_id)
+            
+            token = self.message_cache.load_token(user_id)
+            fetch_limit = max(limit, self.message_cache.per_user)
+            history = self._select_history(user_id, fetch_limit, None, None)
+            self.message_cache.fill(user_id, history, len(history) < fetch_limit, token)
+            return history[-limit:]
+            
+        except Exception as e:
+            logger.error(f"Ошибка при получении истории: {e}")
+            mark_failed()
+            return []
+    
+    def _select_history(self, user_id: str, limit: int, before_id: Optional[int],
+                        after_id: Optional[int]) -> List[Dict]:
+        conn = self.get_connection(user_id)
+        try:
+            cursor = conn.cursor()
+            
+            if after_id is not None:
+                cursor.execute('''
+                    SELECT id, message_text, photo_url, direction, created_at
+                    FROM messages
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                ''', (user_id, after_id, limit))
+            else:
+                cursor.execute('''
+                    SELECT * FROM (
+                        SELECT id, message_text, photo_url, direction, created_at
+                        FROM messages
+                        WHERE user_id = ? AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    ) ORDER BY id ASC
+                ''', (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+            
+            rows = cursor.fetchall()
+            
+            # Archived messages are older than everything left in messages
+            if self.archive is not None:
+                if after_id is not None:
+                    # A batch archived between the two reads is seen in both
+                    seen = {row["id"] for row in rows}
+                    archived = [row for row in self.archive.select_after(conn, user_id, after_id, limit)
+                                if row["id"] not in seen]
+                    rows = sorted(archived + rows, key=lambda row: row["id"])[:limit]
+                elif len(rows) < limit:
+                    bound = rows[0]["id"] if rows else (before_id if before_id is not None else 2 ** 63 - 1)
+                    rows = self.archive.select_before(conn, user_id, bound, limit - len(rows)) + rows
+            
+            return [self._message_from_row(row) for row in rows]
+        finally:
+            conn.close()
+    
+    @timed("sqlite")
+    def get_last_message_id(self, user_id: str) -> Optional[int]:
+        """Get the id of the latest user message (history version for ETag)"""
+        try:
+            self._wait_for_writes(f"user:{user_id}", user_id)
+            
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
-                SELECT message_text, photo_url, direction, created_at
-                FROM messages
+                SELECT MAX(id) AS last_id FROM messages
                 WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (user_id, limit))
+            ''', (user_id,))
             
-            rows = cursor.fetchall()
+            row = cursor.fetchone()
             conn.close()
             
-            history = []
-            for row in rows:
-                history.append({
-                    "message": row["message_text"],
-                    "photo_url": row["photo_url"],
-                    "direction": row["direction"],
-                    "created_at": row["created_at"]
-                })
+            return row["last_id"] if row else None
             
-            return list(reversed(history))
+        except Exception as e:
+            logger.error(f"Ошибка при получении id последнего сообщения: {e}")
+            mark_failed()
+            return None
+    
+    @staticmethod
+    def _message_from_row(row) -> Dict:
+        return {
+            "id": row["id"],
+            "message": row["message_text"],
+            "photo_url": row["photo_url"],
+            "direction": row["direction"],
+            "created_at": row["created_at"]
+        }
+    
+    @staticmethod
+    def _search_terms(query: str) -> List[str]:
+        return re.findall(r"\w+", query)[:SEARCH_MAX_TERMS]
+    
+    @staticmethod
+    def _search_snippet(text: Optional[str], terms: List[str], words: int = 16) -> str:
+        """Up to `words` HTML-escaped words around the first match, matches wrapped in <mark>"""
+        if not text:
+            return ""
+        prefixes = tuple(term.casefold() for term in terms)
+        tokens = text.split()
+        matches = [i for i, token in enumerate(tokens)
+                   if re.sub(r"^\W+", "", token).casefold().startswith(prefixes)]
+        start = max(0, (matches[0] if matches else 0) - words // 2)
+        window = tokens[start:start + words]
+        marked = [f"<mark>{html.escape(token)}</mark>" if start + i in matches else html.escape(token)
+                  for i, token in enumerate(window)]
+        return ("… " if start > 0 else "") + " ".join(marked) + (" …" if start + words < len(tokens) else "")
+    
+    @staticmethod
+    def _search_sql(schema: str, user_filter: str) -> str:
+        # Rank the newest window of matches. Snippets are built in Python: FTS5
+        # snippet() re-runs the MATCH for every row of the page
+        return f'''
+            WITH candidates AS (
+                SELECT fts.rowid AS id, fts.rank AS rank
+                FROM {schema}.messages_fts AS fts
+                JOIN {schema}.messages m ON m.id = fts.rowid
+                WHERE fts.messages_fts MATCH :match {user_filter}
+                ORDER BY fts.rowid DESC
+                LIMIT :window
+            ), page AS (
+                SELECT id, rank FROM candidates
+                ORDER BY rank
+                LIMIT :limit
+            )
+            SELECT m.id, m.user_id, m.message_text, m.direction, m.created_at, page.rank AS rank
+            FROM page
+            JOIN {schema}.messages m ON m.id = page.id
+            ORDER BY page.rank
+        '''
+    
+    @timed("sqlite")
+    def search_messages(self, query: str, limit: int = 20, offset: int = 0,
+                        user_id: Optional[str] = None) -> List[Dict]:
+        """Full-text search over message text, best matches (BM25) first"""
+        terms = self._search_terms(query)
+        if not terms or not self.search_enabled:
+            return []
+        # Every word as a quoted prefix term: no FTS5 syntax from user input, and
+        # prefixes make up for the lack of a Russian stemmer
+        match = "message_text : (" + " ".join(f'"{term}"*' for term in terms) + ")"
+        if user_id is not None:
+            # Phrase of the user_id tokens; the exact id is checked against messages below
+            match += ' AND user_id : "' + user_id.replace('"', '""') + '"'
+        
+        paths = [self.path_for_user(user_id)] if user_id is not None else self.user_paths()
+        user_filter = "AND m.user_id = :user_id" if user_id is not None else ""
+        # Each source (shard, monthly archive) returns its top offset+limit, then they are merged
+        params = {"match": match, "user_id": user_id, "window": SEARCH_RANK_WINDOW,
+                  "limit": offset + limit}
+        
+        try:
+            rows = []
+            months = set()
+            for path in paths:
+                conn = self._connect(path)
+                try:
+                    rows += conn.execute(self._search_sql("main", user_filter), params).fetchall()
+                    if self.archive is not None:
+                        months.update(row["month"] for row in conn.execute("SELECT month FROM message_archives"))
+                finally:
+                    conn.close()
+            
+            # Archived messages are indexed in their monthly files (see retention.py)
+            if months:
+                conn = self._connect(self.db_path)
+                try:
+                    for month in sorted(months, reverse=True):
+                        try:
+                            rows += self.archive.select(conn, month, self._search_sql("archive", user_filter),
+                                                        params)
+                        except sqlite3.OperationalError as e:
+                            # Archive written before it was indexed: retention indexes it on its next run
+                            logger.warning(f"Архив {month} пропущен при поиске: {e}")
+                finally:
+                    conn.close()
+            
+            rows.sort(key=lambda row: row["rank"])
+            return [{
+                "id": row["id"],
+                "user_id": row["user_id"],
+                "snippet": self._search_snippet(row["message_text"], terms),
+                "direction": row["direction"],
+                "created_at": row["created_at"],
+                "rank": row["rank"]
+            } for row in rows[offset:offset + limit]]
             
         except Exception as e:
-            logger.error(f"Ошибка при получении истории: {e}")
+            logger.error(f"Ошибка при поиске сообщений: {e}")
+            mark_failed()
             return []
-    
+
+    @timed("sqlite")
+    def get_message(self, message_id: int) -> Optional[Dict]:
+        """Message by id with its user_id, None if not found (or already archived)"""
+        try:
+            for path in self.user_paths():
+                conn = self._connect(path)
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT id, user_id, message_text, photo_url, direction, created_at
+                        FROM messages
+                        WHERE id = ?
+                    ''', (message_id,))
+                    row = cursor.fetchone()
+                finally:
+                    conn.close()
+                if row is not None:
+                    return {**self._message_from_row(row), "user_id": row["user_id"]}
+            return None
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении сообщения {message_id}: {e}")
+            mark_failed()
+            return None
+
+    @timed("sqlite")
+    def get_operator_reply_pairs(self, limit: int = 50000) -> List[Dict]:
+        """Newest operator replies with the user message that preceded each, oldest first"""
+        try:
+            pairs = []
+            for path in self.user_paths():
+                conn = self._connect(path)
+                try:
+                    cursor = conn.cursor()
+                    # Operator replies are support messages sent from Telegram (AI replies have
+                    # no telegram_message_id); the question is found via idx (user_id, id)
+                    cursor.execute('''
+                        SELECT r.id, r.user_id, r.message_text AS answer,
+                               (SELECT q.message_text FROM messages q
+                                WHERE q.user_id = r.user_id AND q.id < r.id AND q.direction = 'user'
+                                ORDER BY q.id DESC
+                                LIMIT 1) AS question
+                        FROM messages r
+                        WHERE r.direction = 'support' AND r.telegram_message_id IS NOT NULL
+                          AND r.message_text IS NOT NULL
+                        ORDER BY r.id DESC
+                        LIMIT ?
+                    ''', (limit,))
+                    pairs.extend({"id": row["id"], "user_id": row["user_id"],
+                                  "question": row["question"], "answer": row["answer"]}
+                                 for row in cursor.fetchall() if row["question"])
+                finally:
+                    conn.close()
+
+            pairs.sort(key=lambda pair: pair["id"])
+            return pairs[-limit:]
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении ответов операторов: {e}")
+            mark_failed()
+            return []
+
+    @timed("sqlite")
     def save_device_token(self, user_id: str, fcm_token: str, platform: str, device_id: Optional[str] = None):
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -216,15 +808,25 @@ class Database:
             
             conn.commit()
             conn.close()
-            logger.info(f"Токен устройства сохранен для пользователя {user_id}")
+            logger.info("Токен устройства сохранен для пользователя %s", user_id, extra=SAMPLED)
+            
+            self.device_tokens_cache.invalidate(user_id)
+            self._publish_invalidation("device_tokens", user_id)
             
         except Exception as e:
             logger.error(f"Ошибка при сохранении токена устройства: {e}")
             raise
     
+    @timed("sqlite")
     def get_device_tokens(self, user_id: str) -> List[str]:
         try:
-            conn = self.get_connection()
+            if self.cache_enabled:
+                found, tokens = self.device_tokens_cache.get(user_id)
+                if found:
+                    return list(tokens)
+                token = self.device_tokens_cache.load_token()
+            
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -235,21 +837,58 @@ class Database:
             rows = cursor.fetchall()
             conn.close()
             
-            return [row["fcm_token"] for row in rows]
+            tokens = [row["fcm_token"] for row in rows]
+            if self.cache_enabled:
+                self.device_tokens_cache.set(user_id, tuple(tokens), token)
+            return tokens
             
         except Exception as e:
             logger.error(f"Ошибка при получении токенов устройств: {e}")
+            mark_failed()
             return []
     
+    @timed("sqlite")
+    def delete_device_tokens(self, user_id: str, fcm_tokens: List[str]):
+        """Remove tokens that FCM reported as unregistered"""
+        if not fcm_tokens:
+            return
+        try:
+            conn = self.get_connection(user_id)
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                DELETE FROM device_tokens
+                WHERE user_id = ? AND fcm_token = ?
+            ''', [(user_id, fcm_token) for fcm_token in fcm_tokens])
+            
+            conn.commit()
+            conn.close()
+            logger.info(f"Удалено {len(fcm_tokens)} недействительных токенов пользователя {user_id}")
+            
+            self.device_tokens_cache.invalidate(user_id)
+            self._publish_invalidation("device_tokens", user_id)
+            
+        except Exception as e:
+            logger.error(f"Ошибка при удалении токенов устройств: {e}")
+            mark_failed()
+    
+    @timed("sqlite")
     def save_message_mapping(self, user_id: str, telegram_message_id: int):
         try:
+            writer = self._writer_for()
+            if writer is not None:
+                self._submit_write(
+                    writer,
+                    lambda cursor: self._insert_message_mapping(cursor, user_id, telegram_message_id),
+                    (f"user:{user_id}", f"tg:{telegram_message_id}"),
+                    "сохранении связи сообщения"
+                )
+                return
+            
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO message_mapping (user_id, telegram_message_id)
-                VALUES (?, ?)
-            ''', (user_id, telegram_message_id))
+            self._insert_message_mapping(cursor, user_id, telegram_message_id)
             
             conn.commit()
             conn.close()
@@ -258,8 +897,18 @@ class Database:
             logger.error(f"Ошибка при сохранении связи сообщения: {e}")
             raise
     
+    @staticmethod
+    def _insert_message_mapping(cursor, user_id: str, telegram_message_id: int):
+        cursor.execute('''
+            INSERT OR REPLACE INTO message_mapping (user_id, telegram_message_id)
+            VALUES (?, ?)
+        ''', (user_id, telegram_message_id))
+    
+    @timed("sqlite")
     def get_user_by_telegram_message(self, telegram_message_id: int) -> Optional[str]:
         try:
+            self._wait_for_writes(f"tg:{telegram_message_id}")
+            
             conn = self.get_connection()
             cursor = conn.cursor()
             
@@ -277,90 +926,133 @@ class Database:
             
         except Exception as e:
             logger.error(f"Ошибка при получении user_id: {e}")
+            mark_failed()
             return None
     
-    def get_last_message_time(self, user_id: str) -> Optional[str]:
+    @timed("sqlite")
+    def save_greeting_once(self, user_id: str, greeting_text: str, greeting_date: str) -> Optional[int]:
+        """
+        Atomically claim the user's greeting for greeting_date and save the greeting message.
+        
+        Returns the message id, or None if the greeting for that day was already sent.
+        """
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT created_at FROM messages
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            ''', (user_id,))
+            writer = self._writer_for(user_id)
+            if writer is not None:
+                message = writer.execute(
+                    lambda cursor: self._insert_greeting_once(cursor, user_id, greeting_text, greeting_date),
+                    (f"user:{user_id}",)
+                )
+            else:
+                conn = self.get_connection(user_id)
+                cursor = conn.cursor()
+                
+                message = self._insert_greeting_once(cursor, user_id, greeting_text, greeting_date)
+                
+                conn.commit()
+                conn.close()
             
-            row = cursor.fetchone()
-            conn.close()
+            if message is None:
+                return None
             
-            if row:
-                return row["created_at"]
-            return None
+            self._on_message_saved(user_id, message)
+            return message["id"]
             
         except Exception as e:
-            logger.error(f"Ошибка при получении времени последнего сообщения: {e}")
+            logger.error(f"Ошибка при сохранении приветствия: {e}")
+            raise
+    
+    def _insert_greeting_once(self, cursor, user_id: str, greeting_text: str,
+                              greeting_date: str) -> Optional[Dict]:
+        cursor.execute('''
+            INSERT OR IGNORE INTO greetings_sent (user_id, greeting_date)
+            VALUES (?, ?)
+            RETURNING id
+        ''', (user_id, greeting_date))
+        
+        if cursor.fetchone() is None:
             return None
+        return self._insert_message(cursor, user_id, greeting_text, None, "support", None)
     
-    def has_messages(self, user_id: str) -> bool:
+    @timed("sqlite")
+    def prune_greetings(self, before_date: str) -> int:
+        """Delete greeting marks older than before_date (YYYY-MM-DD)"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT COUNT(*) as count FROM messages
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            row = cursor.fetchone()
-            conn.close()
+            deleted = 0
+            for path in self.user_paths():
+                conn = self._connect(path)
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    DELETE FROM greetings_sent
+                    WHERE greeting_date < ?
+                ''', (before_date,))
+                deleted += cursor.rowcount
+                
+                conn.commit()
+                conn.close()
             
-            return row["count"] > 0 if row else False
+            return deleted
             
         except Exception as e:
-            logger.error(f"Ошибка при проверке наличия сообщений: {e}")
-            return False
+            logger.error(f"Ошибка при очистке отметок о приветствии: {e}")
+            mark_failed()
+            return 0
     
-    def was_greeting_sent_today(self, user_id: str) -> bool:
+    @timed("sqlite")
+    def prune_message_mappings(self, older_than_days: int, batch_size: int = 1000) -> int:
+        """Delete Telegram message mappings older than the given number of days"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
+            deleted = 0
+            while True:
+                # Small batches keep the write lock short
+                cursor.execute('''
+                    DELETE FROM message_mapping
+                    WHERE id IN (
+                        SELECT id FROM message_mapping
+                        WHERE created_at < DATETIME('now', ?)
+                        LIMIT ?
+                    )
+                ''', (f"-{older_than_days} days", batch_size))
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+            
+            # Without the mapping a suggestion button can't be answered anyway
             cursor.execute('''
-                SELECT id FROM greetings_sent
-                WHERE user_id = ? AND greeting_date = DATE('now')
-            ''', (user_id,))
-            
-            row = cursor.fetchone()
-            conn.close()
-            
-            return row is not None
-            
-        except Exception as e:
-            logger.error(f"Ошибка при проверке приветствия: {e}")
-            return False
-    
-    def mark_greeting_sent(self, user_id: str):
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
+                DELETE FROM suggestion_replies WHERE created_at < DATETIME('now', ?)
+            ''', (f"-{older_than_days} days",))
             cursor.execute('''
-                INSERT OR REPLACE INTO greetings_sent (user_id, greeting_date)
-                VALUES (?, DATE('now'))
-            ''', (user_id,))
-            
+                DELETE FROM suggestion_offers WHERE created_at < DATETIME('now', ?)
+            ''', (f"-{older_than_days} days",))
             conn.commit()
+            
             conn.close()
             
+            if deleted:
+                logger.info(f"Удалено {deleted} связей с сообщениями Telegram старше {older_than_days} дней")
+            return deleted
+            
         except Exception as e:
-            logger.error(f"Ошибка при сохранении отметки о приветствии: {e}")
-            raise
+            logger.error(f"Ошибка при очистке связей с сообщениями Telegram: {e}")
+            mark_failed()
+            return 0
     
+    @timed("sqlite")
     def get_user_support_mode(self, user_id: str) -> str:
         """Get current support mode for user ('ai' or 'human')"""
         try:
-            conn = self.get_connection()
+            if self.cache_enabled:
+                found, mode = self.support_mode_cache.get(user_id)
+                if found:
+                    return mode
+                token = self.support_mode_cache.load_token()
+            
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -371,18 +1063,21 @@ class Database:
             row = cursor.fetchone()
             conn.close()
             
-            if row:
-                return row["mode"]
-            return "ai"  # Default to AI mode
+            mode = row["mode"] if row else "ai"  # Default to AI mode
+            if self.cache_enabled:
+                self.support_mode_cache.set(user_id, mode, token)
+            return mode
             
         except Exception as e:
             logger.error(f"Ошибка при получении режима поддержки: {e}")
+            mark_failed()
             return "ai"
     
+    @timed("sqlite")
     def set_user_support_mode(self, user_id: str, mode: str):
         """Set support mode for user ('ai' or 'human')"""
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -395,16 +1090,20 @@ class Database:
             
             conn.commit()
             conn.close()
-            logger.info(f"Режим поддержки для пользователя {user_id} установлен на: {mode}")
+            logger.info("Режим поддержки для пользователя %s установлен на: %s", user_id, mode, extra=SAMPLED)
+            
+            self.support_mode_cache.invalidate(user_id)
+            self._publish_invalidation("support_mode", user_id)
             
         except Exception as e:
             logger.error(f"Ошибка при установке режима поддержки: {e}")
             raise
     
+    @timed("sqlite")
     def update_last_user_message_time(self, user_id: str):
         """Update the last user message timestamp"""
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(user_id)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -419,46 +1118,232 @@ class Database:
             
         except Exception as e:
             logger.error(f"Ошибка при обновлении времени последнего сообщения: {e}")
+            mark_failed()
     
-    def get_last_user_message_time(self, user_id: str) -> Optional[datetime]:
-        """Get the last user message timestamp"""
+    @timed("sqlite")
+    def reset_expired_human_sessions(self, timeout_minutes: int = 5) -> List[str]:
+        """Switch back to AI everyone in human mode idle for timeout_minutes, return their ids"""
+        try:
+            user_ids = []
+            for path in self.user_paths():
+                conn = self._connect(path)
+                cursor = conn.cursor()
+                
+                # Both sides are SQLite UTC timestamps, no local time involved
+                cursor.execute('''
+                    UPDATE user_support_mode
+                    SET mode = 'ai', switched_at = CURRENT_TIMESTAMP
+                    WHERE mode = 'human' AND last_user_message_at < DATETIME('now', ?)
+                    RETURNING user_id
+                ''', (f"-{int(timeout_minutes)} minutes",))
+                
+                user_ids.extend(row["user_id"] for row in cursor.fetchall())
+                conn.commit()
+                conn.close()
+            
+            for user_id in user_ids:
+                self.support_mode_cache.invalidate(user_id)
+                self._publish_invalidation("support_mode", user_id)
+            
+            return user_ids
+            
+        except Exception as e:
+            logger.error(f"Ошибка при сбросе неактивных сессий с оператором: {e}")
+            mark_failed()
+            return []
+    
+    @timed("sqlite")
+    def get_telegram_offset(self) -> Optional[int]:
+        """Get the last processed Telegram update_id"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
             cursor.execute('''
-                SELECT last_user_message_at FROM user_support_mode
-                WHERE user_id = ?
-            ''', (user_id,))
+                SELECT last_update_id FROM telegram_offset
+                WHERE id = 1
+            ''')
             
             row = cursor.fetchone()
             conn.close()
             
-            if row and row["last_user_message_at"]:
-                return datetime.strptime(row["last_user_message_at"], '%Y-%m-%d %H:%M:%S')
+            if row:
+                return row["last_update_id"]
             return None
             
         except Exception as e:
-            logger.error(f"Ошибка при получении времени последнего сообщения: {e}")
+            logger.error(f"Ошибка при получении offset обновлений Telegram: {e}")
+            mark_failed()
             return None
     
-    def should_reset_to_ai_mode(self, user_id: str, timeout_minutes: int = 5) -> bool:
-        """Check if user should be reset to AI mode due to inactivity"""
+    @timed("sqlite")
+    def save_telegram_offset(self, last_update_id: int):
+        """Save the last processed Telegram update_id"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO telegram_offset (id, last_update_id, updated_at)
+                VALUES (1, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(id) DO UPDATE SET 
+                    last_update_id = excluded.last_update_id,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (last_update_id,))
+            
+            conn.commit()
+            conn.close()
+            
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении offset обновлений Telegram: {e}")
+            mark_failed()
+    
+    @timed("sqlite")
+    def claim_telegram_update(self, update_id: int) -> bool:
+        """Mark an update as taken; False if this or another replica already took it"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR IGNORE INTO telegram_updates (update_id, status)
+                VALUES (?, 'processing')
+            ''', (update_id,))
+            claimed = cursor.rowcount == 1
+            
+            conn.commit()
+            conn.close()
+            return claimed
+            
+        except Exception as e:
+            # Handling will most likely fail too and end up as a dead letter
+            logger.error(f"Ошибка при отметке обновления Telegram {update_id}: {e}")
+            mark_failed()
+            return True
+    
+    @timed("sqlite")
+    def save_suggestion_offers(self, group_message_id: int, suggestion_ids: List[int]):
+        """Remember which suggested replies were offered under a forwarded message"""
         try:
-            mode = self.get_user_support_mode(user_id)
-            if mode != "human":
-                return False
+            conn = self.get_connection()
+            cursor = conn.cursor()
             
-            last_message_time = self.get_last_user_message_time(user_id)
-            if not last_message_time:
-                return False
+            cursor.executemany('''
+                INSERT OR IGNORE INTO suggestion_offers (group_message_id, suggestion_id)
+                VALUES (?, ?)
+            ''', [(group_message_id, suggestion_id) for suggestion_id in suggestion_ids])
+            
+            conn.commit()
+            conn.close()
+            
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении подсказок для сообщения {group_message_id}: {e}")
+            mark_failed()
+    
+    @timed("sqlite")
+    def is_suggestion_offered(self, group_message_id: int, suggestion_id: int) -> bool:
+        """True if this suggested reply was offered under the forwarded message"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
             
-            now = datetime.now()
-            time_diff = (now - last_message_time).total_seconds() / 60
+            cursor.execute('''
+                SELECT 1 FROM suggestion_offers
+                WHERE group_message_id = ? AND suggestion_id = ?
+            ''', (group_message_id, suggestion_id))
+            offered = cursor.fetchone() is not None
             
-            return time_diff >= timeout_minutes
+            conn.close()
+            return offered
             
         except Exception as e:
-            logger.error(f"Ошибка при проверке сброса режима: {e}")
+            logger.error(f"Ошибка при проверке подсказки для сообщения {group_message_id}: {e}")
+            mark_failed()
             return False
-
+    
+    @timed("sqlite")
+    def claim_suggestion_reply(self, group_message_id: int, suggestion_id: int) -> bool:
+        """Reserve a forwarded message for a suggested reply; False if it was already answered"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR IGNORE INTO suggestion_replies (group_message_id, suggestion_id)
+                VALUES (?, ?)
+            ''', (group_message_id, suggestion_id))
+            claimed = cursor.rowcount == 1
+            
+            conn.commit()
+            conn.close()
+            return claimed
+            
+        except Exception as e:
+            # Not sending is safer than sending the reply twice
+            logger.error(f"Ошибка при отметке подсказки для сообщения {group_message_id}: {e}")
+            mark_failed()
+            return False
+    
+    @timed("sqlite")
+    def release_suggestion_reply(self, group_message_id: int):
+        """Free the reservation when the suggested reply could not be sent"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                DELETE FROM suggestion_replies WHERE group_message_id = ?
+            ''', (group_message_id,))
+            
+            conn.commit()
+            conn.close()
+            
+        except Exception as e:
+            logger.error(f"Ошибка при снятии отметки подсказки для сообщения {group_message_id}: {e}")
+            mark_failed()
+    
+    @timed("sqlite")
+    def finish_telegram_update(self, update_id: int, error: Optional[str] = None,
+                               payload: Optional[str] = None):
+        """Mark a taken update as done, or as failed with the error and the raw update"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO telegram_updates (update_id, status, error, payload)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(update_id) DO UPDATE SET
+                    status = excluded.status,
+                    error = excluded.error,
+                    payload = excluded.payload
+            ''', (update_id, "failed" if error else "done", error, payload))
+            
+            conn.commit()
+            conn.close()
+            
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении статуса обновления Telegram {update_id}: {e}")
+            mark_failed()
+    
+    @timed("sqlite")
+    def prune_telegram_updates(self, older_than_days: int) -> int:
+        """Delete handled update marks older than the given number of days (dead letters are kept)"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                DELETE FROM telegram_updates
+                WHERE status = 'done' AND created_at < DATETIME('now', ?)
+            ''', (f"-{older_than_days} days",))
+            deleted = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            return deleted
+            
+        except Exception as e:
+            logger.error(f"Ошибка при очистке отметок обновлений Telegram: {e}")
+            mark_failed()
+            return 0
@@ -0,0 +1,65 @@
+"""
+Ежедневное приветственное сообщение.
+
+Пользователи, уже поприветствованные сегодня, хранятся в памяти, поэтому повторные
+запросы истории за день не обращаются к БД. Первое приветствие за день — одна
+транзакция: INSERT OR IGNORE ... RETURNING в greetings_sent и само сообщение.
+В полночь (UTC, как DATE('now') в SQLite) множество сбрасывается, а старые
+отметки удаляются из greetings_sent.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class GreetingTracker:
+    """Учет приветствий за текущие сутки"""
+
+    def __init__(self, db, retention_days: int = 2):
+        self.db = db
+        self.retention_days = retention_days
+
+        self._lock = threading.Lock()
+        self._day: Optional[str] = None
+        self._greeted: Set[str] = set()
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def _roll_over(self, today: str):
+        """Вызывается под блокировкой при смене суток"""
+        self._day = today
+        self._greeted = set()
+
+        before = (datetime.fromisoformat(today) - timedelta(days=self.retention_days - 1)).date().isoformat()
+        threading.Thread(target=self._prune, args=(before,), daemon=True).start()
+
+    def _prune(self, before_date: str):
+        deleted = self.db.prune_greetings(before_date)
+        if deleted:
+            logger.info(f"Удалено {deleted} старых отметок о приветствии (до {before_date})")
+
+    def send_if_needed(self, user_id: str, greeting_text: str) -> Optional[int]:
+        """Сохраняет приветствие, если сегодня его еще не было; возвращает id сообщения"""
+        today = self._today()
+        with self._lock:
+            if self._day != today:
+                self._roll_over(today)
+            if user_id in self._greeted:
+                return None
+
+        # Атомарно в БД: при гонке запросов или реплик приветствие сохранит только один
+        message_id = self.db.save_greeting_once(user_id, greeting_text, today)
+
+        with self._lock:
+            if self._day == today:
+                self._greeted.add(user_id)
+
+        return message_id
+
+    def stats(self):
+        return {"day": self._day, "greeted_today": len(self._greeted)}
@@ -0,0 +1,212 @@
+"""
+Ключи идемпотентности (заголовок Idempotency-Key) для повторяемых запросов.
+
+Мобильный клиент повторяет запрос по таймауту, а /send_message может долго ждать
+OpenRouter: каждый повтор сохранял бы еще одно сообщение, заново вызывал модель и
+пересылал сообщение в Telegram. Первый запрос с ключом захватывает его в таблице
+idempotency_keys (общей для всех реплик), выполняется и сохраняет ответ. Повтор
+получает сохраненный ответ, а повтор, пришедший во время выполнения первого, ждет
+его результата.
+
+С ключом хранится хеш запроса: тот же ключ с другим содержимым — ошибка клиента
+(MISMATCH), а не повтор. Ключ, захваченный упавшей репликой, освобождается через
+in_flight_timeout. Записи старше ttl_seconds удаляются попутно, не чаще раза в
+prune_interval.
+"""
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OWNER = "owner"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+MISMATCH = "mismatch"
+
+
+class IdempotencyStore:
+    """Сохраненные ответы по ключам идемпотентности в таблице idempotency_keys"""
+
+    def __init__(self, db, ttl_seconds: float = 86400, in_flight_timeout: float = 120,
+                 poll_interval: float = 0.2, prune_interval: float = 600):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.in_flight_timeout = in_flight_timeout
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+
+        # Ожидающие на этой реплике просыпаются сразу, остальные опрашивают таблицу
+        self._lock = threading.Lock()
+        self._local_events: Dict[str, threading.Event] = {}
+        self._last_prune = 0.0
+
+        self.replays = 0
+        self.waits = 0
+
+        self._init_table()
+
+    def _init_table(self):
+        conn = self.db.get_connection()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    request_hash TEXT,
+                    response_status INTEGER,
+                    response_body TEXT,
+                    mimetype TEXT,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at
+                ON idempotency_keys (expires_at)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def begin(self, key: str, request_hash: Optional[str] = None) -> Tuple[str, Optional[object]]:
+        """
+        Захватывает ключ одним атомарным UPSERT.
+
+        Returns:
+            (OWNER, владелец) — запрос нужно выполнить и вызвать complete или abandon с этим владельцем;
+            (DONE, ответ) — повтор, ответ сохранен; (IN_FLIGHT, None) — первый запрос еще выполняется;
+            (MISMATCH, None) — ключ уже использован с другим содержимым запроса
+        """
+        self._maybe_prune()
+        now = time.time()
+        owner = uuid.uuid4().hex
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.cursor()
+            # Истекший ключ или брошенный упавшей репликой захватывается заново
+            cursor.execute('''
+                INSERT INTO idempotency_keys (key, owner, state, request_hash, created_at, expires_at)
+                VALUES (?, ?, 'in_flight', ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    owner = excluded.owner,
+                    state = 'in_flight',
+                    request_hash = excluded.request_hash,
+                    response_status = NULL,
+                    response_body = NULL,
+                    mimetype = NULL,
+                    created_at = excluded.created_at,
+                    expires_at = excluded.expires_at
+                WHERE idempotency_keys.expires_at < excluded.created_at
+                   OR (idempotency_keys.state = 'in_flight' AND idempotency_keys.created_at < ?)
+            ''', (key, owner, request_hash, now, now + self.ttl_seconds, now - self.in_flight_timeout))
+            cursor.execute('''
+                SELECT owner, state, request_hash, response_status, response_body, mimetype
+                FROM idempotency_keys
+                WHERE key = ?
+            ''', (key,))
+            row = cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+
+        if row["owner"] == owner:
+            with self._lock:
+                self._local_events.setdefault(key, threading.Event())
+            return OWNER, owner
+        if request_hash and row["request_hash"] and row["request_hash"] != request_hash:
+            return MISMATCH, None
+        if row["state"] == DONE:
+            self.replays += 1
+            return DONE, {"status": row["response_status"], "body": row["response_body"],
+                          "mimetype": row["mimetype"]}
+        return IN_FLIGHT, None
+
+    def complete(self, key: str, owner: str, status: int, body: str, mimetype: Optional[str]):
+        """Сохраняет ответ первого запроса, если ключ не захватил другой запрос после in_flight_timeout"""
+        try:
+            conn = self.db.get_connection()
+            try:
+                updated = conn.execute('''
+                    UPDATE idempotency_keys
+                    SET state = 'done', response_status = ?, response_body = ?, mimetype = ?
+                    WHERE key = ? AND owner = ?
+                ''', (status, body, mimetype, key, owner)).rowcount
+                conn.commit()
+            finally:
+                conn.close()
+            if not updated:
+                logger.warning(f"Ключ идемпотентности {key} захвачен другим запросом, ответ не сохранен")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении ответа для ключа идемпотентности {key}: {e}")
+        finally:
+            self._notify(key)
+
+    def abandon(self, key: str, owner: str):
+        """Освобождает ключ после ошибки, чтобы повтор выполнил запрос заново"""
+        try:
+            conn = self.db.get_connection()
+            try:
+                conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND owner = ? AND state = 'in_flight'",
+                             (key, owner))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при освобождении ключа идемпотентности {key}: {e}")
+        finally:
+            self._notify(key)
+
+    def wait(self, key: str, timeout: float) -> bool:
+        """Ждет, пока первый запрос завершится; False, если не дождались за timeout"""
+        self.waits += 1
+        with self._lock:
+            event = self._local_events.get(key)
+        deadline = time.monotonic() + timeout
+        while True:
+            if event is not None:
+                event.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+            if not self._is_in_flight(key):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+
+    def _is_in_flight(self, key: str) -> bool:
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute("SELECT state FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row["state"] == IN_FLIGHT
+
+    def _notify(self, key: str):
+        with self._lock:
+            event = self._local_events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _maybe_prune(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < self.prune_interval:
+                return
+            self._last_prune = now
+        try:
+            conn = self.db.get_connection()
+            try:
+                deleted = conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,)).rowcount
+                conn.commit()
+            finally:
+                conn.close()
+            if deleted:
+                logger.info(f"Удалено {deleted} истекших ключей идемпотентности")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке ключей идемпотентности: {e}")
+
+    def stats(self) -> Dict:
+        return {"replays": self.replays, "waits": self.waits}
@@ -0,0 +1,133 @@
+"""
+Выбор единственного лидера среди реплик через аренду (lease) в SQLite.
+
+Только лидер опрашивает Telegram getUpdates: два одновременных опроса приводят
+к 409 Conflict и потере/дублированию ответов операторов. Лидер продлевает аренду
+heartbeat-потоком; если он упал или завис, аренда истекает через ttl_seconds и ее
+забирает другая реплика. При штатной остановке аренда освобождается сразу.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """Аренда лидерства с именем name, хранящаяся в таблице leader_lease"""
+
+    def __init__(self, db, name: str, ttl_seconds: float = 10, heartbeat_seconds: float = 3,
+                 holder_id: Optional[str] = None):
+        self.db = db
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.holder_id = holder_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # Момент (по monotonic), до которого аренда гарантированно наша
+        self._valid_until = 0.0
+        self._became_leader = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._init_table()
+
+    def _init_table(self):
+        conn = self.db.get_connection()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS leader_lease (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    def try_acquire(self) -> bool:
+        """Захватывает или продлевает аренду одним атомарным UPSERT"""
+        started = time.monotonic()
+        now = time.time()
+        was_leader = self.is_leader
+
+        try:
+            conn = self.db.get_connection()
+            try:
+                row = conn.execute('''
+                    INSERT INTO leader_lease (name, holder, expires_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        holder = excluded.holder,
+                        expires_at = excluded.expires_at
+                    WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+                    RETURNING holder
+                ''', (self.name, self.holder_id, now + self.ttl_seconds, now)).fetchone()
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при продлении аренды {self.name}: {e}")
+            row = None
+
+        if row is not None:
+            # Отсчитываем от начала попытки, чтобы не переоценить срок аренды
+            self._valid_until = started + self.ttl_seconds
+            if not was_leader:
+                logger.info(f"Реплика {self.holder_id} стала лидером '{self.name}'")
+                self._became_leader.set()
+            return True
+
+        self._valid_until = 0.0
+        self._became_leader.clear()
+        if was_leader:
+            logger.warning(f"Реплика {self.holder_id} потеряла лидерство '{self.name}'")
+        return False
+
+    def release(self):
+        """Освобождает аренду, чтобы другая реплика сразу стала лидером"""
+        self._valid_until = 0.0
+        self._became_leader.clear()
+        try:
+            conn = self.db.get_connection()
+            try:
+                conn.execute('''
+                    DELETE FROM leader_lease
+                    WHERE name = ? AND holder = ?
+                ''', (self.name, self.holder_id))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при освобождении аренды {self.name}: {e}")
+
+    def wait_for_leadership(self, timeout: Optional[float] = None) -> bool:
+        return self._became_leader.wait(timeout)
+
+    def _heartbeat_loop(self):
+        while not self._stop.is_set():
+            self.try_acquire()
+            self._stop.wait(self.heartbeat_seconds)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True,
+                                        name=f"lease-{self.name}")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.heartbeat_seconds + 1)
+            self._thread = None
+        self.release()
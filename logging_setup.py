@@ -0,0 +1,176 @@
+"""
+Общая настройка логирования: запись в отдельном потоке, JSON и выборка частых сообщений.
+
+configure_logging() вызывается один раз в точке входа (server.py, shard_tool.py).
+Потоки запросов только создают LogRecord и кладут его в ограниченную очередь;
+подстановку аргументов, форматирование и запись в stderr делает поток
+QueueListener. Поэтому сообщения пишутся в %-стиле с ленивыми аргументами:
+
+    logger.info("Сообщение сохранено для пользователя %s", user_id, extra=SAMPLED)
+
+Сообщения с extra=SAMPLED (частые успешные события) пропускаются не чаще
+LOG_SAMPLE_PER_SECOND раз в секунду на шаблон; число пропущенных добавляется к
+следующему выведенному сообщению того же шаблона. Если очередь переполнена,
+записи отбрасываются, а не блокируют запрос. Структурированные поля передаются
+как extra={"fields": {...}}.
+"""
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_LEVELS, LOG_SAMPLE_PER_SECOND, LOG_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# extra для частых успешных сообщений, которые можно прореживать
+SAMPLED = {"sampled": True}
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+_listener: Optional[QueueListener] = None
+_handler: Optional["_NonBlockingQueueHandler"] = None
+_sampler: Optional["_SamplingFilter"] = None
+
+
+class _SamplingFilter(logging.Filter):
+    """Не больше per_second записей в секунду на (логгер, шаблон) для записей с SAMPLED"""
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        self.suppressed_total = 0
+        self._lock = threading.Lock()
+        self._windows: Dict[tuple, list] = {}  # ключ -> [секунда, выведено, пропущено]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.per_second <= 0 or not getattr(record, "sampled", False):
+            return True
+        key = (record.name, record.msg)
+        second = int(time.monotonic())
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window[0] != second:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                self._windows[key] = [second, 1, 0]
+                return True
+            if window[1] < self.per_second:
+                window[1] += 1
+                return True
+            window[2] += 1
+            self.suppressed_total += 1
+            return False
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Кладет записи в очередь без форматирования и без ожидания места"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирует поток QueueListener; запись не покидает процесс
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Формат logging.basicConfig плюс поля и число пропущенных записей"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + json.dumps(fields, ensure_ascii=False, default=str)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (+{suppressed} похожих пропущено)"
+        return text
+
+
+def _parse_levels(levels: str) -> Dict[str, str]:
+    """'database=WARNING,werkzeug=ERROR' -> {'database': 'WARNING', 'werkzeug': 'ERROR'}"""
+    result = {}
+    for item in levels.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        result[name.strip()] = level.strip().upper()
+    return result
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, levels: str = LOG_LEVELS,
+                      sample_per_second: int = LOG_SAMPLE_PER_SECOND, queue_size: int = LOG_QUEUE_SIZE):
+    """Заменяет обработчики корневого логгера очередью с потоком-писателем (повторный вызов ничего не делает)"""
+    global _listener, _handler, _sampler
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+
+    _sampler = _SamplingFilter(sample_per_second)
+    _handler = _NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    _handler.addFilter(_sampler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level.upper())
+
+    for name, logger_level in _parse_levels(levels).items():
+        try:
+            logging.getLogger(name).setLevel(logger_level)
+        except ValueError:
+            logger.warning("Неизвестный уровень %s для логгера %s в LOG_LEVELS", logger_level, name)
+
+    _listener = QueueListener(_handler.queue, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def stats() -> Dict:
+    """Очередь записи логов и число отброшенных и прореженных записей"""
+    if _listener is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "queue_depth": _handler.queue.qsize(),
+        "dropped": _handler.dropped,
+        "suppressed": _sampler.suppressed_total,
+    }
@@ -0,0 +1,354 @@
+"""
+Метрики в формате Prometheus (эндпоинт /metrics).
+
+Гистограммы задержек внешних зависимостей (OpenRouter, Telegram, FCM, SQLite) по
+операциям, счетчики ошибок, переключений режима и результатов push, а также
+значения, которые считываются только в момент опроса (сокеты, очереди, кэши).
+
+Запись на горячем пути дешевая: серия с нужными метками берется из словаря без
+блокировки (создается один раз), наблюдение — bisect и короткая блокировка самой
+серии, общей блокировки на все запросы нет. Те же измерения добавляются к шагам
+текущего запроса (tracing). Если выключены и метрики, и трассировка, декоратор
+timed возвращает функцию без обертки, а track ничего не измеряет.
+"""
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from config import METRICS_ENABLED, TRACING_ENABLED
+from tracing import record as record_span
+
+logger = logging.getLogger(__name__)
+
+# От миллисекунд SQLite до долгих ответов моделей и long polling Telegram
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_INSTRUMENTED = METRICS_ENABLED or TRACING_ENABLED
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        """Серия с этими значениями меток (создается при первом обращении)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(self._render_child(_format_labels(self.labelnames, values), values, child))
+        return lines
+
+    def _render_child(self, labels: str, values: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, labels, values, child):
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ("_lock", "_bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        # Последний элемент — наблюдения больше всех границ (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self._bounds, value)
+        lock = self._lock
+        lock.acquire()
+        try:
+            self.counts[index] += 1
+            self.sum += value
+        finally:
+            lock.release()
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, labels, values, child):
+        counts, total = child.snapshot()
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(names, values + (_format_value(bound),))} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Значения, которые считываются только при опросе /metrics (gauge или counter)"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: Iterable[str],
+                 collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            for values, value in self.collect():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, tuple(values))} "
+                             f"{_format_value(value)}")
+        except Exception as e:
+            logger.error(f"Ошибка при сборе метрики {self.name}: {e}")
+        return lines
+
+
+class Registry:
+    """Набор метрик, отдаваемых одним текстом"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge_callback(self, name: str, help_text: str, labelnames: Iterable[str],
+                       collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help_text, "gauge", labelnames, collect))
+
+    def counter_callback(self, name: str, help_text: str, labelnames: Iterable[str],
+                         collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help_text, "counter", labelnames, collect))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+DEPENDENCY_LATENCY = REGISTRY.histogram(
+    "smile_dependency_latency_seconds",
+    "Latency of calls to external dependencies",
+    ("dependency", "operation"))
+DEPENDENCY_ERRORS = REGISTRY.counter(
+    "smile_dependency_errors_total",
+    "Failed calls to external dependencies",
+    ("dependency", "operation"))
+SUPPORT_MODE_SWITCHES = REGISTRY.counter(
+    "smile_support_mode_switches_total",
+    "Support mode switches by target mode and reason",
+    ("mode", "reason"))
+PUSH_NOTIFICATIONS = REGISTRY.counter(
+    "smile_push_notifications_total",
+    "Push notifications by outcome (sent, failed, invalid_token)",
+    ("outcome",))
+
+
+class _Track:
+    __slots__ = ("_dependency", "_latency", "_errors", "_started", "failed")
+
+    def __init__(self, dependency: str, operation: str):
+        self._dependency = dependency
+        labels = (dependency, operation)
+        self._latency = DEPENDENCY_LATENCY.labels(*labels)
+        self._errors = DEPENDENCY_ERRORS.labels(*labels)
+        self.failed = False
+
+    def fail(self):
+        """Помечает вызов как неудачный без исключения"""
+        self.failed = True
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        self._latency.observe(elapsed)
+        record_span(self._dependency, elapsed)
+        if exc_type is not None or self.failed:
+            self._errors.inc()
+        return False
+
+
+class _NoTrack:
+    __slots__ = ()
+
+    def fail(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_TRACK = _NoTrack()
+
+
+def track(dependency: str, operation: str):
+    """Контекстный менеджер: задержка вызова и ошибка при исключении или fail()"""
+    if not _INSTRUMENTED:
+        return _NO_TRACK
+    return _Track(dependency, operation)
+
+
+def observe(dependency: str, operation: str, seconds: float, failed: bool = False):
+    """Записывает уже измеренный вызов (когда его границы не совпадают с блоком кода)"""
+    if not _INSTRUMENTED:
+        return
+    DEPENDENCY_LATENCY.labels(dependency, operation).observe(seconds)
+    record_span(dependency, seconds)
+    if failed:
+        DEPENDENCY_ERRORS.labels(dependency, operation).inc()
+
+
+# Флаг ошибки текущего вызова timed: его ставит mark_failed() в перехваченной ошибке
+_call_failed: ContextVar[bool] = ContextVar("smile_call_failed", default=False)
+
+
+def mark_failed():
+    """Помечает текущий вызов timed как неудачный (ошибка перехвачена и не выброшена)"""
+    _call_failed.set(True)
+
+
+def timed(dependency: str, operation: Optional[str] = None,
+          failed: Optional[Callable[[object], bool]] = None):
+    """
+    Декоратор: задержка каждого вызова функции (операция по умолчанию — имя функции).
+
+    Ошибкой считается исключение, вызов mark_failed() внутри функции (для методов,
+    которые сами перехватывают ошибки и возвращают значение по умолчанию) или
+    результат, для которого failed(result) истинно.
+    """
+    def decorator(func):
+        if not _INSTRUMENTED:
+            return func
+        labels = (dependency, operation or func.__name__)
+        latency = DEPENDENCY_LATENCY.labels(*labels)
+        errors = DEPENDENCY_ERRORS.labels(*labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Свой флаг на каждый вызов: ошибка вложенного вызова не считается ошибкой внешнего
+            token = _call_failed.set(False)
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                elapsed = time.perf_counter() - started
+                latency.observe(elapsed)
+                record_span(dependency, elapsed)
+                errors.inc()
+                raise
+            finally:
+                marked = _call_failed.get()
+                _call_failed.reset(token)
+            elapsed = time.perf_counter() - started
+            latency.observe(elapsed)
+            record_span(dependency, elapsed)
+            if marked or (failed is not None and failed(result)):
+                errors.inc()
+            return result
+        return wrapper
+    return decorator
+
+
+def failed_result(result) -> bool:
+    """None или False — неудачный вызов (так отвечают методы TelegramBot)"""
+    return result is None or result is False
@@ -1,9 +1,24 @@
 import requests
+import json
 import logging
-from typing import List, Dict, Optional
-from config import OPENROUTER_API_KEY, OPENROUTER_MODEL, OPENROUTER_BASE_URL
+import math
+import queue
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+from config import (OPENROUTER_API_KEY, OPENROUTER_MODELS, OPENROUTER_BASE_URL,
+                    OPENROUTER_TIMEOUT_SECONDS, AI_HEDGE_AFTER_MS, AI_BREAKER_FAILURE_THRESHOLD,
+                    AI_BREAKER_LATENCY_P95_SECONDS, AI_BREAKER_OPEN_SECONDS,
+                    AI_MAX_CONCURRENT_REQUESTS, AI_BULKHEAD_WAIT_SECONDS,
+                    HANDOFF_CLASSIFIER_ENABLED, HANDOFF_CLASSIFIER_MODEL,
+                    HANDOFF_CLASSIFIER_TIMEOUT_SECONDS)
+from resilience import CircuitBreaker, Bulkhead, CLOSED
+from metrics import observe
+from logging_setup import SAMPLED
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Keywords that trigger human support request
@@ -29,12 +44,166 @@ SYSTEM_PROMPT = """Вы - дружелюбный и полезный AI-асси
 
 Вы - ассистент компании Smile. Отвечайте кратко и по делу."""
 
+# Prompt for the handoff classifier that runs alongside the answer
+HANDOFF_CLASSIFIER_PROMPT = """Вы решаете, нужно ли передать диалог службы поддержки живому оператору.
+Оператор нужен, если пользователь просит человека, жалуется или раздражен, вопрос касается
+его личных данных, оплаты, возврата денег или проблемы, которую ассистент не может решить.
+Ответьте одним словом: HUMAN, если нужен оператор, иначе AI."""
+
+# Returned by _request_completion when the caller cancelled it
+_CANCELLED = object()
+
+
+class _ModelAttempt:
+    """One streamed completion request to one model"""
+    
+    def __init__(self, model: str):
+        self.model = model
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self.response = None
+        self.text = None
+        self.first_token_seconds = None
+        self.total_seconds = None
+        self.failed = False
+        self.finished = False
+    
+    @property
+    def live(self) -> bool:
+        return not (self.finished or self.failed or self.cancelled.is_set())
+    
+    def cancel(self):
+        """Stop the attempt; shutting the socket down unblocks a thread waiting for the stream"""
+        self.cancelled.set()
+        response = self.response
+        if response is None:
+            return
+        try:
+            # response.close() alone waits for the streaming thread's pending read
+            # (until the next chunk); after shutdown that read fails at once
+            with socket.fromfd(response.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            response.close()
+        except Exception:
+            pass
+
+
+class Cancellation:
+    """Lets another thread cancel an in-flight completion"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+        self.finished = False
+    
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def finish(self) -> bool:
+        """Marks the completion as done; False if it was cancelled first"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.finished = True
+            return True
+    
+    def cancel(self):
+        with self._lock:
+            # A finished completion is no longer in flight
+            if self.cancelled or self.finished:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class ModelStats:
+    """Per-model attempts, wins and latency of hedged requests"""
+    
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._models: Dict[str, Dict] = {}
+    
+    def record(self, attempts: List[_ModelAttempt], winner: Optional[_ModelAttempt]):
+        with self._lock:
+            for attempt in attempts:
+                stats = self._models.get(attempt.model)
+                if stats is None:
+                    stats = {"attempts": 0, "wins": 0, "failures": 0, "cancelled": 0,
+                             "first_token": deque(maxlen=self._window), "total": deque(maxlen=self._window)}
+                    self._models[attempt.model] = stats
+                stats["attempts"] += 1
+                if attempt is winner and attempt.text is not None:
+                    stats["wins"] += 1
+                    stats["total"].append(attempt.total_seconds)
+                elif attempt.failed:
+                    stats["failures"] += 1
+                elif attempt.cancelled.is_set():
+                    stats["cancelled"] += 1
+                if attempt.first_token_seconds is not None:
+                    stats["first_token"].append(attempt.first_token_seconds)
+    
+    @staticmethod
+    def _percentile_ms(values, fraction: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[max(0, math.ceil(len(ordered) * fraction) - 1)] * 1000, 1)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                model: {
+                    "attempts": stats["attempts"],
+                    "wins": stats["wins"],
+                    "win_rate": round(stats["wins"] / stats["attempts"], 4) if stats["attempts"] else 0.0,
+                    "failures": stats["failures"],
+                    "cancelled": stats["cancelled"],
+                    "first_token_p50_ms": self._percentile_ms(stats["first_token"], 0.5),
+                    "first_token_p95_ms": self._percentile_ms(stats["first_token"], 0.95),
+                    "total_p95_ms": self._percentile_ms(stats["total"], 0.95),
+                }
+                for model, stats in self._models.items()
+            }
+
 
 class OpenRouterAI:
     def __init__(self):
         self.api_key = OPENROUTER_API_KEY
-        self.model = OPENROUTER_MODEL
+        # Ordered fallback chain; the first model is the primary
+        self.models = OPENROUTER_MODELS
+        self.hedge_after = AI_HEDGE_AFTER_MS / 1000.0
         self.base_url = OPENROUTER_BASE_URL
+        self.timeout = OPENROUTER_TIMEOUT_SECONDS
+        # Fail fast while OpenRouter is down or slow instead of holding request threads
+        self.breaker = CircuitBreaker("OpenRouter",
+                                      failure_threshold=AI_BREAKER_FAILURE_THRESHOLD,
+                                      latency_threshold=AI_BREAKER_LATENCY_P95_SECONDS,
+                                      open_seconds=AI_BREAKER_OPEN_SECONDS)
+        self.bulkhead = Bulkhead("OpenRouter", max_concurrent=AI_MAX_CONCURRENT_REQUESTS)
+        self.model_stats = ModelStats()
+        self.classifier_enabled = HANDOFF_CLASSIFIER_ENABLED
+        self.classifier_model = HANDOFF_CLASSIFIER_MODEL
+        self._classifier_lock = threading.Lock()
+        self.classifier_stats = {"calls": 0, "handoffs": 0, "errors": 0, "skipped": 0,
+                                 "cancelled_completions": 0, "latency": deque(maxlen=500)}
+        self._executor = ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENT_REQUESTS * len(self.models),
+                                            thread_name_prefix="openrouter")
+        # At most one classifier call per completion slot, in its own pool so it never
+        # queues behind or delays the hedged attempts
+        self.classifier_bulkhead = Bulkhead("Handoff classifier", max_concurrent=AI_MAX_CONCURRENT_REQUESTS)
+        self._classifier_executor = ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENT_REQUESTS,
+                                                       thread_name_prefix="handoff-classifier")
         
     def is_human_support_requested(self, message: str) -> bool:
         """Check if user is requesting human support"""
@@ -44,62 +213,307 @@ class OpenRouterAI:
                 return True
         return False
     
-    def get_ai_response(self, user_message: str, conversation_history: Optional[List[Dict]] = None) -> Optional[str]:
+    def answer_or_handoff(self, user_message: str,
+                          conversation_history: Optional[List[Dict]] = None) -> Tuple[Optional[str], bool]:
+        """
+        AI reply with the handoff classifier running alongside it.
+        
+        Returns (reply, False), or (None, True) when the classifier asked for an operator
+        before the reply was ready; the in-flight completion is cancelled then. A verdict
+        that arrives after the reply is finished is ignored.
+        """
+        if not self.classifier_enabled or not self.api_key:
+            return self.get_ai_response(user_message, conversation_history), False
+        
+        cancellation = Cancellation()
+        
+        def classify():
+            try:
+                if self.classify_handoff(user_message, conversation_history):
+                    cancellation.cancel()
+            finally:
+                self.classifier_bulkhead.release()
+        
+        # While OpenRouter is degraded or the classifier slots are taken the answer
+        # and the keyword check decide alone
+        if self.breaker.state == CLOSED and self.classifier_bulkhead.acquire():
+            self._classifier_executor.submit(classify)
+        else:
+            self._count_classifier("skipped")
+        ai_message = self.get_ai_response(user_message, conversation_history, cancellation)
+        if cancellation.cancelled:
+            if ai_message is None:
+                self._count_classifier("cancelled_completions")
+            return None, True
+        return ai_message, False
+    
+    def _count_classifier(self, name: str):
+        with self._classifier_lock:
+            self.classifier_stats[name] += 1
+    
+    def classify_handoff(self, user_message: str, conversation_history: Optional[List[Dict]] = None) -> bool:
+        """Short completion of a small model: does this conversation need an operator?"""
+        started = time.monotonic()
+        failed = False
+        self._count_classifier("calls")
+        try:
+            messages = [{"role": "system", "content": HANDOFF_CLASSIFIER_PROMPT}]
+            for msg in (conversation_history or [])[-4:]:
+                role = "user" if msg.get("direction") == "user" else "assistant"
+                if msg.get("message"):
+                    messages.append({"role": role, "content": msg["message"]})
+            messages.append({"role": "user", "content": user_message})
+            
+            response = requests.post(
+                f"{self.base_url}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                    "HTTP-Referer": "https://smile-support.com",
+                    "X-Title": "Smile Support Bot"
+                },
+                json={
+                    "model": self.classifier_model,
+                    "messages": messages,
+                    "max_tokens": 2,
+                    "temperature": 0
+                },
+                timeout=HANDOFF_CLASSIFIER_TIMEOUT_SECONDS
+            )
+            response.raise_for_status()
+            verdict = response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+            handoff = verdict.strip().upper().startswith("HUMAN")
+            if handoff:
+                self._count_classifier("handoffs")
+                logger.info("Handoff classifier asked for an operator")
+            return handoff
+        except Exception as e:
+            # Without a verdict the answer and the keyword check decide as before
+            failed = True
+            self._count_classifier("errors")
+            logger.error(f"Handoff classifier error: {e}")
+            return False
+        finally:
+            with self._classifier_lock:
+                self.classifier_stats["latency"].append(time.monotonic() - started)
+            observe("openrouter", "classify_handoff", time.monotonic() - started, failed)
+    
+    def get_ai_response(self, user_message: str, conversation_history: Optional[List[Dict]] = None,
+                        cancellation: Optional[Cancellation] = None) -> Optional[str]:
         """Get AI response from OpenRouter"""
         if not self.api_key:
             logger.error("OpenRouter API key not configured")
             return None
         
+        if not self.bulkhead.acquire(timeout=AI_BULKHEAD_WAIT_SECONDS):
+            logger.warning(f"OpenRouter: {self.bulkhead.max_concurrent} requests already in flight, skipping AI")
+            return None
         try:
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-            
-            # Add conversation history for context (last 10 messages)
-            if conversation_history:
-                for msg in conversation_history[-10:]:
-                    role = "user" if msg.get("direction") == "user" else "assistant"
-                    content = msg.get("message", "")
-                    if content:
-                        messages.append({"role": role, "content": content})
-            
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://smile-support.com",
-                "X-Title": "Smile Support Bot"
-            }
-            
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": 1000,
-                "temperature": 0.7
-            }
+            if not self.breaker.allow_request():
+                logger.warning("OpenRouter circuit breaker is open, skipping AI")
+                return None
             
+            started = time.monotonic()
+            ai_message = self._request_completion(user_message, conversation_history, cancellation)
+            if ai_message is _CANCELLED:
+                # Not a verdict on OpenRouter health
+                self.breaker.release()
+                return None
+            if ai_message is None:
+                self.breaker.record_failure(time.monotonic() - started)
+            else:
+                self.breaker.record_success(time.monotonic() - started)
+            return ai_message
+        finally:
+            self.bulkhead.release()
+    
+    def _build_messages(self, user_message: str,
+                        conversation_history: Optional[List[Dict]] = None) -> List[Dict]:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        
+        # Add conversation history for context (last 10 messages)
+        if conversation_history:
+            for msg in conversation_history[-10:]:
+                role = "user" if msg.get("direction") == "user" else "assistant"
+                content = msg.get("message", "")
+                if content:
+                    messages.append({"role": role, "content": content})
+        
+        # Add current user message
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
+    def _request_completion(self, user_message: str, conversation_history: Optional[List[Dict]] = None,
+                            cancellation: Optional[Cancellation] = None):
+        """
+        Hedged completion over the model chain.
+        
+        The first model is asked right away. Whenever no attempt has produced its first
+        token within hedge_after (or the running ones failed), the next model is asked
+        too. The first attempt to stream a token wins and the others are cancelled.
+        Returns the reply, None on failure or _CANCELLED when cancellation fired.
+        """
+        messages = self._build_messages(user_message, conversation_history)
+        events = queue.Queue()
+        attempts: List[_ModelAttempt] = []
+        next_models = iter(self.models)
+        started = time.monotonic()
+        deadline = started + self.timeout
+        winner = None
+        
+        def launch() -> bool:
+            model = next(next_models, None)
+            if model is None:
+                return False
+            attempt = _ModelAttempt(model)
+            attempts.append(attempt)
+            self._executor.submit(self._stream_attempt, attempt, messages, events)
+            return True
+        
+        if cancellation is not None:
+            cancellation.on_cancel(lambda: events.put(("cancelled", None)))
+        
+        models_left = launch()
+        next_hedge_at = started + self.hedge_after
+        try:
+            while True:
+                now = time.monotonic()
+                wait_until = deadline
+                if winner is None and models_left:
+                    wait_until = min(deadline, next_hedge_at)
+                try:
+                    kind, attempt = events.get(timeout=max(0.0, wait_until - now))
+                except queue.Empty:
+                    if time.monotonic() >= deadline:
+                        logger.error("OpenRouter API timeout")
+                        return None
+                    # No first token within the budget: hedge with the next model
+                    logger.info("No first token from %s within %.0f ms, hedging",
+                                ", ".join(a.model for a in attempts if a.live), self.hedge_after * 1000)
+                    models_left = launch()
+                    next_hedge_at = time.monotonic() + self.hedge_after
+                    continue
+                
+                if kind == "cancelled":
+                    winner = None
+                    return _CANCELLED
+                if kind == "first_token" and winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other is not winner:
+                            other.cancel()
+                elif kind == "done" and winner in (None, attempt):
+                    if cancellation is not None and not cancellation.finish():
+                        return _CANCELLED
+                    logger.info("AI response generated successfully (%s)", attempt.model, extra=SAMPLED)
+                    return attempt.text
+                elif kind == "error":
+                    if attempt is winner:
+                        return None
+                    if winner is None and not any(a.live for a in attempts):
+                        # Everything in flight failed: fall back to the next model right away
+                        models_left = launch()
+                        next_hedge_at = time.monotonic() + self.hedge_after
+                        if not models_left:
+                            return None
+        finally:
+            # Includes a winner still streaming when the deadline expired: its thread
+            # and connection are released instead of running on after the caller left
+            for attempt in attempts:
+                if not attempt.finished:
+                    attempt.cancel()
+            self.model_stats.record(attempts, winner)
+    
+    def _stream_attempt(self, attempt: "_ModelAttempt", messages: List[Dict], events: "queue.Queue"):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://smile-support.com",
+            "X-Title": "Smile Support Bot"
+        }
+        
+        data = {
+            "model": attempt.model,
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.7,
+            "stream": True
+        }
+        
+        try:
             response = requests.post(
                 f"{self.base_url}/chat/completions",
                 headers=headers,
                 json=data,
-                timeout=30
+                timeout=self.timeout,
+                stream=True
             )
+            attempt.response = response
+            if attempt.cancelled.is_set():
+                response.close()
+                return
+            
+            if response.status_code != 200:
+                raise RuntimeError(f"{response.status_code} - {response.text}")
+            
+            # text/event-stream usually comes without a charset and requests would
+            # decode it as ISO-8859-1; SSE is always UTF-8
+            response.encoding = "utf-8"
+            parts = []
+            for line in response.iter_lines(decode_unicode=True):
+                if attempt.cancelled.is_set():
+                    return
+                # Server-sent events; lines starting with ':' are keep-alive comments
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"].get("message", chunk["error"]))
+                content = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+                if content:
+                    if not parts:
+                        attempt.first_token_seconds = time.monotonic() - attempt.started
+                        events.put(("first_token", attempt))
+                    parts.append(content)
+            
+            if attempt.cancelled.is_set():
+                return
+            if not parts:
+                raise RuntimeError("empty response")
+            attempt.text = "".join(parts)
+            attempt.total_seconds = time.monotonic() - attempt.started
+            observe("openrouter", "chat_completion", attempt.total_seconds)
+            events.put(("done", attempt))
             
-            if response.status_code == 200:
-                result = response.json()
-                ai_message = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-                logger.info(f"AI response generated successfully")
-                return ai_message
-            else:
-                logger.error(f"OpenRouter API error: {response.status_code} - {response.text}")
-                return None
-                
-        except requests.exceptions.Timeout:
-            logger.error("OpenRouter API timeout")
-            return None
         except Exception as e:
-            logger.error(f"Error getting AI response: {e}")
-            return None
+            if attempt.cancelled.is_set():
+                return
+            attempt.failed = True
+            observe("openrouter", "chat_completion", time.monotonic() - attempt.started, failed=True)
+            logger.error(f"OpenRouter API error ({attempt.model}): {e}")
+            events.put(("error", attempt))
+        finally:
+            attempt.finished = True
+            if attempt.response is not None:
+                attempt.response.close()
+    
+    def stats(self) -> Dict:
+        return {
+            "breaker": self.breaker.stats(),
+            "bulkhead": self.bulkhead.stats(),
+            "models": self.model_stats.stats(),
+            "handoff_classifier": self._classifier_stats()
+        }
+    
+    def _classifier_stats(self) -> Dict:
+        with self._classifier_lock:
+            stats = dict(self.classifier_stats)
+            latencies = sorted(stats.pop("latency"))
+        stats["p95_ms"] = ModelStats._percentile_ms(latencies, 0.95)
+        return stats
     
     def get_human_transfer_message(self) -> str:
         """Message to show when transferring to human support"""
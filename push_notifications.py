@@ -5,9 +5,10 @@
 import logging
 from typing import List, Dict, Optional
 import os
-from config import FCM_SERVICE_ACCOUNT_PATH
+from config import FCM_SERVICE_ACCOUNT_PATH, FCM_API_BASE
+from metrics import track, PUSH_NOTIFICATIONS
+from logging_setup import SAMPLED
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Инициализация Firebase Admin SDK
@@ -18,6 +19,12 @@ try:
     from firebase_admin import credentials, messaging
     from firebase_admin.exceptions import FirebaseError
     
+    if FCM_API_BASE:
+        # Локальная заглушка FCM для нагрузочных тестов: в SDK нет параметра для адреса
+        messaging._MessagingService.FCM_URL = f"{FCM_API_BASE}/v1/projects/{{0}}/messages:send"
+        messaging._MessagingService.FCM_BATCH_URL = f"{FCM_API_BASE}/batch"
+        logger.warning(f"FCM запросы отправляются на {FCM_API_BASE}")
+    
     # Инициализация Firebase Admin SDK
     if not firebase_admin._apps:
         if os.path.exists(FCM_SERVICE_ACCOUNT_PATH):
@@ -71,17 +78,18 @@ class PushNotificationService:
         """
         if not self.initialized:
             logger.error("Firebase Admin SDK не инициализирован")
-            return {"success": False, "error": "Firebase Admin SDK не инициализирован", "sent": 0, "failed": 0, "errors": []}
+            return {"success": False, "error": "Firebase Admin SDK не инициализирован", "sent": 0, "failed": 0, "errors": [], "invalid_tokens": []}
         
         if not tokens:
             logger.warning("Список токенов пуст")
-            return {"success": False, "error": "Нет токенов для отправки", "sent": 0, "failed": 0, "errors": []}
+            return {"success": False, "error": "Нет токенов для отправки", "sent": 0, "failed": 0, "errors": [], "invalid_tokens": []}
         
         results = {
             "success": True,
             "sent": 0,
             "failed": 0,
-            "errors": []
+            "errors": [],
+            "invalid_tokens": []  # Токены, которые нужно удалить из БД
         }
         
         # Если один токен, используем send, иначе send_multicast
@@ -111,14 +119,16 @@ class PushNotificationService:
                     ),
                 )
                 
-                response = messaging.send(message)
+                with track("fcm", "send"):
+                    response = messaging.send(message)
                 results["sent"] = 1
-                logger.info(f"Push уведомление отправлено на устройство {tokens[0][:20]}...")
+                logger.info("Push уведомление отправлено на устройство %s...", tokens[0][:20], extra=SAMPLED)
                 logger.debug(f"Response: {response}")
                 
             except messaging.UnregisteredError:
                 results["failed"] = 1
                 results["errors"].append(f"Token {tokens[0][:20]}...: недействителен (UnregisteredError)")
+                results["invalid_tokens"].append(tokens[0])
                 logger.warning(f"Токен {tokens[0][:20]}... недействителен и должен быть удален из БД")
             except FirebaseError as e:
                 results["failed"] = 1
@@ -154,11 +164,13 @@ class PushNotificationService:
                     ),
                 )
                 
-                response = messaging.send_multicast(multicast_message)
+                with track("fcm", "send_multicast"):
+                    response = messaging.send_multicast(multicast_message)
                 results["sent"] = response.success_count
                 results["failed"] = response.failure_count
                 
-                logger.info(f"Push уведомления отправлены: успешно={response.success_count}, ошибок={response.failure_count}")
+                logger.info("Push уведомления отправлены: успешно=%d, ошибок=%d",
+                            response.success_count, response.failure_count, extra=SAMPLED)
                 
                 # Обрабатываем ошибки
                 if response.failure_count > 0:
@@ -169,8 +181,9 @@ class PushNotificationService:
                             error_msg = str(error) if error else "Unknown error"
                             results["errors"].append(f"Token {token[:20]}...: {error_msg}")
                             
-                            # Если токен недействителен, логируем для удаления
+                            # Если токен недействителен, возвращаем его для удаления из БД
                             if isinstance(error, messaging.UnregisteredError):
+                                results["invalid_tokens"].append(token)
                                 logger.warning(f"Токен {token[:20]}... недействителен и должен быть удален из БД")
                 
             except FirebaseError as e:
@@ -185,6 +198,10 @@ class PushNotificationService:
         if results["failed"] > 0:
             results["success"] = False
         
+        PUSH_NOTIFICATIONS.labels("sent").inc(results["sent"])
+        PUSH_NOTIFICATIONS.labels("failed").inc(results["failed"])
+        PUSH_NOTIFICATIONS.labels("invalid_token").inc(len(results["invalid_tokens"]))
+        
         return results
     
     def send_support_reply_notification(self, tokens: List[str], message: str, user_id: str):
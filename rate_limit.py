@@ -0,0 +1,185 @@
+"""
+Ограничение частоты запросов (token bucket) по пользователю и IP.
+
+Ведро на каждый ключ пополняется со скоростью rate токенов в секунду до burst;
+запрос забирает один токен, а при пустом ведре получает время до появления
+следующего (для Retry-After). В памяти одного процесса проверка занимает доли
+микросекунды: словарь, монотонные часы и одна блокировка. Полные ведра ничем не
+отличаются от отсутствующих, поэтому давно не используемые ключи периодически
+удаляются.
+
+При нескольких репликах общий лимит дает Redis-бэкенд: то же ведро хранится в
+хеше Redis и обновляется Lua-скриптом атомарно (один запрос к Redis на проверку).
+Скорость 0 отключает лимит.
+"""
+import logging
+import math
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def _check_limits(name: str, rate: float, burst: float):
+    if rate <= 0:
+        raise ValueError(f"Лимит {name}: скорость должна быть больше 0 (0 отключает лимит)")
+    if burst < 1:
+        raise ValueError(f"Лимит {name}: запас должен быть не меньше 1")
+
+
+class UnlimitedLimiter:
+    """Отключенный лимит: пропускает все запросы"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def acquire(self, key: str) -> float:
+        return 0.0
+
+    def stats(self) -> Dict:
+        return {"disabled": True}
+
+
+class TokenBucketLimiter:
+    """Token bucket по ключу в памяти процесса"""
+
+    __slots__ = ("name", "rate", "burst", "sweep_seconds", "_lock", "_buckets", "_next_sweep",
+                 "allowed", "limited")
+
+    def __init__(self, name: str, rate: float, burst: float, sweep_seconds: float = 60):
+        _check_limits(name, rate, burst)
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.sweep_seconds = sweep_seconds
+
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, list] = {}  # ключ -> [токены, время последнего пополнения]
+        self._next_sweep = time.monotonic() + sweep_seconds
+
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, key: str, _monotonic=time.monotonic) -> float:
+        """0, если запрос разрешен, иначе через сколько секунд появится токен"""
+        now = _monotonic()
+        # Горячий путь: __slots__, локальные имена и явные acquire/release дешевле with
+        lock = self._lock
+        lock.acquire()
+        try:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if now >= self._next_sweep:
+                    self._sweep(now)
+                self._buckets[key] = [self.burst - 1, now]
+                self.allowed += 1
+                return 0.0
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                self.allowed += 1
+                return 0.0
+            bucket[0] = tokens
+            self.limited += 1
+            return (1 - tokens) / self.rate
+        finally:
+            lock.release()
+
+    def _sweep(self, now: float):
+        # Ведро, не тронутое дольше времени полного пополнения, уже полное
+        idle = self.burst / self.rate
+        stale = [key for key, bucket in self._buckets.items() if now - bucket[1] >= idle]
+        for key in stale:
+            del self._buckets[key]
+        self._next_sweep = now + self.sweep_seconds
+
+    def stats(self) -> Dict:
+        return {"keys": len(self._buckets), "allowed": self.allowed, "limited": self.limited}
+
+
+# KEYS[1] — хеш ведра; ARGV: rate, burst, now (с). Возвращает 0 или мс до токена
+_REDIS_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait_ms = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait_ms = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return wait_ms
+"""
+
+
+class RedisTokenBucketLimiter:
+    """Token bucket по ключу, общий для всех реплик через Redis"""
+
+    def __init__(self, name: str, rate: float, burst: float, url: str, prefix: str = "smile"):
+        _check_limits(name, rate, burst)
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.prefix = f"{prefix}:ratelimit:{name}"
+        self._redis = redis.Redis.from_url(url)
+        self._script = self._redis.register_script(_REDIS_BUCKET_SCRIPT)
+
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+
+    def acquire(self, key: str) -> float:
+        try:
+            wait_ms = self._script(keys=[f"{self.prefix}:{key}"], args=[self.rate, self.burst, time.time()])
+        except Exception as e:
+            # Недоступный Redis не должен останавливать прием сообщений
+            self.errors += 1
+            logger.error(f"Ошибка лимита {self.name} в Redis, запрос пропущен без проверки: {e}")
+            return 0.0
+        if wait_ms:
+            self.limited += 1
+            return wait_ms / 1000.0
+        self.allowed += 1
+        return 0.0
+
+    def stats(self) -> Dict:
+        return {"allowed": self.allowed, "limited": self.limited, "errors": self.errors}
+
+
+def create_rate_limiter(name: str, rate: float, burst: float, kind: str = "memory",
+                        url: str = "", prefix: str = "smile"):
+    """Лимитер выбранного бэкенда; без пакета redis — в памяти, при rate <= 0 — без лимита"""
+    if rate <= 0:
+        return UnlimitedLimiter(name)
+    if kind == "redis":
+        if redis is None:
+            logger.error("Пакет redis не установлен, лимиты запросов считаются в памяти процесса")
+        else:
+            return RedisTokenBucketLimiter(name, rate, burst, url, prefix)
+    return TokenBucketLimiter(name, rate, burst)
+
+
+def retry_after_header(seconds: float) -> str:
+    """Значение Retry-After: целое число секунд, не меньше 1"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,354 @@
+"""
+Бэкенд присутствия (presence) и межпроцессной рассылки событий для Socket.IO.
+
+In-memory реализация подходит для одного процесса. Redis-реализация (подходит любой
+Redis-совместимый сервер: Redis, Valkey, KeyDB) позволяет запускать несколько
+воркеров/реплик server.py, которые обслуживают одних и тех же пользователей:
+- Socket.IO получает message_queue, поэтому socketio.emit(..., room=user_id)
+  доходит до сокета на любой реплике;
+- присутствие пользователей хранится в Redis: для каждого пользователя sorted set
+  воркеров, у которых он онлайн, со временем истечения в score. Воркер продлевает
+  свои записи каждые PRESENCE_TTL_SECONDS / 3, поэтому записи упавшего воркера
+  перестают учитываться через PRESENCE_TTL_SECONDS;
+- publish/subscribe позволяет репликам обмениваться служебными событиями
+  (событие доставляется всем воркерам, кроме отправителя).
+
+Ошибка Redis не прерывает запрос: присутствие проверяется по сокетам этого воркера,
+событие не рассылается, а heartbeat восстановит записи, когда Redis вернется.
+Подписки обслуживает один поток-слушатель: после разрыва соединения он с паузой
+переподключается и заново подписывается на все каналы.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Set
+from urllib.parse import urlsplit
+from config import REALTIME_BACKEND, REDIS_URL, REDIS_CHANNEL_PREFIX, PRESENCE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def redact_url(url: str) -> str:
+    """Адрес Redis для логов: без логина и пароля"""
+    parts = urlsplit(url)
+    if parts.password is None and parts.username is None:
+        return url
+    return parts._replace(netloc=f"***@{parts.hostname or ''}{f':{parts.port}' if parts.port else ''}").geturl()
+
+
+class PresenceRegistry:
+    """
+    Потокобезопасный реестр сокетов пользователей.
+    
+    Хранит прямой индекс user_id -> множество sid и обратный sid -> множество user_id,
+    поэтому join, leave и disconnect выполняются за O(1) на каждую пару (user_id, sid).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sids_by_user: Dict[str, Set[str]] = {}
+        self._users_by_sid: Dict[str, Set[str]] = {}
+
+    def join(self, user_id: str, sid: str) -> bool:
+        """Добавляет сокет в чат пользователя, возвращает True если пользователь стал онлайн"""
+        with self._lock:
+            sids = self._sids_by_user.get(user_id)
+            became_online = sids is None
+            if became_online:
+                sids = self._sids_by_user[user_id] = set()
+            sids.add(sid)
+            self._users_by_sid.setdefault(sid, set()).add(user_id)
+            return became_online
+
+    def leave(self, user_id: str, sid: str) -> bool:
+        """Убирает сокет из чата пользователя, возвращает True если пользователь стал офлайн"""
+        with self._lock:
+            return self._unlink(user_id, sid)
+
+    def disconnect(self, sid: str) -> List[str]:
+        """Убирает сокет из всех чатов, возвращает список затронутых user_id"""
+        with self._lock:
+            user_ids = list(self._users_by_sid.get(sid, ()))
+            for user_id in user_ids:
+                self._unlink(user_id, sid)
+            return user_ids
+
+    def _unlink(self, user_id: str, sid: str) -> bool:
+        users = self._users_by_sid.get(sid)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._users_by_sid[sid]
+
+        sids = self._sids_by_user.get(user_id)
+        if sids is None:
+            return False
+        sids.discard(sid)
+        if not sids:
+            del self._sids_by_user[user_id]
+            return True
+        return False
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self._sids_by_user
+
+    def sids(self, user_id: str) -> Set[str]:
+        with self._lock:
+            return set(self._sids_by_user.get(user_id, ()))
+
+    def user_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._sids_by_user)
+
+    @property
+    def online_users(self) -> int:
+        return len(self._sids_by_user)
+
+    @property
+    def sockets(self) -> int:
+        return len(self._users_by_sid)
+
+    def stats(self) -> Dict:
+        return {"online_users": self.online_users, "sockets": self.sockets}
+
+
+class InMemoryBackend:
+    """Присутствие и события в памяти текущего процесса (один воркер)"""
+
+    name = "memory"
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.presence = PresenceRegistry()
+
+    def socketio_options(self) -> Dict:
+        """Дополнительные параметры для SocketIO (client_manager по умолчанию)"""
+        return {}
+
+    def add_connection(self, user_id: str, sid: str):
+        self.presence.join(user_id, sid)
+
+    def remove_connection(self, user_id: str, sid: str):
+        self.presence.leave(user_id, sid)
+
+    def remove_sid(self, sid: str) -> List[str]:
+        """Удаляет сокет из всех чатов, возвращает список затронутых user_id"""
+        return self.presence.disconnect(sid)
+
+    def is_online(self, user_id: str) -> bool:
+        return self.presence.is_online(user_id)
+
+    def stats(self) -> Dict:
+        return self.presence.stats()
+
+    def publish(self, channel: str, payload: Dict):
+        # Других воркеров нет: локальные сокеты обслуживает стандартный client_manager
+        pass
+
+    def subscribe(self, channel: str, callback: Callable[[Dict], None]):
+        pass
+
+    def close(self):
+        pass
+
+
+class RedisBackend:
+    """Общие присутствие и события через Redis-совместимый сервер (несколько реплик)"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "smile", presence_ttl: float = 30):
+        if redis is None:
+            raise RuntimeError("Пакет redis не установлен. Установите: pip install redis")
+
+        self.url = url
+        self.prefix = prefix
+        self.presence_ttl = presence_ttl
+        self.worker_id = uuid.uuid4().hex
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        # Сокеты этого воркера: обратный индекс sid -> user_id без запросов к Redis
+        self.presence = PresenceRegistry()
+        self._listener = None
+        self._callbacks: Dict[str, List[Callable[[Dict], None]]] = {}
+        # Каналы, на которые слушатель еще не подписался (pubsub трогает только его поток)
+        self._new_channels: Set[str] = set()
+        self._lock = threading.Lock()
+        self.listener_reconnects = 0
+        self.redis_errors = 0
+
+        self._redis.ping()
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True, name="presence-heartbeat")
+        self._heartbeat.start()
+        logger.info(f"Realtime бэкенд Redis подключен: {redact_url(url)} (worker {self.worker_id[:8]})")
+
+    def _user_key(self, user_id: str) -> str:
+        return f"{self.prefix}:presence:user:{user_id}"
+
+    def _redis_failed(self, action: str, e: Exception):
+        self.redis_errors += 1
+        logger.error(f"Ошибка Redis ({action}), продолжаем без Redis: {e}")
+
+    def _mark_online(self, pipe, user_id: str, now: float):
+        key = self._user_key(user_id)
+        pipe.zadd(key, {self.worker_id: now + self.presence_ttl})
+        pipe.expire(key, int(self.presence_ttl) + 1)
+
+    def _mark_offline(self, user_ids: List[str]):
+        try:
+            pipe = self._redis.pipeline()
+            for user_id in user_ids:
+                pipe.zrem(self._user_key(user_id), self.worker_id)
+            pipe.execute()
+        except redis.RedisError as e:
+            # Запись истечет сама через presence_ttl
+            self._redis_failed("снятие присутствия", e)
+
+    def _heartbeat_loop(self):
+        """Продлевает записи присутствия пользователей, подключенных к этому воркеру"""
+        while not self._stopped.wait(self.presence_ttl / 3):
+            user_ids = self.presence.user_ids()
+            if not user_ids:
+                continue
+            try:
+                now = time.time()
+                pipe = self._redis.pipeline(transaction=False)
+                for user_id in user_ids:
+                    self._mark_online(pipe, user_id, now)
+                pipe.execute()
+            except redis.RedisError as e:
+                self._redis_failed("heartbeat", e)
+
+    def _channel(self, channel: str) -> str:
+        return f"{self.prefix}:events:{channel}"
+
+    def socketio_options(self) -> Dict:
+        """Подключает Socket.IO к общей очереди сообщений (RedisManager)"""
+        return {
+            "message_queue": self.url,
+            "channel": f"{self.prefix}:socketio",
+        }
+
+    def add_connection(self, user_id: str, sid: str):
+        if not self.presence.join(user_id, sid):
+            return
+        try:
+            pipe = self._redis.pipeline()
+            self._mark_online(pipe, user_id, time.time())
+            pipe.execute()
+        except redis.RedisError as e:
+            # Следующий heartbeat добавит запись
+            self._redis_failed("добавление присутствия", e)
+
+    def remove_connection(self, user_id: str, sid: str):
+        if self.presence.leave(user_id, sid):
+            self._mark_offline([user_id])
+
+    def remove_sid(self, sid: str) -> List[str]:
+        """Удаляет сокет из всех чатов, возвращает список затронутых user_id"""
+        user_ids = self.presence.disconnect(sid)
+        offline = [user_id for user_id in user_ids if not self.presence.is_online(user_id)]
+        if offline:
+            self._mark_offline(offline)
+        return user_ids
+
+    def is_online(self, user_id: str) -> bool:
+        if self.presence.is_online(user_id):
+            return True
+        try:
+            # Учитываются только непросроченные записи воркеров
+            return self._redis.zcount(self._user_key(user_id), time.time(), "+inf") > 0
+        except redis.RedisError as e:
+            self._redis_failed("проверка присутствия", e)
+            return False
+
+    def stats(self) -> Dict:
+        """Счетчики сокетов этого воркера"""
+        return {**self.presence.stats(), "redis_errors": self.redis_errors,
+                "listener_reconnects": self.listener_reconnects}
+
+    def publish(self, channel: str, payload: Dict):
+        """Отправляет событие остальным воркерам (свои сообщения не обрабатываются)"""
+        message = json.dumps({"origin": self.worker_id, "payload": payload})
+        try:
+            self._redis.publish(self._channel(channel), message)
+        except redis.RedisError as e:
+            self._redis_failed(f"публикация в {channel}", e)
+
+    def _dispatch(self, message):
+        try:
+            data = json.loads(message["data"])
+            if data.get("origin") == self.worker_id:
+                return
+            for callback in list(self._callbacks.get(message["channel"], [])):
+                callback(data["payload"])
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике канала {message.get('channel')}: {e}")
+
+    def subscribe(self, channel: str, callback: Callable[[Dict], None]):
+        with self._lock:
+            name = self._channel(channel)
+            if name not in self._callbacks:
+                self._new_channels.add(name)
+            self._callbacks.setdefault(name, []).append(callback)
+            # Слушатель запускается один раз и подписывается на новые каналы сам
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen_loop, daemon=True, name="realtime-listener")
+                self._listener.start()
+
+    def _listen_loop(self):
+        """Читает события всех каналов; при ошибке Redis переподключается с паузой"""
+        backoff = 0.5
+        while not self._stopped.is_set():
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                with self._lock:
+                    self._new_channels.clear()
+                    channels = list(self._callbacks)
+                pubsub.subscribe(*channels)
+                while not self._stopped.is_set():
+                    with self._lock:
+                        new_channels, self._new_channels = self._new_channels, set()
+                    if new_channels:
+                        pubsub.subscribe(*new_channels)
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self._dispatch(message)
+                    backoff = 0.5
+            except redis.RedisError as e:
+                self.listener_reconnects += 1
+                self._redis_failed("подписка на события", e)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, 10)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.join(2)
+        user_ids = self.presence.user_ids()
+        if user_ids:
+            self._mark_offline(user_ids)
+        self._redis.close()
+
+
+def create_realtime_backend(kind: str = REALTIME_BACKEND):
+    """Создает бэкенд по имени из конфигурации ('memory' или 'redis')"""
+    if kind == "redis":
+        return RedisBackend(REDIS_URL, prefix=REDIS_CHANNEL_PREFIX, presence_ttl=PRESENCE_TTL_SECONDS)
+    if kind != "memory":
+        logger.warning(f"Неизвестный REALTIME_BACKEND '{kind}', используется memory")
+    return InMemoryBackend()
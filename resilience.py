@@ -0,0 +1,154 @@
+"""
+Защита от медленного внешнего сервиса: circuit breaker и bulkhead.
+
+CircuitBreaker размыкается после failure_threshold ошибок подряд или когда p95
+задержки последних вызовов превышает latency_threshold. Пока он разомкнут, вызовы
+сразу отклоняются; через open_seconds пропускается один пробный вызов (half-open):
+успех замыкает цепь, ошибка снова размыкает ее.
+
+Bulkhead ограничивает число одновременных вызовов, чтобы зависший сервис не занял
+все потоки сервера.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Размыкатель по ошибкам подряд и по p95 задержки"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, latency_threshold: Optional[float] = None,
+                 open_seconds: float = 30, latency_window: int = 50, min_latency_samples: int = 10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.min_latency_samples = min_latency_samples
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._latencies = deque(maxlen=latency_window)
+
+        self.opened_count = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        """True, если вызов можно выполнить; в half-open пропускает один пробный вызов"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._state = HALF_OPEN
+                logger.info(f"{self.name}: пробный вызов после {self.open_seconds:.0f} с размыкания")
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Отменяет разрешение, если вызов так и не был выполнен"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self._probe_in_flight = False
+            self._consecutive_failures = 0
+            if self._state == HALF_OPEN:
+                self._state = CLOSED
+                self._latencies.clear()
+                logger.info(f"{self.name}: сервис восстановился, цепь замкнута")
+                return
+            self._latencies.append(seconds)
+            p95 = self._p95()
+            if self.latency_threshold is not None and p95 is not None and p95 > self.latency_threshold:
+                self._open(f"p95 задержки {p95:.1f} с > {self.latency_threshold:.1f} с")
+
+    def record_failure(self, seconds: float):
+        with self._lock:
+            self._probe_in_flight = False
+            self._consecutive_failures += 1
+            self._latencies.append(seconds)
+            if self._state == HALF_OPEN:
+                self._open("пробный вызов не удался")
+            elif self._state == CLOSED and self._consecutive_failures >= self.failure_threshold:
+                self._open(f"{self._consecutive_failures} ошибок подряд")
+
+    def _open(self, reason: str):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._latencies.clear()
+        self.opened_count += 1
+        logger.warning(f"{self.name}: цепь разомкнута на {self.open_seconds:.0f} с ({reason})")
+
+    def _p95(self) -> Optional[float]:
+        if len(self._latencies) < self.min_latency_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[math.ceil(len(latencies) * 0.95) - 1]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            p95 = self._p95()
+            return {
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "opened_count": self.opened_count,
+                "rejected": self.rejected,
+            }
+
+
+class Bulkhead:
+    """Ограничение числа одновременных вызовов"""
+
+    def __init__(self, name: str, max_concurrent: int = 8):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """Занимает место; False, если за timeout секунд место не освободилось"""
+        acquired = self._semaphore.acquire(timeout=timeout) if timeout > 0 \
+            else self._semaphore.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrent": self.max_concurrent,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,351 @@
+"""
+Хранение старых данных: архивирование сообщений и уплотнение БД.
+
+Сообщения старше archive_after_days переносятся из messages в месячные файлы
+messages_YYYY_MM.db (по дате created_at). Индекс архивов (месяц, диапазон id)
+хранится в основной БД в таблице message_archives; при чтении истории нужный
+архив подключается через ATTACH только тогда, когда основной таблицы не хватает.
+
+Перенос идет пачками: сначала строки копируются в архив (INSERT OR IGNORE) и
+архив фиксируется, затем одной транзакцией основной БД удаляются и отмечаются
+в индексе. Сбой между шагами оставляет только дубликаты, которые следующий
+запуск перезапишет.
+
+У каждого архива свой полнотекстовый индекс messages_fts (как в основной БД):
+удаление из messages убирает строки из основного индекса, а копия в архиве
+индексируется триггером, поэтому /search находит и архивные сообщения.
+
+В периоды затишья (нет новых сообщений quiet_seconds) освобожденные страницы
+возвращаются через PRAGMA incremental_vacuum, а WAL сбрасывается wal_checkpoint.
+Полный VACUUM блокирует базу на все время перезаписи, поэтому здесь он не
+выполняется: базу, созданную без auto_vacuum, переводят командой
+shard_tool.py vacuum при остановленном сервере.
+"""
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_ARCHIVE_COLUMNS = "id, user_id, message_text, photo_url, direction, telegram_message_id, created_at"
+
+
+class MessageArchive:
+    """Месячные файлы архива сообщений рядом с основной БД"""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def path_for(self, month: str) -> str:
+        return os.path.join(self.archive_dir, f"messages_{month}.db")
+
+    def select(self, conn: sqlite3.Connection, month: str, sql: str,
+               params: Union[tuple, Dict]) -> List[sqlite3.Row]:
+        """Выполняет запрос к archive.messages, подключив архив месяца на время запроса"""
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS archive", (self.path_for(month),))
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.execute("DETACH DATABASE archive")
+
+    def select_before(self, conn: sqlite3.Connection, user_id: str, before_id: int,
+                      limit: int) -> List[sqlite3.Row]:
+        """До limit архивных сообщений пользователя с id < before_id, от старых к новым"""
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT month, max_id FROM message_archives
+            WHERE min_id < ?
+            ORDER BY max_id DESC
+        ''', (before_id,))
+
+        collected: List[sqlite3.Row] = []
+        for archive in cursor.fetchall():
+            if len(collected) >= limit and archive["max_id"] < collected[-1]["id"]:
+                break
+            rows = self.select(conn, archive["month"], f'''
+                SELECT {_ARCHIVE_COLUMNS} FROM archive.messages
+                WHERE user_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (user_id, before_id, limit))
+            collected = sorted(collected + rows, key=lambda row: row["id"], reverse=True)[:limit]
+
+        return collected[::-1]
+
+    def select_after(self, conn: sqlite3.Connection, user_id: str, after_id: int,
+                     limit: int) -> List[sqlite3.Row]:
+        """До limit архивных сообщений пользователя с id > after_id, от старых к новым"""
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT month, min_id FROM message_archives
+            WHERE max_id > ?
+            ORDER BY min_id ASC
+        ''', (after_id,))
+
+        collected: List[sqlite3.Row] = []
+        for archive in cursor.fetchall():
+            if len(collected) >= limit and archive["min_id"] > collected[-1]["id"]:
+                break
+            rows = self.select(conn, archive["month"], f'''
+                SELECT {_ARCHIVE_COLUMNS} FROM archive.messages
+                WHERE user_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (user_id, after_id, limit))
+            collected = sorted(collected + rows, key=lambda row: row["id"])[:limit]
+
+        return collected
+
+
+class RetentionManager:
+    """Периодическое архивирование, очистка связей и уплотнение БД"""
+
+    def __init__(self, db, archive: Optional[MessageArchive], archive_after_days: int = 180,
+                 mapping_retention_days: int = 30, quiet_seconds: float = 300,
+                 vacuum_pages: int = 1000, batch_size: int = 1000):
+        self.db = db
+        self.archive = archive
+        self.archive_after_days = archive_after_days
+        self.mapping_retention_days = mapping_retention_days
+        self.quiet_seconds = quiet_seconds
+        self.vacuum_pages = vacuum_pages
+        self.batch_size = batch_size
+
+        self.last_run: Dict = {}
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        # Явные транзакции: ATTACH и VACUUM нельзя выполнять внутри неявной транзакции
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def archive_messages(self) -> int:
+        """Переносит сообщения старше archive_after_days в месячные архивы"""
+        if self.archive is None:
+            # MESSAGE_ARCHIVE_DIR пуст: архив отключен, сообщения остаются в базе
+            return 0
+        # Id уникальны и между шардами, поэтому архивы у шардов общие
+        return sum(self._archive_file(path) for path in self.db.user_paths())
+
+    def _archive_file(self, db_path: str) -> int:
+        conn = self._connect(db_path)
+        try:
+            cursor = conn.cursor()
+
+            # Граница по id: id растет вместе с created_at, а индекса по дате нет
+            cursor.execute('''
+                SELECT id FROM messages
+                WHERE created_at >= DATETIME('now', ?)
+                ORDER BY id ASC
+                LIMIT 1
+            ''', (f"-{self.archive_after_days} days",))
+            row = cursor.fetchone()
+            if row is not None:
+                boundary = row["id"]
+            else:
+                cursor.execute("SELECT MAX(id) AS max_id FROM messages")
+                max_id = cursor.fetchone()["max_id"]
+                if max_id is None:
+                    return 0
+                boundary = max_id + 1
+
+            archived = 0
+            while True:
+                cursor.execute('''
+                    SELECT MIN(id) AS low, MAX(id) AS high FROM (
+                        SELECT id FROM messages
+                        WHERE id < ?
+                        ORDER BY id ASC
+                        LIMIT ?
+                    )
+                ''', (boundary, self.batch_size))
+                batch = cursor.fetchone()
+                if batch["low"] is None:
+                    break
+                archived += self._archive_batch(cursor, batch["low"], batch["high"])
+
+            if archived:
+                logger.info(f"В архив перенесено {archived} сообщений старше {self.archive_after_days} дней "
+                            f"из {os.path.basename(db_path)}")
+            return archived
+        finally:
+            conn.close()
+
+    def _archive_batch(self, cursor: sqlite3.Cursor, low: int, high: int) -> int:
+        cursor.execute('''
+            SELECT STRFTIME('%Y_%m', created_at) AS month, MIN(id) AS min_id,
+                   MAX(id) AS max_id, COUNT(*) AS row_count
+            FROM messages
+            WHERE id BETWEEN ? AND ?
+            GROUP BY month
+        ''', (low, high))
+        months = cursor.fetchall()
+
+        # Шаг 1: копия в архив каждого месяца (повтор после сбоя безопасен)
+        for month in months:
+            cursor.execute("ATTACH DATABASE ? AS archive", (self.archive.path_for(month["month"]),))
+            try:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS archive.messages (
+                        id INTEGER PRIMARY KEY,
+                        user_id TEXT NOT NULL,
+                        message_text TEXT,
+                        photo_url TEXT,
+                        direction TEXT NOT NULL,
+                        telegram_message_id INTEGER,
+                        created_at TIMESTAMP
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS archive.idx_messages_user_id_id
+                    ON messages (user_id, id)
+                ''')
+                if self.db.search_enabled:
+                    self.db._init_search_index(cursor, "archive")
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO archive.messages ({_ARCHIVE_COLUMNS})
+                    SELECT {_ARCHIVE_COLUMNS} FROM main.messages
+                    WHERE id BETWEEN ? AND ? AND STRFTIME('%Y_%m', created_at) = ?
+                ''', (month["min_id"], month["max_id"], month["month"]))
+            finally:
+                cursor.execute("DETACH DATABASE archive")
+
+        # Шаг 2: удаление из основной БД и запись в индекс архивов одной транзакцией
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for month in months:
+                cursor.execute('''
+                    INSERT INTO message_archives (month, min_id, max_id, row_count)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(month) DO UPDATE SET
+                        min_id = MIN(min_id, excluded.min_id),
+                        max_id = MAX(max_id, excluded.max_id),
+                        row_count = row_count + excluded.row_count,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (month["month"], month["min_id"], month["max_id"], month["row_count"]))
+            cursor.execute("DELETE FROM messages WHERE id BETWEEN ? AND ?", (low, high))
+            deleted = cursor.rowcount
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+        return deleted
+
+    def index_archives(self) -> int:
+        """Создает поисковый индекс в архивах, записанных до его появления; возвращает их число"""
+        if self.archive is None or not self.db.search_enabled:
+            return 0
+        months = set()
+        for path in self.db.user_paths():
+            conn = self._connect(path)
+            try:
+                months.update(row["month"] for row in conn.execute("SELECT month FROM message_archives"))
+            finally:
+                conn.close()
+
+        indexed = 0
+        conn = self._connect(self.db.db_path)
+        try:
+            cursor = conn.cursor()
+            for month in sorted(months):
+                cursor.execute("ATTACH DATABASE ? AS archive", (self.archive.path_for(month),))
+                try:
+                    cursor.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'messages_fts'")
+                    if cursor.fetchone() is None:
+                        self.db._init_search_index(cursor, "archive")
+                        indexed += 1
+                        logger.info(f"Архив {month} проиндексирован для поиска")
+                finally:
+                    cursor.execute("DETACH DATABASE archive")
+        finally:
+            conn.close()
+        return indexed
+
+    def is_quiet(self) -> bool:
+        """True, если последнее сообщение было не меньше quiet_seconds назад"""
+        for path in self.db.user_paths():
+            conn = self._connect(path)
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT (JULIANDAY('now') - JULIANDAY(created_at)) * 86400 AS idle_seconds
+                    FROM messages
+                    ORDER BY id DESC
+                    LIMIT 1
+                ''')
+                row = cursor.fetchone()
+                if row is not None and row["idle_seconds"] < self.quiet_seconds:
+                    return False
+            finally:
+                conn.close()
+        return True
+
+    def compact(self) -> Dict:
+        """Возвращает свободные страницы файлам БД и сбрасывает WAL"""
+        result = {"pages_freed": 0, "freelist_pages": 0}
+        for path in self.db.all_paths():
+            compacted = self._compact_file(path)
+            result["pages_freed"] += compacted.pop("pages_freed")
+            result["freelist_pages"] += compacted.pop("freelist_pages")
+            if compacted:
+                result.setdefault("files", {})[os.path.basename(path)] = compacted
+        return result
+
+    def _compact_file(self, db_path: str) -> Dict:
+        conn = self._connect(db_path)
+        try:
+            cursor = conn.cursor()
+            result = {}
+
+            auto_vacuum = cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if auto_vacuum == 1:
+                # FULL -> INCREMENTAL переключается без перезаписи файла
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            elif auto_vacuum == 0:
+                # Без auto_vacuum страницы не освобождаются, а включение требует полного VACUUM
+                result["auto_vacuum"] = "none"
+                logger.warning(f"{os.path.basename(db_path)}: auto_vacuum не INCREMENTAL, "
+                               f"выполните python shard_tool.py vacuum при остановленном сервере")
+
+            free_before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            cursor.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})").fetchall()
+            free_after = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            result["pages_freed"] = free_before - free_after
+            result["freelist_pages"] = free_after
+
+            journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            if journal_mode.lower() == "wal":
+                busy, wal_pages, checkpointed = cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                result["wal_checkpoint"] = {"busy": bool(busy), "log": wal_pages, "checkpointed": checkpointed}
+
+            return result
+        finally:
+            conn.close()
+
+    def run_once(self) -> Dict:
+        """Один проход: архив, очистка связей и, если тихо, уплотнение"""
+        started = time.monotonic()
+        result = {
+            "archived_messages": self.archive_messages(),
+            "pruned_mappings": self.db.prune_message_mappings(self.mapping_retention_days),
+            "pruned_updates": self.db.prune_telegram_updates(self.mapping_retention_days),
+            "indexed_archives": self.index_archives(),
+            "compacted": False,
+        }
+        if self.is_quiet():
+            result.update(self.compact())
+            result["compacted"] = True
+
+        result["seconds"] = round(time.monotonic() - started, 2)
+        self.last_run = result
+        return result
+
+    def stats(self) -> Dict:
+        return {"last_run": self.last_run}
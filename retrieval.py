@@ -0,0 +1,287 @@
+"""
+Локальный поиск похожих вопросов (BM25 на NumPy) и FAQ-уровень ответов AI.
+
+RetrievalIndex хранит постинги каждого терма в растущих массивах NumPy, поэтому
+добавление документа стоит O(его длины), а запрос — O(постингов слов запроса)
+без перестроения индекса. Кандидаты по BM25 переранжируются косинусной мерой
+TF-IDF, которая служит уверенностью совпадения (0..1).
+
+FaqTier отвечает на типовые вопросы без обращения к OpenRouter: из FAQ-файла и из
+ответов операторов, которые дословно давались нескольким разным пользователям
+(шаблонные ответы без персональных данных).
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logger.error("numpy не установлен, локальный поиск ответов отключен. Установите: pip install numpy")
+
+_TOKEN_RE = re.compile(r"\w+")
+# Слова длиннее обрезаются: грубая замена стемминга для русских окончаний
+_STEM_LENGTH = 6
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return [token[:_STEM_LENGTH] for token in _TOKEN_RE.findall(text.casefold())]
+
+
+def normalize_text(text: str) -> str:
+    """Ключ для сравнения ответов: без регистра и лишних пробелов"""
+    return " ".join(text.casefold().split())
+
+
+class _GrowableArray:
+    """Массив NumPy с удвоением емкости: добавление за амортизированное O(1)"""
+
+    __slots__ = ("_buffer", "size")
+
+    def __init__(self, dtype, capacity: int = 4):
+        self._buffer = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self._buffer):
+            grown = np.empty(len(self._buffer) * 2, dtype=self._buffer.dtype)
+            grown[:self.size] = self._buffer
+            self._buffer = grown
+        self._buffer[self.size] = value
+        self.size += 1
+
+    def view(self):
+        return self._buffer[:self.size]
+
+
+class RetrievalIndex:
+    """BM25-индекс коротких текстов с пополнением по одному документу"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, candidates: int = 10):
+        self.k1 = k1
+        self.b = b
+        self.candidates = candidates
+
+        self._lock = threading.Lock()
+        self._postings: Dict[str, tuple] = {}  # терм -> (id документов, частоты)
+        self._doc_lengths = _GrowableArray(np.float32) if np is not None else None
+        self._doc_terms: List[Counter] = []
+        self._payloads: List[Any] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def add(self, text: str, payload: Any) -> bool:
+        """Добавляет документ; False, если в тексте нет слов"""
+        terms = Counter(tokenize(text))
+        if not terms:
+            return False
+        with self._lock:
+            doc_id = len(self._payloads)
+            for term, count in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = (_GrowableArray(np.int32), _GrowableArray(np.float32))
+                    self._postings[term] = postings
+                postings[0].append(doc_id)
+                postings[1].append(count)
+            length = sum(terms.values())
+            self._doc_lengths.append(length)
+            self._total_length += length
+            self._doc_terms.append(terms)
+            self._payloads.append(payload)
+        return True
+
+    def _idf(self, term: str, total_docs: int) -> float:
+        postings = self._postings.get(term)
+        frequency = postings[0].size if postings is not None else 0
+        return math.log(1 + (total_docs - frequency + 0.5) / (frequency + 0.5))
+
+    def _weights(self, terms: Counter, total_docs: int) -> Dict[str, float]:
+        return {term: (1 + math.log(count)) * self._idf(term, total_docs) for term, count in terms.items()}
+
+    def search(self, text: str, k: int = 3) -> List[Dict]:
+        """До k документов: {"confidence", "score", "payload"}, лучшие первыми"""
+        query = Counter(tokenize(text))
+        if not query:
+            return []
+        with self._lock:
+            total_docs = len(self._payloads)
+            if total_docs == 0:
+                return []
+
+            doc_lengths = self._doc_lengths.view()
+            average_length = self._total_length / total_docs
+            scores = np.zeros(total_docs, dtype=np.float32)
+            for term in query:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                doc_ids, frequencies = postings[0].view(), postings[1].view()
+                norm = self.k1 * (1 - self.b + self.b * doc_lengths[doc_ids] / average_length)
+                scores[doc_ids] += self._idf(term, total_docs) * frequencies * (self.k1 + 1) / (frequencies + norm)
+
+            count = min(max(k, self.candidates), total_docs)
+            top = np.argpartition(-scores, count - 1)[:count]
+            top = [int(doc_id) for doc_id in top if scores[doc_id] > 0]
+
+            # Уверенность: косинус TF-IDF векторов запроса и документа
+            query_weights = self._weights(query, total_docs)
+            query_norm = math.sqrt(sum(weight * weight for weight in query_weights.values()))
+            results = []
+            for doc_id in top:
+                doc_weights = self._weights(self._doc_terms[doc_id], total_docs)
+                doc_norm = math.sqrt(sum(weight * weight for weight in doc_weights.values()))
+                dot = sum(weight * doc_weights.get(term, 0.0) for term, weight in query_weights.items())
+                results.append({
+                    "confidence": dot / (query_norm * doc_norm) if query_norm and doc_norm else 0.0,
+                    "score": float(scores[doc_id]),
+                    "payload": self._payloads[doc_id],
+                })
+
+        results.sort(key=lambda result: result["confidence"], reverse=True)
+        return results[:k]
+
+
+class TierStats:
+    """Доля попаданий и задержка по уровням ответа (faq, llm)"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._tiers: Dict[str, Dict] = {}
+
+    def record(self, tier: str, hit: bool, seconds: float):
+        with self._lock:
+            stats = self._tiers.get(tier)
+            if stats is None:
+                stats = {"requests": 0, "hits": 0, "latencies": deque(maxlen=self._window)}
+                self._tiers[tier] = stats
+            stats["requests"] += 1
+            stats["hits"] += int(hit)
+            stats["latencies"].append(seconds * 1000)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {}
+            for tier, stats in self._tiers.items():
+                latencies = sorted(stats["latencies"])
+                result[tier] = {
+                    "requests": stats["requests"],
+                    "hits": stats["hits"],
+                    "hit_rate": round(stats["hits"] / stats["requests"], 4) if stats["requests"] else 0.0,
+                    "p50_ms": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+                    "p95_ms": round(latencies[max(0, math.ceil(len(latencies) * 0.95) - 1)], 3) if latencies else 0.0,
+                }
+            return result
+
+
+class FaqTier:
+    """Ответы на типовые вопросы из FAQ и повторяющихся ответов операторов"""
+
+    def __init__(self, threshold: float = 0.75, min_operator_users: int = 3,
+                 max_candidates: int = 10000):
+        self.threshold = threshold
+        self.min_operator_users = min_operator_users
+        self.max_candidates = max_candidates
+        self.index = RetrievalIndex() if np is not None else None
+
+        self._lock = threading.Lock()
+        # Нормализованный ответ оператора, еще не ставший шаблоном -> пользователи, которым
+        # он дан, и их вопросы. LRU: редкие персональные ответы вытесняются
+        self._candidates: "OrderedDict[str, Tuple[set, List[str]]]" = OrderedDict()
+        self._promoted: set = set()
+        self.evicted_candidates = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.index is not None
+
+    def load_faq(self, path: str) -> int:
+        """Загружает FAQ: [{"questions": [...], "answer": "..."}]"""
+        if not self.enabled:
+            return 0
+        if not os.path.exists(path):
+            logger.info(f"Файл FAQ {path} не найден, используются только ответы операторов")
+            return 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении FAQ {path}: {e}")
+            return 0
+
+        added = 0
+        for entry in entries:
+            answer = entry.get("answer")
+            for question in entry.get("questions", []):
+                if answer and self.index.add(question, {"answer": answer, "source": "faq"}):
+                    added += 1
+        logger.info(f"Загружено {added} вопросов FAQ из {path}")
+        return added
+
+    def add_operator_reply(self, user_id: str, question: Optional[str], answer: Optional[str]):
+        """Учитывает ответ оператора; в индекс он попадает, когда дан min_operator_users пользователям"""
+        if not self.enabled or not question or not answer:
+            return
+        key = normalize_text(answer)
+        with self._lock:
+            if key in self._promoted:
+                new_questions = [question]
+            else:
+                users, questions = self._candidates.setdefault(key, (set(), []))
+                self._candidates.move_to_end(key)
+                users.add(user_id)
+                if len(questions) < 20:
+                    questions.append(question)
+                if len(users) < self.min_operator_users:
+                    while len(self._candidates) > self.max_candidates:
+                        self._candidates.popitem(last=False)
+                        self.evicted_candidates += 1
+                    return
+                self._promoted.add(key)
+                new_questions = self._candidates.pop(key)[1]
+
+        for new_question in new_questions:
+            self.index.add(new_question, {"answer": answer, "source": "operator"})
+
+    def load_history(self, db, limit: int = 50000) -> int:
+        """Наполняет индекс прошлыми парами вопрос -> ответ оператора"""
+        if not self.enabled:
+            return 0
+        started = time.monotonic()
+        pairs = db.get_operator_reply_pairs(limit)
+        for pair in pairs:
+            self.add_operator_reply(pair["user_id"], pair["question"], pair["answer"])
+        logger.info(f"FAQ: обработано {len(pairs)} ответов операторов за {time.monotonic() - started:.1f} с, "
+                    f"в индексе {len(self.index)} вопросов")
+        return len(pairs)
+
+    def match(self, question: str) -> Optional[Dict]:
+        """Ответ, если похожий вопрос найден с уверенностью не ниже threshold"""
+        if not self.enabled:
+            return None
+        results = self.index.search(question, k=1)
+        if not results or results[0]["confidence"] < self.threshold:
+            return None
+        return {**results[0]["payload"], "confidence": round(results[0]["confidence"], 3)}
+
+    def stats(self) -> Dict:
+        return {
+            "indexed_questions": len(self.index) if self.enabled else 0,
+            "operator_templates": len(self._promoted),
+            "operator_candidates": len(self._candidates),
+            "evicted_candidates": self.evicted_candidates,
+        }
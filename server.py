@@ -1,35 +1,158 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, g, send_from_directory
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, disconnect
 import logging
 import threading
 import time
+import atexit
+import functools
+import hashlib
+import hmac
 import os
 import uuid
 import json
 from werkzeug.utils import secure_filename
 from bot import TelegramBot
 from database import Database
+from cache import RecentMessageCache
+from greetings import GreetingTracker
 from push_notifications import PushNotificationService
 from openrouter_ai import OpenRouterAI
+from realtime_backend import create_realtime_backend
+from leader_election import LeaderLease
+from retention import RetentionManager
+from idempotency import IdempotencyStore, IN_FLIGHT, DONE, MISMATCH
+from rate_limit import create_rate_limiter, retry_after_header
+from resilience import Bulkhead
+from retrieval import FaqTier, TierStats
+from suggestions import ReplySuggester
+from metrics import REGISTRY, SUPPORT_MODE_SWITCHES, CONTENT_TYPE
+from tracing import RequestProfiler, start_trace, end_trace, span, log_trace
+from logging_setup import configure_logging, SAMPLED, stats as logging_stats
 from config import (SERVER_PORT, SERVER_HOST, API_SECRET_KEY, 
                    UPLOAD_FOLDER, ALLOWED_EXTENSIONS, MAX_FILE_SIZE,
-                   HUMAN_SUPPORT_TIMEOUT_MINUTES)
+                   HUMAN_SUPPORT_TIMEOUT_MINUTES, LEADER_LEASE_TTL_SECONDS,
+                   LEADER_HEARTBEAT_SECONDS, TELEGRAM_POLL_TIMEOUT_SECONDS,
+                   REPLAY_LIMIT, MESSAGE_CACHE_ENABLED, MESSAGE_CACHE_PER_USER,
+                   MESSAGE_CACHE_MAX_MESSAGES, DB_CACHE_ENABLED, DB_CACHE_TTL_SECONDS,
+                   DB_CACHE_MAXSIZE, SUPPORT_MODE_SWEEP_INTERVAL_SECONDS,
+                   GREETINGS_RETENTION_DAYS, WRITE_BEHIND_ENABLED, WRITE_BATCH_SIZE,
+                   WRITE_BATCH_MAX_DELAY_MS, WRITE_TIMEOUT_SECONDS, RETENTION_ENABLED,
+                   MESSAGE_ARCHIVE_DIR, MESSAGE_ARCHIVE_AFTER_DAYS, MESSAGE_MAPPING_RETENTION_DAYS,
+                   RETENTION_INTERVAL_SECONDS, RETENTION_QUIET_SECONDS, RETENTION_VACUUM_PAGES,
+                   DB_SHARDS, FAQ_ENABLED, FAQ_PATH, FAQ_CONFIDENCE_THRESHOLD,
+                   FAQ_MIN_OPERATOR_USERS, FAQ_HISTORY_LIMIT, FAQ_MAX_CANDIDATES, SUGGESTIONS_ENABLED,
+                   SUGGESTIONS_COUNT, SUGGESTIONS_MIN_CONFIDENCE, IDEMPOTENCY_TTL_HOURS,
+                   IDEMPOTENCY_WAIT_SECONDS, IDEMPOTENCY_IN_FLIGHT_TIMEOUT_SECONDS,
+                   RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND, RATE_LIMIT_USER_PER_SECOND,
+                   RATE_LIMIT_USER_BURST, RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST,
+                   RATE_LIMIT_TRUST_X_FORWARDED_FOR, SEND_MESSAGE_MAX_CONCURRENT,
+                   METRICS_ENABLED, TRACING_ENABLED, TRACE_LOG_MIN_MS, PROFILE_DIR,
+                   PROFILE_SAMPLE_INTERVAL_MS, REDIS_URL, REDIS_CHANNEL_PREFIX)
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+realtime = create_realtime_backend()
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading',
+                    **realtime.socketio_options())
 
 bot = TelegramBot()
-db = Database()
+db = Database(message_cache=RecentMessageCache(MESSAGE_CACHE_PER_USER, MESSAGE_CACHE_MAX_MESSAGES)
+              if MESSAGE_CACHE_ENABLED else None,
+              cache_enabled=DB_CACHE_ENABLED,
+              cache_ttl_seconds=DB_CACHE_TTL_SECONDS,
+              cache_maxsize=DB_CACHE_MAXSIZE,
+              write_behind=WRITE_BEHIND_ENABLED,
+              write_batch_size=WRITE_BATCH_SIZE,
+              write_max_delay_ms=WRITE_BATCH_MAX_DELAY_MS,
+              write_timeout_seconds=WRITE_TIMEOUT_SECONDS,
+              archive_dir=MESSAGE_ARCHIVE_DIR,
+              shards=DB_SHARDS)
+db.attach_invalidation_bus(realtime)
+greetings = GreetingTracker(db, retention_days=GREETINGS_RETENTION_DAYS)
 push_service = PushNotificationService()
 ai_service = OpenRouterAI()
+poller_lease = LeaderLease(db, "telegram_poller",
+                           ttl_seconds=LEADER_LEASE_TTL_SECONDS,
+                           heartbeat_seconds=LEADER_HEARTBEAT_SECONDS)
+retention = RetentionManager(db, db.archive,
+                             archive_after_days=MESSAGE_ARCHIVE_AFTER_DAYS,
+                             mapping_retention_days=MESSAGE_MAPPING_RETENTION_DAYS,
+                             quiet_seconds=RETENTION_QUIET_SECONDS,
+                             vacuum_pages=RETENTION_VACUUM_PAGES)
+faq = FaqTier(threshold=FAQ_CONFIDENCE_THRESHOLD, min_operator_users=FAQ_MIN_OPERATOR_USERS,
+              max_candidates=FAQ_MAX_CANDIDATES)
+tier_stats = TierStats()
+suggester = ReplySuggester(count=SUGGESTIONS_COUNT, min_confidence=SUGGESTIONS_MIN_CONFIDENCE)
+idempotency = IdempotencyStore(db, ttl_seconds=IDEMPOTENCY_TTL_HOURS * 3600,
+                               in_flight_timeout=IDEMPOTENCY_IN_FLIGHT_TIMEOUT_SECONDS)
+user_limiter = create_rate_limiter("user", RATE_LIMIT_USER_PER_SECOND, RATE_LIMIT_USER_BURST,
+                                   RATE_LIMIT_BACKEND, REDIS_URL, REDIS_CHANNEL_PREFIX)
+ip_limiter = create_rate_limiter("ip", RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST,
+                                 RATE_LIMIT_BACKEND, REDIS_URL, REDIS_CHANNEL_PREFIX)
+send_bulkhead = Bulkhead("send_message", max_concurrent=SEND_MESSAGE_MAX_CONCURRENT)
+profiler = RequestProfiler(PROFILE_DIR, sample_interval=PROFILE_SAMPLE_INTERVAL_MS / 1000.0)
+
+# Read only when /metrics is scraped, nothing is added to the request path
+REGISTRY.gauge_callback(
+    "smile_socketio_connections", "Socket.IO connections and online users on this worker", ("kind",),
+    lambda: [(("sockets",), realtime.stats()["sockets"]), (("online_users",), realtime.stats()["online_users"])])
+REGISTRY.gauge_callback(
+    "smile_in_flight_requests", "Requests currently inside a concurrency limit", ("pool",),
+    lambda: [(("send_message",), send_bulkhead.stats()["in_flight"]),
+             (("openrouter",), ai_service.bulkhead.stats()["in_flight"])])
+REGISTRY.gauge_callback(
+    "smile_write_queue_depth", "Writes waiting for the group-commit writer", (),
+    lambda: [((), db.writer_stats().get("queue_depth", 0))])
+REGISTRY.gauge_callback(
+    "smile_circuit_breaker_open", "1 while the OpenRouter circuit breaker rejects calls", ("name",),
+    lambda: [((ai_service.breaker.name,), 0 if ai_service.breaker.state == "closed" else 1)])
+REGISTRY.counter_callback(
+    "smile_cache_hits_total", "Cache hits by cache", ("cache",),
+    lambda: [((name,), cache["hits"]) for name, cache in db.cache_stats().items()])
+REGISTRY.counter_callback(
+    "smile_cache_misses_total", "Cache misses by cache", ("cache",),
+    lambda: [((name,), cache["misses"]) for name, cache in db.cache_stats().items()])
+REGISTRY.counter_callback(
+    "smile_log_records_dropped_total", "Log records not written: queue full (dropped) or sampled out (suppressed)",
+    ("reason",), lambda: [((reason,), logging_stats().get(reason, 0)) for reason in ("dropped", "suppressed")])
+REGISTRY.counter_callback(
+    "smile_answer_tier_requests_total", "Questions that reached an answer tier (faq, llm)", ("tier", "result"),
+    lambda: [row for tier, item in tier_stats.stats().items()
+             for row in (((tier, "hit"), item["hits"]), ((tier, "miss"), item["requests"] - item["hits"]))])
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-active_connections = {}
+
+
+@app.before_request
+def begin_request_trace():
+    if TRACING_ENABLED:
+        g.trace = start_trace()
+    g.profile = profiler.start(request.endpoint)
+
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.get('trace')
+    if trace is not None:
+        total = trace.elapsed()
+        response.headers['Server-Timing'] = trace.server_timing(total)
+        if total * 1000 >= TRACE_LOG_MIN_MS:
+            log_trace(trace, total, method=request.method, endpoint=request.endpoint,
+                      status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def close_request_trace(exc):
+    if g.pop('trace', None) is not None:
+        end_trace()
+    session = g.pop('profile', None)
+    if session is not None:
+        profiler.finish(session, request.endpoint)
 
 
 def allowed_file(filename):
@@ -37,80 +160,350 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def require_api_key(view):
+    """Operator-only endpoint: the X-API-Key header must match API_SECRET_KEY"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not API_SECRET_KEY:
+            return jsonify({"error": "API_SECRET_KEY не задан, эндпоинт отключен"}), 403
+        api_key = request.headers.get('X-API-Key', '')
+        if not hmac.compare_digest(api_key.encode(), API_SECRET_KEY.encode()):
+            return jsonify({"error": "Неверный API ключ"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def too_many_requests(retry_after):
+    response = jsonify({"error": "Слишком много запросов, повторите позже"})
+    response.status_code = 429
+    response.headers['Retry-After'] = retry_after_header(retry_after)
+    return response
+
+
+def request_user_id():
+    """user_id from the JSON body or the form, before the view validates it"""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        return data.get("user_id") if isinstance(data, dict) else None
+    return request.form.get("user_id")
+
+
+def request_fingerprint():
+    """Hash of the request content; multipart boundaries do not change it between retries"""
+    digest = hashlib.sha256()
+    if request.is_json:
+        digest.update(json.dumps(request.get_json(silent=True), sort_keys=True, ensure_ascii=False).encode())
+        return digest.hexdigest()
+    for name, value in sorted(request.form.items(multi=True)):
+        digest.update(f"{name}={value}\0".encode())
+    for name, file in sorted(request.files.items(multi=True), key=lambda item: (item[0], item[1].filename or "")):
+        digest.update(f"{name}:{file.filename}\0".encode())
+        for chunk in iter(lambda: file.stream.read(65536), b""):
+            digest.update(chunk)
+        file.stream.seek(0)
+    return digest.hexdigest()
+
+
+def rate_limited(view):
+    """Token buckets per IP and user_id plus a global cap on concurrent requests (429 + Retry-After)"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not RATE_LIMIT_ENABLED:
+            return view(*args, **kwargs)
+        
+        ip = request.access_route[0] if RATE_LIMIT_TRUST_X_FORWARDED_FOR else request.remote_addr
+        wait = ip_limiter.acquire(ip or "")
+        if not wait:
+            user_id = request_user_id()
+            if user_id:
+                wait = user_limiter.acquire(str(user_id))
+        if wait:
+            return too_many_requests(wait)
+        
+        if not send_bulkhead.acquire():
+            return too_many_requests(1)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            send_bulkhead.release()
+    return wrapper
+
+
+def idempotent(view):
+    """Replay the stored response for a repeated Idempotency-Key instead of running the view again"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({"error": "Idempotency-Key длиннее 255 символов"}), 400
+        # Scoped to the caller: another user's key never replays this user's response
+        key = f"{request.endpoint}:{request_user_id() or ''}:{client_key}"
+        fingerprint = request_fingerprint()
+        
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        state, stored = idempotency.begin(key, fingerprint)
+        while state == IN_FLIGHT:
+            # The first request is still running (possibly on another replica)
+            if not idempotency.wait(key, deadline - time.monotonic()):
+                return jsonify({"error": "Запрос с этим Idempotency-Key еще выполняется"}), 409
+            state, stored = idempotency.begin(key, fingerprint)
+        
+        if state == MISMATCH:
+            return jsonify({"error": "Idempotency-Key уже использован для другого запроса"}), 422
+        
+        if state == DONE:
+            response = make_response(stored["body"], stored["status"])
+            response.mimetype = stored["mimetype"] or "application/json"
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        owner = stored
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency.abandon(key, owner)
+            raise
+        # Server errors are not stored: a retry should get another chance
+        if response.status_code >= 500:
+            idempotency.abandon(key, owner)
+        else:
+            idempotency.complete(key, owner, response.status_code, response.get_data(as_text=True),
+                                 response.mimetype)
+        return response
+    return wrapper
+
+
+def emit_new_message(user_id, message_id, message_text, direction, **extra):
+    """Emit new_message to the user's room; id lets the client resume after a reconnect"""
+    if not realtime.is_online(user_id):
+        return
+    
+    try:
+        socketio.emit('new_message', {
+            'id': message_id,
+            'user_id': user_id,
+            'message': message_text,
+            **extra,
+            'direction': direction,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+        }, room=user_id)
+    except Exception as e:
+        # The message is already saved: a broken message queue must not fail the request,
+        # the client picks the message up from /message_history on reconnect
+        logger.error(f"Ошибка отправки new_message пользователю {user_id}: {e}")
+
+
+def prune_invalid_tokens(user_id, results):
+    """Drop device tokens that FCM reported as unregistered"""
+    if results and isinstance(results, dict) and results.get("invalid_tokens"):
+        db.delete_device_tokens(user_id, results["invalid_tokens"])
+
+
+def handle_telegram_update(update):
+    callback_query = update.get("callback_query")
+    if callback_query:
+        handle_suggestion_callback(callback_query)
+        return
+    
+    message = update.get("message")
+    if not message:
+        return
+    
+    reply_to_message = message.get("reply_to_message")
+    if reply_to_message:
+        replied_message_id = reply_to_message.get("message_id")
+        user_id = db.get_user_by_telegram_message(replied_message_id)
+        
+        if user_id:
+            reply_text = message.get("text", "")
+            if reply_text:
+                deliver_operator_reply(user_id, reply_text, message.get("message_id"))
+        else:
+            logger.warning(f"Не найден user_id для message_id {replied_message_id}")
+
+
+def deliver_operator_reply(user_id, reply_text, telegram_message_id):
+    """Save an operator reply from the Telegram group and deliver it to the user"""
+    message_id = db.save_message(
+        user_id=user_id,
+        message_text=reply_text,
+        photo_url=None,
+        direction="support",
+        telegram_message_id=telegram_message_id
+    )
+    
+    tokens = db.get_device_tokens(user_id)
+    
+    if not tokens:
+        logger.warning(f"Для пользователя {user_id} нет зарегистрированных устройств")
+    else:
+        logger.info("Найдено %d устройств для пользователя %s", len(tokens), user_id, extra=SAMPLED)
+    
+    push_data = {
+        "type": "support_reply",
+        "user_id": user_id,
+        "message": reply_text
+    }
+    
+    results = push_service.send_notification(
+        tokens=tokens,
+        title="Ответ от поддержки",
+        body=reply_text,
+        data=push_data
+    )
+    prune_invalid_tokens(user_id, results)
+    
+    logger.info("Ответ отправлен пользователю %s: %s", user_id, reply_text, extra=SAMPLED)
+    
+    emit_new_message(user_id, message_id, reply_text, 'support')
+    
+    if FAQ_ENABLED or SUGGESTIONS_ENABLED:
+        learn_operator_reply(user_id, message_id, reply_text)
+    
+    if results and isinstance(results, dict):
+        sent = results.get('sent', 0)
+        failed = results.get('failed', 0)
+        logger.info("Push уведомления: отправлено=%d, ошибок=%d", sent, failed, extra=SAMPLED)
+        if failed > 0:
+            errors = results.get('errors', [])
+            for error in errors[:3]:
+                logger.error(f"  - {error}")
+    else:
+        logger.warning(f"Неожиданный формат результатов push: {results}")
+
+
+def handle_suggestion_callback(callback_query):
+    """An operator pressed a suggested reply button under a forwarded message"""
+    data = callback_query.get("data") or ""
+    if not data.startswith("suggest:"):
+        return
+    
+    # Callback data comes from Telegram as-is: validate before parsing
+    suggestion_id = data[len("suggest:"):]
+    group_message_id = (callback_query.get("message") or {}).get("message_id")
+    if not (suggestion_id.isascii() and suggestion_id.isdigit()) or not isinstance(group_message_id, int):
+        logger.warning("Некорректная кнопка подсказки: %r", data)
+        bot.answer_callback_query(callback_query["id"], "Подсказка недоступна, ответьте вручную")
+        return
+    
+    # Only an operator reply actually offered under this message may be sent: a forged
+    # callback must not deliver an arbitrary (another user's) message
+    if not db.is_suggestion_offered(group_message_id, int(suggestion_id)):
+        logger.warning("Подсказка %s не предлагалась для сообщения %s", suggestion_id, group_message_id)
+        bot.answer_callback_query(callback_query["id"], "Подсказка недоступна, ответьте вручную")
+        return
+    
+    user_id = db.get_user_by_telegram_message(group_message_id)
+    suggestion = db.get_message(int(suggestion_id))
+    if not user_id or not suggestion or suggestion["direction"] != "support":
+        bot.answer_callback_query(callback_query["id"], "Подсказка устарела, ответьте вручную")
+        return
+    
+    # A double press arrives as two callback queries: only the first one sends the reply
+    if not db.claim_suggestion_reply(group_message_id, suggestion["id"]):
+        bot.answer_callback_query(callback_query["id"], "Ответ на это сообщение уже отправлен")
+        return
+    
+    # The reply is posted in the group too, so other operators see the user was answered
+    reply_text = suggestion["message"]
+    telegram_message_id = bot.send_group_reply(group_message_id, reply_text)
+    if not telegram_message_id:
+        db.release_suggestion_reply(group_message_id)
+        bot.answer_callback_query(callback_query["id"], "Не удалось отправить ответ, попробуйте еще раз")
+        return
+    db.save_message_mapping(user_id, telegram_message_id)
+    
+    operator = (callback_query.get("from") or {}).get("username", "")
+    logger.info("Оператор %s выбрал подсказку %s для пользователя %s", operator, suggestion['id'], user_id)
+    deliver_operator_reply(user_id, reply_text, telegram_message_id)
+    bot.clear_reply_markup(group_message_id)
+    bot.answer_callback_query(callback_query["id"], "Ответ отправлен")
+
+
+def learn_operator_reply(user_id, message_id, reply_text):
+    """Index the operator reply with the user question it answers, here and on other replicas"""
+    history = db.get_message_history(user_id, limit=10)
+    questions = [m["message"] for m in history if m["direction"] == "user" and m["message"]]
+    if not questions:
+        return
+    reply = {"user_id": user_id, "message_id": message_id, "question": questions[-1], "answer": reply_text}
+    index_operator_reply(reply)
+    # Only the poller replica sees operator replies; the others learn them through the bus
+    realtime.publish("operator_reply", reply)
+
+
+def index_operator_reply(reply):
+    if FAQ_ENABLED:
+        faq.add_operator_reply(reply["user_id"], reply["question"], reply["answer"])
+    if SUGGESTIONS_ENABLED:
+        suggester.add(reply["question"], reply["answer"], reply["message_id"])
+
+
+if FAQ_ENABLED or SUGGESTIONS_ENABLED:
+    realtime.subscribe("operator_reply", index_operator_reply)
+
+
+def load_answer_indexes():
+    """Build the FAQ and suggestion indexes in the background from the FAQ file and past replies"""
+    try:
+        if FAQ_ENABLED:
+            faq.load_faq(FAQ_PATH)
+            faq.load_history(db, limit=FAQ_HISTORY_LIMIT)
+        if SUGGESTIONS_ENABLED:
+            suggester.load_history(db, limit=FAQ_HISTORY_LIMIT)
+    except Exception as e:
+        logger.error(f"Ошибка при построении индексов ответов: {e}")
+
+
+def process_telegram_update(update):
+    """
+    Handle one update at most once across replicas.
+    
+    An update that raises is stored as a dead letter (telegram_updates, status 'failed')
+    and skipped, so it cannot block the updates after it.
+    """
+    update_id = update.get("update_id")
+    if not db.claim_telegram_update(update_id):
+        logger.warning(f"Обновление Telegram {update_id} уже обработано, пропуск")
+        return
+    try:
+        handle_telegram_update(update)
+    except Exception as e:
+        logger.error(f"Обновление Telegram {update_id} не обработано и сохранено для разбора: {e}")
+        db.finish_telegram_update(update_id, error=str(e), payload=json.dumps(update, ensure_ascii=False))
+        return
+    db.finish_telegram_update(update_id)
+
+
 def process_telegram_updates():
+    """Poll Telegram getUpdates while this replica holds the poller lease"""
     last_update_id = None
     
     while True:
         try:
-            updates = bot.get_updates(last_update_id)
+            if not poller_lease.is_leader:
+                # Another replica polls; the offset is re-read after failover
+                last_update_id = None
+                poller_lease.wait_for_leadership(timeout=LEADER_HEARTBEAT_SECONDS)
+                continue
+            
+            if last_update_id is None:
+                last_update_id = db.get_telegram_offset()
+            
+            updates = bot.get_updates(last_update_id, timeout=TELEGRAM_POLL_TIMEOUT_SECONDS)
             
             if updates:
                 for update in updates:
-                    update_id = update.get("update_id")
-                    last_update_id = update_id
+                    # Unprocessed updates stay unconfirmed for the next leader
+                    if not poller_lease.is_leader:
+                        break
                     
-                    message = update.get("message")
-                    if not message:
-                        continue
+                    process_telegram_update(update)
                     
-                    reply_to_message = message.get("reply_to_message")
-                    if reply_to_message:
-                        replied_message_id = reply_to_message.get("message_id")
-                        user_id = db.get_user_by_telegram_message(replied_message_id)
-                        
-                        if user_id:
-                            reply_text = message.get("text", "")
-                            if reply_text:
-                                db.save_message(
-                                    user_id=user_id,
-                                    message_text=reply_text,
-                                    photo_url=None,
-                                    direction="support",
-                                    telegram_message_id=message.get("message_id")
-                                )
-                                
-                                tokens = db.get_device_tokens(user_id)
-                                
-                                if not tokens:
-                                    logger.warning(f"Для пользователя {user_id} нет зарегистрированных устройств")
-                                else:
-                                    logger.info(f"Найдено {len(tokens)} устройств для пользователя {user_id}")
-                                
-                                push_data = {
-                                    "type": "support_reply",
-                                    "user_id": user_id,
-                                    "message": reply_text
-                                }
-                                
-                                results = push_service.send_notification(
-                                    tokens=tokens,
-                                    title="Ответ от поддержки",
-                                    body=reply_text,
-                                    data=push_data
-                                )
-                                
-                                logger.info(f"Ответ отправлен пользователю {user_id}: {reply_text}")
-                                
-                                if user_id in active_connections:
-                                    socketio.emit('new_message', {
-                                        'user_id': user_id,
-                                        'message': reply_text,
-                                        'direction': 'support',
-                                        'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-                                    }, room=user_id)
-                                
-                                if results and isinstance(results, dict):
-                                    sent = results.get('sent', 0)
-                                    failed = results.get('failed', 0)
-                                    logger.info(f"Push уведомления: отправлено={sent}, ошибок={failed}")
-                                    if failed > 0:
-                                        errors = results.get('errors', [])
-                                        for error in errors[:3]:
-                                            logger.error(f"  - {error}")
-                                else:
-                                    logger.warning(f"Неожиданный формат результатов push: {results}")
-                        else:
-                            logger.warning(f"Не найден user_id для message_id {replied_message_id}")
+                    last_update_id = update.get("update_id")
+                    db.save_telegram_offset(last_update_id)
             
             time.sleep(1)
             
@@ -119,12 +512,107 @@ def process_telegram_updates():
             time.sleep(5)
 
 
+def sweep_expired_human_sessions():
+    """Periodically switch idle human-mode users back to AI and notify their sockets"""
+    while True:
+        time.sleep(SUPPORT_MODE_SWEEP_INTERVAL_SECONDS)
+        try:
+            user_ids = db.reset_expired_human_sessions(HUMAN_SUPPORT_TIMEOUT_MINUTES)
+            for user_id in user_ids:
+                SUPPORT_MODE_SWITCHES.labels("ai", "inactivity").inc()
+                logger.info(f"Пользователь {user_id} автоматически переключен на AI режим из-за неактивности")
+                if realtime.is_online(user_id):
+                    socketio.emit('support_mode_changed', {
+                        'user_id': user_id,
+                        'mode': 'ai',
+                        'reason': 'inactivity'
+                    }, room=user_id)
+        except Exception as e:
+            logger.error(f"Ошибка при сбросе неактивных сессий: {e}")
+
+
+def run_retention():
+    """Archive old messages and compact the database; runs on the poller leader only"""
+    while True:
+        time.sleep(RETENTION_INTERVAL_SECONDS)
+        if not poller_lease.is_leader:
+            continue
+        try:
+            result = retention.run_once()
+            logger.info(f"Обслуживание базы данных завершено: {result}")
+        except Exception as e:
+            logger.error(f"Ошибка при обслуживании базы данных: {e}")
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "ok"}), 200
+    return jsonify({"status": "ok", **realtime.stats()}), 200
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "presence": realtime.stats(),
+        "cache": db.cache_stats(),
+        "writer": db.writer_stats(),
+        "retention": retention.stats(),
+        "faq": faq.stats(),
+        "answer_tiers": tier_stats.stats(),
+        "suggestions": suggester.stats(),
+        "ai": ai_service.stats(),
+        "idempotency": idempotency.stats(),
+        "rate_limit": {
+            "user": user_limiter.stats(),
+            "ip": ip_limiter.stats(),
+            "concurrency": send_bulkhead.stats()
+        },
+        "logging": logging_stats()
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Метрики отключены"}), 404
+    response = make_response(REGISTRY.render(), 200)
+    response.headers['Content-Type'] = CONTENT_TYPE
+    return response
+
+
+@app.route('/admin/profiling', methods=['GET'])
+@require_api_key
+def get_profiling():
+    return jsonify({**profiler.state(), "profiles": profiler.profiles()}), 200
+
+
+@app.route('/admin/profiling', methods=['POST'])
+@require_api_key
+def set_profiling():
+    """Profile a share of requests for a limited time (cProfile or sampling flamegraph stacks)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        state = profiler.configure(
+            enabled=bool(data.get("enabled", True)),
+            mode=data.get("mode", "cprofile"),
+            sample_rate=float(data.get("sample_rate", 1.0)),
+            endpoints=data.get("endpoints"),
+            duration_seconds=float(data.get("duration_seconds", 300)),
+            max_profiles=int(data.get("max_profiles", 20))
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(state), 200
+
+
+@app.route('/admin/profiles/<filename>', methods=['GET'])
+@require_api_key
+def download_profile(filename):
+    return send_from_directory(os.path.abspath(PROFILE_DIR), secure_filename(filename), as_attachment=True)
 
 
 @app.route('/send_message', methods=['POST'])
+@rate_limited
+@idempotent
 def send_message():
     try:
         photo_paths = []
@@ -176,17 +664,12 @@ def send_message():
         # Update last user message time
         db.update_last_user_message_time(user_id)
         
-        # Check if user should be reset to AI mode due to inactivity
-        if db.should_reset_to_ai_mode(user_id, HUMAN_SUPPORT_TIMEOUT_MINUTES):
-            db.set_user_support_mode(user_id, "ai")
-            logger.info(f"Пользователь {user_id} автоматически переключен на AI режим из-за неактивности")
-        
-        # Get current support mode
+        # Get current support mode (inactivity resets are done by the sweeper)
         support_mode = db.get_user_support_mode(user_id)
         
         # Save user message to database first
         photo_url_for_db = photo_url if len(photo_urls) <= 1 else json.dumps(photo_urls)
-        db.save_message(
+        user_message_id = db.save_message(
             user_id=user_id,
             message_text=message_text,
             photo_url=photo_url_for_db,
@@ -195,32 +678,47 @@ def send_message():
         )
         
         # Emit user message to WebSocket
-        if user_id in active_connections:
-            socketio.emit('new_message', {
-                'user_id': user_id,
-                'message': message_text,
-                'photo_url': photo_url if len(photo_urls) <= 1 else photo_urls,
-                'direction': 'user',
-                'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-            }, room=user_id)
+        emit_new_message(user_id, user_message_id, message_text, 'user',
+                         photo_url=photo_url if len(photo_urls) <= 1 else photo_urls)
         
         # Check if user is requesting human support
         requesting_human = ai_service.is_human_support_requested(message_text)
+        handoff = False
         
         if support_mode == "ai" and not requesting_human:
-            # AI mode - get AI response
-            conversation_history = db.get_message_history(user_id, limit=20)
-            ai_response = ai_service.get_ai_response(message_text, conversation_history)
+            # AI mode - a confident local FAQ match first, OpenRouter otherwise
+            faq_match = None
+            if FAQ_ENABLED:
+                started = time.monotonic()
+                with span("faq"):
+                    faq_match = faq.match(message_text)
+                tier_stats.record("faq", faq_match is not None, time.monotonic() - started)
+            
+            if faq_match:
+                logger.info("Ответ из FAQ (%s, уверенность %s) для пользователя %s",
+                            faq_match['source'], faq_match['confidence'], user_id, extra=SAMPLED)
+                ai_response = faq_match["answer"]
+            else:
+                conversation_history = db.get_message_history(user_id, limit=20)
+                started = time.monotonic()
+                with span("ai"):
+                    ai_response, handoff = ai_service.answer_or_handoff(message_text, conversation_history)
+                tier_stats.record("llm", ai_response is not None or handoff, time.monotonic() - started)
             
-            if ai_response:
+            if handoff:
+                # The classifier asked for an operator before the reply was ready:
+                # handled below like an explicit request
+                requesting_human = True
+            elif ai_response:
                 # Check if AI itself suggests transferring to human
-                if ai_service.is_human_support_requested(ai_response):
+                if not faq_match and ai_service.is_human_support_requested(ai_response):
                     # AI suggested human support, switch mode
                     db.set_user_support_mode(user_id, "human")
+                    SUPPORT_MODE_SWITCHES.labels("human", "ai_suggested").inc()
                     support_mode = "human"
                 else:
                     # Save AI response and send to user
-                    db.save_message(
+                    ai_message_id = db.save_message(
                         user_id=user_id,
                         message_text=ai_response,
                         photo_url=None,
@@ -229,13 +727,7 @@ def send_message():
                     )
                     
                     # Emit AI response to WebSocket
-                    if user_id in active_connections:
-                        socketio.emit('new_message', {
-                            'user_id': user_id,
-                            'message': ai_response,
-                            'direction': 'support',
-                            'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-                        }, room=user_id)
+                    emit_new_message(user_id, ai_message_id, ai_response, 'support')
                     
                     # Send push notification
                     tokens = db.get_device_tokens(user_id)
@@ -245,12 +737,13 @@ def send_message():
                             "user_id": user_id,
                             "message": ai_response
                         }
-                        push_service.send_notification(
+                        results = push_service.send_notification(
                             tokens=tokens,
                             title="Ответ от поддержки",
                             body=ai_response,
                             data=push_data
                         )
+                        prune_invalid_tokens(user_id, results)
                     
                     return jsonify({
                         "success": True,
@@ -261,11 +754,12 @@ def send_message():
             else:
                 # AI unavailable, switch to human mode
                 db.set_user_support_mode(user_id, "human")
+                SUPPORT_MODE_SWITCHES.labels("human", "ai_unavailable").inc()
                 support_mode = "human"
                 
                 # Send unavailability message
                 unavailable_msg = ai_service.get_ai_unavailable_message()
-                db.save_message(
+                unavailable_message_id = db.save_message(
                     user_id=user_id,
                     message_text=unavailable_msg,
                     photo_url=None,
@@ -273,22 +767,17 @@ def send_message():
                     telegram_message_id=None
                 )
                 
-                if user_id in active_connections:
-                    socketio.emit('new_message', {
-                        'user_id': user_id,
-                        'message': unavailable_msg,
-                        'direction': 'support',
-                        'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-                    }, room=user_id)
+                emit_new_message(user_id, unavailable_message_id, unavailable_msg, 'support')
         
         # User requested human support while in AI mode
         if support_mode == "ai" and requesting_human:
             db.set_user_support_mode(user_id, "human")
+            SUPPORT_MODE_SWITCHES.labels("human", "classifier" if handoff else "requested").inc()
             support_mode = "human"
             
             # Send transfer message
             transfer_msg = ai_service.get_human_transfer_message()
-            db.save_message(
+            transfer_message_id = db.save_message(
                 user_id=user_id,
                 message_text=transfer_msg,
                 photo_url=None,
@@ -296,13 +785,7 @@ def send_message():
                 telegram_message_id=None
             )
             
-            if user_id in active_connections:
-                socketio.emit('new_message', {
-                    'user_id': user_id,
-                    'message': transfer_msg,
-                    'direction': 'support',
-                    'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-                }, room=user_id)
+            emit_new_message(user_id, transfer_message_id, transfer_msg, 'support')
         
         # Human support mode - forward to Telegram group
         if support_mode == "human":
@@ -314,12 +797,17 @@ def send_message():
                     photo_paths=photo_paths
                 )
             else:
+                suggestions = suggester.suggest(message_text) if SUGGESTIONS_ENABLED else None
                 result = bot.send_message_to_group(
                     user_id=user_id,
                     user_name=user_name,
                     message_text=message_text,
-                    photo_path=photo_path
+                    photo_path=photo_path,
+                    suggestions=suggestions
                 )
+                if result and suggestions:
+                    db.save_suggestion_offers(result["group_message_id"],
+                                              [suggestion["message_id"] for suggestion in suggestions])
             
             if result:
                 telegram_message_id = result.get("group_message_id")
@@ -362,6 +850,7 @@ def send_message():
 
 
 @app.route('/register_device', methods=['POST'])
+@idempotent
 def register_device():
     try:
         data = request.get_json()
@@ -411,39 +900,53 @@ def get_message_history(user_id):
     try:
         limit = request.args.get('limit', 50, type=int)
         user_name = request.args.get('user_name', '')
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
         
-        should_send_greeting = False
+        if before_id is not None and after_id is not None:
+            return jsonify({"error": "Укажите только один из параметров: before_id или after_id"}), 400
+        if limit <= 0:
+            return jsonify({"error": "limit должен быть больше 0"}), 400
         
-        if not db.was_greeting_sent_today(user_id):
-            should_send_greeting = True
-            greeting_text = f"Здравствуйте, {user_name}!" if user_name else "Здравствуйте!"
-            
-            db.save_message(
-                user_id=user_id,
-                message_text=greeting_text,
-                photo_url=None,
-                direction="support",
-                telegram_message_id=None
-            )
-            
-            db.mark_greeting_sent(user_id)
-            logger.info(f"Приветственное сообщение отправлено для пользователя {user_id}")
-            
-            if user_id in active_connections:
-                socketio.emit('new_message', {
-                    'user_id': user_id,
-                    'message': greeting_text,
-                    'direction': 'support',
-                    'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-                }, room=user_id)
+        greeting_text = f"Здравствуйте, {user_name}!" if user_name else "Здравствуйте!"
+        greeting_message_id = greetings.send_if_needed(user_id, greeting_text)
+        should_send_greeting = greeting_message_id is not None
         
-        history = db.get_message_history(user_id, limit)
+        if should_send_greeting:
+            logger.info("Приветственное сообщение отправлено для пользователя %s", user_id, extra=SAMPLED)
+            emit_new_message(user_id, greeting_message_id, greeting_text, 'support')
         
-        return jsonify({
+        # One extra row tells whether there is another page; the first page may come from
+        # this worker's ring buffer, which is refilled if it is behind the database
+        last_id = db.get_last_message_id(user_id) if before_id is None and after_id is None else None
+        history = db.get_message_history(user_id, limit + 1, before_id=before_id, after_id=after_id,
+                                         min_last_id=last_id)
+        
+        # Weak ETag of the rows actually returned and the page requested
+        etag = f"{user_id}:{history[-1]['id'] if history else 0}:{len(history)}:{limit}:{before_id}:{after_id}"
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag, weak=True)
+            return response
+        
+        has_more = len(history) > limit
+        
+        if after_id is not None:
+            history = history[:limit]
+            next_cursor = history[-1]["id"] if history else after_id
+        else:
+            history = history[-limit:]
+            next_cursor = history[0]["id"] if has_more else None
+        
+        response = jsonify({
             "success": True,
             "messages": history,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
             "greeting_sent": should_send_greeting
-        }), 200
+        })
+        response.set_etag(etag, weak=True)
+        return response, 200
         
     except Exception as e:
         logger.error(f"Ошибка при получении истории: {e}")
@@ -452,6 +955,41 @@ def get_message_history(user_id):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/search', methods=['GET'])
+@require_api_key
+def search_messages():
+    """Full-text search over all conversations for operators"""
+    try:
+        query = request.args.get('q', '').strip()
+        limit = request.args.get('limit', 20, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        user_id = request.args.get('user_id') or None
+        
+        if not query:
+            return jsonify({"error": "Параметр q обязателен"}), 400
+        if limit <= 0 or limit > 100:
+            return jsonify({"error": "limit должен быть от 1 до 100"}), 400
+        if offset < 0:
+            return jsonify({"error": "offset не может быть отрицательным"}), 400
+        if not db.search_enabled:
+            return jsonify({"error": "Полнотекстовый поиск недоступен: SQLite собран без FTS5"}), 503
+        
+        # One extra row tells whether there is another page
+        results = db.search_messages(query, limit + 1, offset, user_id=user_id)
+        has_more = len(results) > limit
+        
+        return jsonify({
+            "success": True,
+            "results": results[:limit],
+            "next_offset": offset + limit if has_more else None,
+            "has_more": has_more
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Ошибка при поиске сообщений: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/uploads/<filename>', methods=['GET'])
 def uploaded_file(filename):
     from flask import send_from_directory
@@ -477,11 +1015,6 @@ def check_device(user_id):
 def get_support_mode(user_id):
     """Get current support mode for user"""
     try:
-        # Check for inactivity reset
-        if db.should_reset_to_ai_mode(user_id, HUMAN_SUPPORT_TIMEOUT_MINUTES):
-            db.set_user_support_mode(user_id, "ai")
-            logger.info(f"Пользователь {user_id} автоматически переключен на AI режим из-за неактивности")
-        
         mode = db.get_user_support_mode(user_id)
         return jsonify({
             "success": True,
@@ -506,6 +1039,7 @@ def set_support_mode(user_id):
             return jsonify({"error": "mode должен быть 'ai' или 'human'"}), 400
         
         db.set_user_support_mode(user_id, mode)
+        SUPPORT_MODE_SWITCHES.labels(mode, "manual").inc()
         
         return jsonify({
             "success": True,
@@ -519,17 +1053,13 @@ def set_support_mode(user_id):
 
 @socketio.on('connect')
 def handle_connect():
-    logger.info(f"WebSocket подключение: {request.sid}")
+    logger.info("WebSocket подключение: %s", request.sid, extra=SAMPLED)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    for user_id, connections in list(active_connections.items()):
-        if request.sid in connections:
-            connections.remove(request.sid)
-            if not connections:
-                del active_connections[user_id]
-    logger.info(f"WebSocket отключение: {request.sid}")
+    realtime.remove_sid(request.sid)
+    logger.info("WebSocket отключение: %s", request.sid, extra=SAMPLED)
 
 
 @socketio.on('join_chat')
@@ -542,13 +1072,28 @@ def handle_join_chat(data):
         
         socketio.server.enter_room(request.sid, user_id)
         
-        if user_id not in active_connections:
-            active_connections[user_id] = []
-        if request.sid not in active_connections[user_id]:
-            active_connections[user_id].append(request.sid)
+        realtime.add_connection(user_id, request.sid)
+        
+        # Replay messages missed while disconnected; the room is joined first,
+        # so nothing is lost in between (clients drop duplicates by id)
+        replayed = 0
+        replay_truncated = False
+        last_seen_id = data.get('last_seen_id')
+        if last_seen_id is not None:
+            missed = db.get_message_history(user_id, limit=REPLAY_LIMIT + 1,
+                                            after_id=int(last_seen_id))
+            replay_truncated = len(missed) > REPLAY_LIMIT
+            for message in missed[:REPLAY_LIMIT]:
+                emit('new_message', {'user_id': user_id, **message, 'replayed': True})
+            replayed = min(len(missed), REPLAY_LIMIT)
         
-        logger.info(f"Пользователь {user_id} подключился к чату")
-        emit('joined', {'user_id': user_id, 'status': 'connected'})
+        logger.info("Пользователь %s подключился к чату", user_id, extra=SAMPLED)
+        emit('joined', {
+            'user_id': user_id,
+            'status': 'connected',
+            'replayed': replayed,
+            'replay_truncated': replay_truncated
+        })
         
     except Exception as e:
         logger.error(f"Ошибка при подключении к чату: {e}")
@@ -559,11 +1104,8 @@ def handle_join_chat(data):
 def handle_leave_chat(data):
     try:
         user_id = data.get('user_id')
-        if user_id and user_id in active_connections:
-            if request.sid in active_connections[user_id]:
-                active_connections[user_id].remove(request.sid)
-            if not active_connections[user_id]:
-                del active_connections[user_id]
+        if user_id:
+            realtime.remove_connection(user_id, request.sid)
         
         socketio.server.leave_room(request.sid, user_id)
         
@@ -572,9 +1114,24 @@ def handle_leave_chat(data):
 
 
 if __name__ == '__main__':
+    poller_lease.start()
+    atexit.register(poller_lease.stop)
+    atexit.register(db.close)
+    
     update_thread = threading.Thread(target=process_telegram_updates, daemon=True)
     update_thread.start()
     
+    sweeper_thread = threading.Thread(target=sweep_expired_human_sessions, daemon=True)
+    sweeper_thread.start()
+    
+    if FAQ_ENABLED or SUGGESTIONS_ENABLED:
+        index_thread = threading.Thread(target=load_answer_indexes, daemon=True)
+        index_thread.start()
+    
+    if RETENTION_ENABLED:
+        retention_thread = threading.Thread(target=run_retention, daemon=True)
+        retention_thread.start()
+    
     logger.info(f"Сервер запущен на {SERVER_HOST}:{SERVER_PORT}")
     socketio.run(app, host=SERVER_HOST, port=SERVER_PORT, debug=False, allow_unsafe_werkzeug=True)
 
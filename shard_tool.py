@@ -0,0 +1,216 @@
+"""
+Утилита для шардирования и обслуживания базы данных (DB_SHARDS).
+
+    python shard_tool.py status
+    python shard_tool.py migrate --shards 8 [--dry-run]
+    python shard_tool.py vacuum
+
+migrate переносит данные пользователей (messages, device_tokens, user_support_mode,
+greetings_sent) в файлы по новой схеме: из одного файла в N шардов, между разным
+числом шардов или обратно в один файл (--shards 0). Запускайте при остановленном
+сервере, затем выставьте DB_SHARDS равным --shards.
+
+Перенос идет пачками пользователей: строки копируются в целевой файл (INSERT OR
+IGNORE) и удаляются из исходного. После сбоя команду можно просто запустить снова.
+
+vacuum переводит файлы, созданные без auto_vacuum, в режим INCREMENTAL полным
+VACUUM (файл блокируется на все время перезаписи, поэтому тоже при остановленном
+сервере). Дальше место освобождает retention через PRAGMA incremental_vacuum.
+"""
+import argparse
+import glob
+import logging
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+from database import Database
+from logging_setup import configure_logging
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+USER_BATCH = 500
+
+# Таблицы с данными пользователей и столбцы, которые переносятся (без суррогатных id,
+# кроме messages: id сообщений уникальны во всех шардах и служат курсорами истории)
+USER_TABLES = {
+    "messages": "id, user_id, message_text, photo_url, direction, telegram_message_id, created_at",
+    "device_tokens": "user_id, fcm_token, platform, device_id, created_at, updated_at",
+    "user_support_mode": "user_id, mode, last_user_message_at, switched_at",
+    "greetings_sent": "user_id, greeting_date, created_at",
+}
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def existing_files(db: Database):
+    """Основной файл и все файлы шардов рядом с ним, в том числе от прежней схемы"""
+    stem, ext = os.path.splitext(db.db_path)
+    shard_files = sorted(glob.glob(f"{glob.escape(stem)}.shard[0-9][0-9]{ext}"))
+    return [db.db_path] + [path for path in shard_files if path != db.db_path]
+
+
+def status(db: Database):
+    for path in existing_files(db):
+        conn = connect(path)
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in USER_TABLES}
+        users = conn.execute("SELECT COUNT(DISTINCT user_id) FROM messages").fetchone()[0]
+        conn.close()
+        in_use = "" if path in db.all_paths() else "  (не используется при DB_SHARDS={})".format(db.shards)
+        print(f"{os.path.basename(path):32s} пользователей={users:<8d} "
+              + " ".join(f"{table}={count}" for table, count in counts.items()) + in_use)
+
+
+def vacuum(db: Database):
+    for path in db.all_paths():
+        conn = connect(path)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                print(f"{os.path.basename(path):32s} уже INCREMENTAL")
+                continue
+            started = time.monotonic()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            print(f"{os.path.basename(path):32s} VACUUM за {time.monotonic() - started:.1f} с")
+        finally:
+            conn.close()
+
+
+def raise_sequences(sources, targets):
+    """Поднимает счетчик id сообщений целевых файлов выше всех существующих id"""
+    high = 0
+    for path in sources:
+        conn = connect(path)
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        conn.close()
+        if row is not None:
+            high = max(high, row["seq"])
+
+    for path in targets:
+        conn = connect(path)
+        if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (high,)).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (high,))
+        conn.close()
+
+
+def copy_archive_index(sources, targets):
+    """Объединяет индексы архивов: архивные сообщения пользователя могли остаться от любого файла"""
+    months = {}
+    for path in sources:
+        conn = connect(path)
+        for row in conn.execute("SELECT month, min_id, max_id, row_count FROM message_archives"):
+            if row["month"] in months:
+                low, high, count = months[row["month"]]
+                months[row["month"]] = (min(low, row["min_id"]), max(high, row["max_id"]), count + row["row_count"])
+            else:
+                months[row["month"]] = (row["min_id"], row["max_id"], row["row_count"])
+        conn.close()
+
+    for path in targets:
+        conn = connect(path)
+        conn.executemany('''
+            INSERT INTO message_archives (month, min_id, max_id, row_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(month) DO UPDATE SET
+                min_id = MIN(min_id, excluded.min_id),
+                max_id = MAX(max_id, excluded.max_id)
+        ''', [(month, *values) for month, values in months.items()])
+        conn.close()
+
+
+def move_users(source: str, target: str, user_ids) -> int:
+    conn = connect(source)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE moving (user_id TEXT PRIMARY KEY)")
+    cursor.execute("ATTACH DATABASE ? AS target", (target,))
+    moved = 0
+    try:
+        for start in range(0, len(user_ids), USER_BATCH):
+            batch = user_ids[start:start + USER_BATCH]
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute("DELETE FROM temp.moving")
+                cursor.executemany("INSERT INTO temp.moving (user_id) VALUES (?)", [(uid,) for uid in batch])
+                for table, columns in USER_TABLES.items():
+                    cursor.execute(f'''
+                        INSERT OR IGNORE INTO target.{table} ({columns})
+                        SELECT {columns} FROM main.{table}
+                        WHERE user_id IN (SELECT user_id FROM temp.moving)
+                    ''')
+                    cursor.execute(f'''
+                        DELETE FROM main.{table}
+                        WHERE user_id IN (SELECT user_id FROM temp.moving)
+                    ''')
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            moved += len(batch)
+    finally:
+        cursor.execute("DETACH DATABASE target")
+        conn.close()
+    return moved
+
+
+def migrate(db: Database, dry_run: bool):
+    sources = existing_files(db)
+    targets = db.user_paths()
+
+    plan = defaultdict(lambda: defaultdict(list))
+    for source in sources:
+        conn = connect(source)
+        rows = conn.execute(" UNION ".join(f"SELECT user_id FROM {table}" for table in USER_TABLES)).fetchall()
+        conn.close()
+        for row in rows:
+            target = db.path_for_user(row["user_id"])
+            if target != source:
+                plan[source][target].append(row["user_id"])
+
+    total = sum(len(users) for targets_ in plan.values() for users in targets_.values())
+    for source, targets_ in plan.items():
+        for target, users in targets_.items():
+            print(f"{os.path.basename(source)} -> {os.path.basename(target)}: {len(users)} пользователей")
+    if dry_run or not total:
+        print(f"Всего к переносу: {total} пользователей" + (" (dry run)" if dry_run else ""))
+        return
+
+    raise_sequences(sources, targets)
+    copy_archive_index(sources, targets)
+    for source, targets_ in plan.items():
+        for target, users in targets_.items():
+            moved = move_users(source, target, users)
+            logger.info(f"Перенесено {moved} пользователей из {os.path.basename(source)} в {os.path.basename(target)}")
+
+    print(f"Готово: перенесено {total} пользователей. Установите DB_SHARDS={db.shards}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "migrate", "vacuum"])
+    parser.add_argument("--db", default="support_bot.db", help="имя основного файла базы")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="число шардов после переноса (0 — один файл); по умолчанию DB_SHARDS")
+    parser.add_argument("--dry-run", action="store_true", help="только показать план переноса")
+    args = parser.parse_args()
+
+    if args.shards is None:
+        from config import DB_SHARDS
+        args.shards = DB_SHARDS
+
+    db = Database(args.db, shards=args.shards)
+    if args.command == "status":
+        status(db)
+    elif args.command == "vacuum":
+        vacuum(db)
+    else:
+        migrate(db, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
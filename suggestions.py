@@ -0,0 +1,83 @@
+"""
+Подсказки ответов операторам по прошлым ответам на похожие вопросы.
+
+Каждая пара «вопрос пользователя -> ответ оператора» добавляется в RetrievalIndex
+(retrieval.py) по мере поступления, поэтому обновление стоит O(нового сообщения).
+Одинаковые ответы объединяются: для каждого текста хранится id последнего
+сообщения оператора с ним — он передается в callback_data кнопки (Telegram
+ограничивает ее 64 байтами) и по нему текст читается из БД на любой реплике.
+"""
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from retrieval import RetrievalIndex, normalize_text, np
+
+logger = logging.getLogger(__name__)
+
+
+class ReplySuggester:
+    """Индекс прошлых ответов операторов для подсказок к новым вопросам"""
+
+    def __init__(self, count: int = 3, min_confidence: float = 0.3):
+        self.count = count
+        self.min_confidence = min_confidence
+        self.index = RetrievalIndex() if np is not None else None
+
+        self._lock = threading.Lock()
+        self._answers: Dict[str, Dict] = {}  # нормализованный ответ -> {"message_id", "text"}
+
+    @property
+    def enabled(self) -> bool:
+        return self.index is not None
+
+    def add(self, question: Optional[str], answer: Optional[str], message_id: int):
+        """Добавляет ответ оператора на вопрос пользователя"""
+        if not self.enabled or not question or not answer:
+            return
+        key = normalize_text(answer)
+        with self._lock:
+            answer_entry = self._answers.get(key)
+            if answer_entry is None or message_id > answer_entry["message_id"]:
+                self._answers[key] = {"message_id": message_id, "text": answer}
+        self.index.add(question, key)
+
+    def load_history(self, db, limit: int = 50000) -> int:
+        """Наполняет индекс прошлыми парами вопрос -> ответ оператора"""
+        if not self.enabled:
+            return 0
+        started = time.monotonic()
+        pairs = db.get_operator_reply_pairs(limit)
+        for pair in pairs:
+            self.add(pair["question"], pair["answer"], pair["id"])
+        logger.info(f"Подсказки: проиндексировано {len(pairs)} ответов операторов "
+                    f"за {time.monotonic() - started:.1f} с")
+        return len(pairs)
+
+    def suggest(self, question: Optional[str]) -> List[Dict]:
+        """До count разных ответов на похожие вопросы: {"message_id", "text", "confidence"}"""
+        if not self.enabled or not question:
+            return []
+        suggestions = []
+        seen = set()
+        # С запасом: несколько похожих вопросов часто получали один и тот же ответ
+        for result in self.index.search(question, k=self.count * 4):
+            if result["confidence"] < self.min_confidence:
+                break
+            key = result["payload"]
+            if key in seen:
+                continue
+            seen.add(key)
+            with self._lock:
+                answer_entry = self._answers[key]
+            suggestions.append({**answer_entry, "confidence": round(result["confidence"], 3)})
+            if len(suggestions) == self.count:
+                break
+        return suggestions
+
+    def stats(self) -> Dict:
+        return {
+            "indexed_questions": len(self.index) if self.enabled else 0,
+            "answers": len(self._answers),
+        }
@@ -0,0 +1,254 @@
+"""
+Разбивка времени запроса по шагам и профилирование выбранных запросов.
+
+Trace живет в ContextVar потока запроса. Вызовы SQLite, Telegram и FCM (декоратор
+timed и track из metrics) и явные участки (span) суммируются по имени: в ответ
+уходит заголовок Server-Timing, в лог — одна строка JSON на запрос. Работа в
+других потоках (попытки OpenRouter, поток-писатель) в Trace не попадает, ее
+покрывает span вокруг ожидающего вызова.
+
+RequestProfiler включается администратором на время: доля запросов выбранных
+эндпоинтов выполняется под cProfile (файл .prof для snakeviz/flameprof) или под
+семплирующим профилировщиком (свернутые стеки .folded для flamegraph.pl и
+speedscope). Одновременно профилируется не больше одного запроса: начиная с
+Python 3.12 cProfile не может работать в двух потоках сразу.
+"""
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("smile_trace", default=None)
+
+
+class Trace:
+    """Суммарное время и число вызовов по именам шагов одного запроса"""
+
+    __slots__ = ("started", "spans")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, list] = {}  # имя -> [секунды, вызовы]
+
+    def add(self, name: str, seconds: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            span[0] += seconds
+            span[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total: float) -> str:
+        """Значение заголовка Server-Timing (длительности в мс)"""
+        parts = [f'{name};dur={seconds * 1000:.1f};desc="{count}"'
+                 for name, (seconds, count) in self.spans.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+    def as_dict(self, total: float) -> Dict:
+        return {
+            "total_ms": round(total * 1000, 2),
+            "spans": {name: {"ms": round(seconds * 1000, 2), "calls": count}
+                      for name, (seconds, count) in self.spans.items()},
+        }
+
+
+def start_trace() -> Trace:
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def end_trace():
+    _current_trace.set(None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record(name: str, seconds: float):
+    """Добавляет время к шагу текущего запроса (вне запроса ничего не делает)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+class span:
+    """Контекстный менеджер: время блока как шаг текущего запроса"""
+
+    __slots__ = ("name", "_started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self._started)
+        return False
+
+
+def log_trace(trace: Trace, total: float, **fields):
+    """Одна строка JSON с разбивкой времени запроса"""
+    logger.info("request_trace", extra={"fields": {**fields, **trace.as_dict(total)}})
+
+
+class _CProfileSession:
+    extension = "prof"
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop_and_save(self, path: str):
+        self._profile.disable()
+        self._profile.dump_stats(path)
+
+
+class _SamplingSession:
+    """Снимает стек потока запроса каждые interval секунд"""
+
+    extension = "folded"
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread_id = threading.get_ident()
+        self._stacks: Counter = Counter()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True, name="profiler-sampler")
+        self._sampler.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self._stacks[";".join(reversed(stack))] += 1
+
+    def stop_and_save(self, path: str):
+        self._stopped.set()
+        self._sampler.join()
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class RequestProfiler:
+    """Профилирование доли запросов выбранных эндпоинтов, включаемое на время"""
+
+    MODES = ("cprofile", "sampling")
+
+    def __init__(self, output_dir: str, sample_interval: float = 0.005):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+
+        self._lock = threading.Lock()
+        self._busy = False
+        self.enabled = False
+        self.mode = "cprofile"
+        self.sample_rate = 1.0
+        self.endpoints: Optional[set] = None
+        self.expires_at = 0.0
+        self.max_profiles = 0
+        self.saved = 0
+
+    def configure(self, enabled: bool, mode: str = "cprofile", sample_rate: float = 1.0,
+                  endpoints: Optional[Iterable[str]] = None, duration_seconds: float = 300,
+                  max_profiles: int = 20) -> Dict:
+        if mode not in self.MODES:
+            raise ValueError(f"mode должен быть одним из {self.MODES}")
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate должен быть в (0, 1]")
+        with self._lock:
+            self.mode = mode
+            self.sample_rate = sample_rate
+            self.endpoints = set(endpoints) if endpoints else None
+            self.expires_at = time.monotonic() + duration_seconds
+            self.max_profiles = max_profiles
+            self.saved = 0
+            self.enabled = enabled
+        logger.info(f"Профилирование {'включено' if enabled else 'выключено'}: {self.state()}")
+        return self.state()
+
+    def start(self, endpoint: Optional[str]):
+        """Сессия профилирования, если этот запрос попал в выборку, иначе None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if not self.enabled or self._busy:
+                return None
+            if time.monotonic() >= self.expires_at or self.saved >= self.max_profiles:
+                self.enabled = False
+                logger.info(f"Профилирование выключено: сохранено {self.saved} профилей")
+                return None
+            if self.endpoints is not None and endpoint not in self.endpoints:
+                return None
+            if random.random() >= self.sample_rate:
+                return None
+            self._busy = True
+            mode = self.mode
+        try:
+            if mode == "sampling":
+                return _SamplingSession(self.sample_interval)
+            return _CProfileSession()
+        except Exception as e:
+            with self._lock:
+                self._busy = False
+            logger.error(f"Не удалось запустить профилировщик: {e}")
+            return None
+
+    def finish(self, session, endpoint: Optional[str]) -> Optional[str]:
+        """Останавливает сессию и сохраняет профиль; возвращает путь к файлу"""
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint or 'unknown'}-{threading.get_ident()}"
+            path = os.path.join(self.output_dir, f"{name}.{session.extension}")
+            session.stop_and_save(path)
+            with self._lock:
+                self.saved += 1
+            logger.info(f"Профиль запроса {endpoint} сохранен: {path}")
+            return path
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении профиля: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def profiles(self, limit: int = 50) -> List[str]:
+        """Последние сохраненные профили"""
+        if not os.path.isdir(self.output_dir):
+            return []
+        names = [name for name in os.listdir(self.output_dir) if name.endswith((".prof", ".folded"))]
+        return sorted(names, reverse=True)[:limit]
+
+    def state(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "mode": self.mode,
+                "sample_rate": self.sample_rate,
+                "endpoints": sorted(self.endpoints) if self.endpoints else None,
+                "seconds_left": max(0, round(self.expires_at - time.monotonic())) if self.enabled else 0,
+                "max_profiles": self.max_profiles,
+                "saved": self.saved,
+            }
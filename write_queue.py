@@ -0,0 +1,219 @@
+"""
+Групповая фиксация (group commit) записей в SQLite.
+
+Каждая отдельная транзакция SQLite заканчивается fsync. При всплесках (сообщение
+пользователя, ответ AI и уведомление о переводе приходят за миллисекунды) большая
+часть времени уходит на фиксацию. GroupCommitWriter собирает операции записи из
+разных потоков и выполняет их одной транзакцией в отдельном потоке: пачка
+закрывается, когда набралось max_batch операций, прошло max_delay_ms с прихода
+первой или новые операции перестали поступать (пауза в десятую часть max_delay_ms).
+Каждая операция выполняется в своем SAVEPOINT, поэтому ошибка одной не откатывает
+остальные.
+
+Остановленный или упавший писатель сразу отклоняет новые операции (RuntimeError), а
+оставшиеся в очереди завершает ошибкой, чтобы ожидающие потоки не зависали.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError
+from typing import Any, Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _WriteOp:
+    __slots__ = ("func", "keys", "future")
+
+    def __init__(self, func: Callable[[sqlite3.Cursor], Any], keys: tuple):
+        self.func = func
+        self.keys = keys
+        self.future = Future()
+
+
+class GroupCommitWriter:
+    """Поток-писатель, фиксирующий операции пачками"""
+
+    def __init__(self, db_path: str, max_batch: int = 256, max_delay_ms: float = 5,
+                 commit_timeout: float = 10):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.commit_timeout = commit_timeout
+
+        self._queue: "queue.Queue" = queue.Queue()
+        # Ключи (user:<id>, tg:<id>) еще не зафиксированных операций — для read-your-writes
+        self._pending = Counter()
+        self._pending_cond = threading.Condition()
+
+        self.batches = 0
+        self.operations = 0
+        self.failed_operations = 0
+
+        # Проверка и постановка в очередь под одной блокировкой со stop: после _STOP
+        # в очередь ничего не попадает
+        self._submit_lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="group-commit-writer")
+        self._thread.start()
+
+    def submit(self, func: Callable[[sqlite3.Cursor], Any], keys: Iterable[str] = ()) -> Future:
+        """Ставит операцию в очередь; Future завершается после фиксации пачки"""
+        op = _WriteOp(func, tuple(keys))
+        with self._submit_lock:
+            if not self._running:
+                raise RuntimeError(f"Поток записи {self.db_path} остановлен")
+            if op.keys:
+                with self._pending_cond:
+                    self._pending.update(op.keys)
+            self._queue.put(op)
+        return op.future
+
+    def execute(self, func: Callable[[sqlite3.Cursor], Any], keys: Iterable[str] = ()) -> Any:
+        """Ставит операцию в очередь и ждет фиксации не дольше commit_timeout"""
+        future = self.submit(func, keys)
+        try:
+            return future.result(self.commit_timeout)
+        except TimeoutError:
+            # Операция может быть зафиксирована позже, но запрос не должен висеть
+            logger.error(f"Запись в {self.db_path} не зафиксирована за {self.commit_timeout} с "
+                         f"(в очереди {self.queue_depth})")
+            raise TimeoutError(f"Запись не зафиксирована за {self.commit_timeout} с")
+
+    def wait_for(self, key: str, timeout: Optional[float] = 5.0):
+        """Ждет фиксации всех поставленных операций с этим ключом"""
+        if not self._pending.get(key):
+            return
+        with self._pending_cond:
+            self._pending_cond.wait_for(lambda: not self._pending.get(key), timeout)
+
+    def flush(self, timeout: Optional[float] = 5.0):
+        """Ждет фиксации всего, что поставлено в очередь к этому моменту"""
+        self.submit(lambda cursor: None).result(timeout)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        with self._submit_lock:
+            if not self._running:
+                return
+            self._running = False
+            self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "batches": self.batches,
+            "operations": self.operations,
+            "failed_operations": self.failed_operations,
+            "avg_batch": round(self.operations / self.batches, 2) if self.batches else 0.0,
+        }
+
+    def _collect(self, first: _WriteOp) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        # Пачка закрывается раньше срока, если операции перестали поступать
+        idle_gap = self.max_delay / 10
+        while len(batch) < self.max_batch:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = min(deadline - time.monotonic(), idle_gap)
+                if remaining <= 0:
+                    break
+                try:
+                    op = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if op is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(op)
+        return batch
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            logger.error(f"Поток записи {self.db_path} остановился с ошибкой: {e}")
+        finally:
+            with self._submit_lock:
+                self._running = False
+            self._fail_queued()
+
+    def _fail_queued(self):
+        """Завершает ошибкой операции, оставшиеся в очереди после остановки потока"""
+        while True:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if op is _STOP:
+                continue
+            op.future.set_exception(RuntimeError(f"Поток записи {self.db_path} остановлен"))
+            with self._pending_cond:
+                self._pending.subtract(op.keys)
+                for key in op.keys:
+                    if self._pending[key] <= 0:
+                        del self._pending[key]
+                self._pending_cond.notify_all()
+
+    def _loop(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = self._collect(first)
+            results = []
+
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for op in batch:
+                    cursor.execute("SAVEPOINT op")
+                    try:
+                        results.append((True, op.func(cursor)))
+                        cursor.execute("RELEASE op")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO op")
+                        cursor.execute("RELEASE op")
+                        results.append((False, e))
+                cursor.execute("COMMIT")
+            except Exception as e:
+                logger.error(f"Ошибка при фиксации пачки из {len(batch)} операций: {e}")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                results = [(False, e)] * len(batch)
+
+            self.batches += 1
+            self.operations += len(batch)
+
+            for op, (ok, value) in zip(batch, results):
+                if ok:
+                    op.future.set_result(value)
+                else:
+                    self.failed_operations += 1
+                    op.future.set_exception(value)
+
+            with self._pending_cond:
+                for op in batch:
+                    self._pending.subtract(op.keys)
+                    for key in op.keys:
+                        if self._pending[key] <= 0:
+                            del self._pending[key]
+                self._pending_cond.notify_all()
+
+        conn.close()